@@ -13,16 +13,7 @@ import requests
 from PySide2.QtCore import Slot, QAbstractTableModel, QObject, QModelIndex, Qt, Signal, QThread, QAbstractItemModel
 
 from .devicemodel import DevicesTableModel, DeviceItem
-
-
-def discovery_rssi_to_weight(_rssi):
-    # type: (int) -> float
-    if _rssi > 45:
-        _rssi = 45
-    if _rssi <= 0:
-        _rssi = 0
-    _weight = 1.0 - _rssi / 45.0
-    return _weight if _weight > 0.05 else 0.05
+from ..hub2.linkquality import rssi_to_weight
 
 
 class EntityItem:
@@ -343,7 +334,7 @@ class ComunicationWorker(QObject):
                 if disc_ser_hex not in tnt:
                     tnt[disc_ser_hex] = {'target':disc_node, 'last': None, 'next': None, 'curr': None, 'orig': False}
 
-                tnt[disc_ser_hex]['curr'] = discovery_rssi_to_weight(disc_rssi), discovery_rssi_to_weight(disc_rssi2)
+                tnt[disc_ser_hex]['curr'] = rssi_to_weight(max(disc_rssi, 0)), rssi_to_weight(max(disc_rssi2, 0))
                 tnt[disc_ser_hex]['next'] = tnt[disc_ser_hex]['curr'] \
                     if tnt[disc_ser_hex]['last'] is None \
                     else ((tnt[disc_ser_hex]['last'][0] + tnt[disc_ser_hex]['curr'][0]) / 2, (tnt[disc_ser_hex]['last'][1] +
@@ -1,5 +1,6 @@
 import argparse
 import asyncio
+import functools
 import locale
 import logging
 import os
@@ -15,7 +16,12 @@ from .network import GraphNetwork
 from .serialprotocol import SerialProtocol
 from .connectedpath import connectedpath_setup, connectedpath_pre_run
 from .xmlrpcserver import xmlrpcserver_setup
+from .correlator import correlator_setup
+from .rtt import rtt_setup, rtt_shutdown
+from .linkquality import linklearner_setup
+from .connlog import connlog_setup, connlog_shutdown
 from .esphomeapi import esphomeapi_setup, esphomeapi_shutdown
+from .aggregator import aggregator_setup, aggregator_shutdown
 from .frame import APIFrame
 from .direct import DirectBase
 
@@ -29,13 +35,19 @@ def config_default(config):
     if 'serial' not in config:
         config['serial'] = {
             'port': '/dev/ttyUSB0',
-            'baud': 115200
+            'baud': 115200,
+            'rx_buffer_size': 2048
         }
     if 'server' not in config:
         config['server'] = {
             'bind_ip': 'localhost',
             'bind_port': 8801
         }
+    if 'esphome' not in config:
+        config['esphome'] = {
+            'aggregate_port': 0,
+            'aggregate_nodes': ''
+        }
 
 
 async def setup():
@@ -59,6 +71,7 @@ async def setup():
     else:
         local_node_serial = frame['serial']
         GraphNetwork.instance().local_node_id = local_node_serial
+        GraphNetwork.instance().precompute_routes()
     buffer = DirectBase.build_command('firm')
     frame = APIFrame(buffer, escaped=True)
     serprot.send_api_frame(frame)
@@ -75,6 +88,9 @@ async def shutdown(loop, signal_=None):
     if signal_:
         print(f"Received exit signal {signal_.name}...")
     esphomeapi_shutdown()
+    aggregator_shutdown()
+    rtt_shutdown()
+    await connlog_shutdown()
     await asyncio.sleep(1)
     loop.stop()
     print("Shutdown complete ...")
@@ -121,6 +137,8 @@ def main(_args=None):
                         help="Select default protocol")
     parser.add_argument("-ep", "--esphomeport", type=int, default=6053,
                         help="Select default protocol")
+    parser.add_argument("-ew", "--esphome-coalesce", type=float, default=5.0,
+                        help="Esphome API write coalescing window in milliseconds, 0 to disable")
     parser.add_argument("-eg", "--empty-graph", action='store_true', help='start with empty grpah. Coordinator only')
     args = parser.parse_args()
 
@@ -139,7 +157,9 @@ def main(_args=None):
     # loop.set_exception_handler(handle_exception)
     for s in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
         loop.add_signal_handler(s, lambda _s=s: asyncio.create_task(shutdown(loop, signal_=_s)))
-    coro = serial_asyncio.create_serial_connection(loop, SerialProtocol, conf['serial']['port'], baudrate=conf['serial']['baud'])
+    protocol_factory = functools.partial(SerialProtocol, conf.getint('serial', 'baud'),
+                                         conf.getint('serial', 'rx_buffer_size', fallback=2048))
+    coro = serial_asyncio.create_serial_connection(loop, protocol_factory, conf['serial']['port'], baudrate=conf['serial']['baud'])
     # coro = SerialProtocolW.create_serial_connection(conf['serial']['port'], baudrate=conf['serial']['baud'])
 
     if args.empty_graph:
@@ -154,11 +174,20 @@ def main(_args=None):
             print('Can\'t setup comunication with local node...')
             return
         connectedpath_setup()
+        correlator_setup()
+        rtt_setup(loop, 'meshmesh_rtt.json')
+        linklearner_setup(loop)
+        connlog_setup(loop, 'meshmesh_connections.db')
         print('serialconnection Setup phase completed... local node is 0x%08X firmware (%s)' % (local_node_serial, local_node_firm))
         xmlrpcserver_setup(loop, args.protocol, args.port)
         print('xmlrpcserver Setup phase completed...')
-        esphomeapi_setup(loop, args.esphomeport)
+        esphomeapi_setup(loop, args.esphomeport, args.esphome_coalesce / 1000.0)
         print('esphomeapi_setup Setup phase completed. Starting main loop')
+        aggregate_port = conf.getint('esphome', 'aggregate_port', fallback=0)
+        if aggregate_port > 0:
+            nodes = [int(n, 16) for n in conf.get('esphome', 'aggregate_nodes', fallback='').split(',') if n.strip()]
+            aggregator_setup(loop, aggregate_port, nodes)
+            print(f'aggregator_setup {len(nodes)} nodes on port {aggregate_port}')
         # loop.set_exception_handler(handle_exception)
         connectedpath_pre_run(loop)
         loop.run_forever()
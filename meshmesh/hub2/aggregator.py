@@ -0,0 +1,429 @@
+import asyncio
+import logging
+import struct
+import time
+
+from typing import Optional, Dict, List, Tuple, Any
+
+import networkx as nx
+
+from .connectedpath import ConnectedPathProtocol, Connection, STATUS_CONN_ACTIVE, STATUS_CONN_ERROR, \
+    CONNPATH_INVALID_HANDLE
+from .network import GraphNetwork
+from .apicache import ApiCache
+from .esphomeapi import ApiFrameReader, encode_api_message, read_varint, write_varint, fetch_revision, API_HELLO_REQUEST, \
+    API_HELLO_RESPONSE, API_CONNECT_REQUEST, API_CONNECT_RESPONSE, API_PING_REQUEST, API_PING_RESPONSE, \
+    API_DEVICE_INFO_REQUEST, API_DEVICE_INFO_RESPONSE, API_LIST_ENTITIES_REQUEST, API_LIST_ENTITIES_DONE_RESPONSE, \
+    API_SUBSCRIBE_STATES_REQUEST, API_NOT_ENTITIES
+
+GL_AGGREGATOR = None  # type: Optional[EsphomeAggregator]
+server = None  # type: Optional[Any]
+
+# Port of the ESPHome API on the nodes
+AGGREGATE_NODE_PORT = 6053
+# Connpath connections the aggregator may keep open at once, the last ones are reserved to commands
+AGGREGATE_MAX_SESSIONS = 16
+AGGREGATE_COMMAND_SLOTS = 2
+# A session opened by a command is closed after this many seconds without state changes or commands
+AGGREGATE_IDLE_TIMEOUT = 30.0
+# Nodes without a session are visited this often to refresh their state
+AGGREGATE_POLL_INTERVAL = 300.0
+# A refresh session is closed when the node was quiet this long, its state dump is complete
+AGGREGATE_REFRESH_QUIET = 1.0
+AGGREGATE_TICK = 0.5
+
+AGGREGATE_CLIENT_INFO = b'meshmeshhub'
+# API version announced to the clients of the aggregated endpoint
+AGGREGATE_API_VERSION = (1, 9)
+# Every message of the multiplexed stream is an ESPHome plaintext frame prefixed by the node id
+AGGREGATE_HEADER = struct.Struct('<I')
+
+# Node messages that are neither entities nor entity states
+AGGREGATE_NOT_STATES = (API_HELLO_RESPONSE, API_CONNECT_RESPONSE, API_DEVICE_INFO_RESPONSE) + API_NOT_ENTITIES
+
+
+class NodeSession(object):
+    """
+    ESPHome API session held by the hub with one node. It subscribes to the states and keeps the last
+    state of every entity, so the aggregated clients are served from memory when the session is closed.
+    """
+    def __init__(self, parent, node):
+        # type: (EsphomeAggregator, int) -> None
+        self._parent = parent  # type: EsphomeAggregator
+        self._node = node  # type: int
+        self._connection = None  # type: Optional[Connection]
+        self._open_task = None  # type: Optional[asyncio.Task]
+        self._reader = ApiFrameReader()  # type: ApiFrameReader
+        self._revision = None  # type: Optional[bytes]
+        self._entities = None  # type: Optional[List[bytes]]
+        self._expect_device_info = False  # type: bool
+        self._pending = []  # type: List[bytes]
+        # Last state of every entity, keyed by message type and entity key
+        self._states = {}  # type: Dict[Tuple[int, int], bytes]
+        self._last_activity = 0.0  # type: float
+        self._last_received = 0.0  # type: float
+        self._refreshed_at = 0.0  # type: float
+        # Opened only to read the states, not for a command
+        self._refresh = False  # type: bool
+
+    @property
+    def node(self):
+        # type: () -> int
+        return self._node
+
+    @property
+    def is_open(self):
+        # type: () -> bool
+        return self._open_task is not None or self._connection is not None
+
+    @property
+    def is_active(self):
+        # type: () -> bool
+        return self._connection is not None and self._connection.status == STATUS_CONN_ACTIVE
+
+    @property
+    def last_activity(self):
+        # type: () -> float
+        return self._last_activity
+
+    @property
+    def is_refresh(self):
+        # type: () -> bool
+        return self._refresh
+
+    @property
+    def refreshed_at(self):
+        # type: () -> float
+        return self._refreshed_at
+
+    def is_idle(self, now):
+        # type: (float) -> bool
+        if not self.is_active or self._pending:
+            return False
+        if self._refresh:
+            # States are sent right after the subscription, the dump is over when the node goes quiet
+            return self._entities is None and not self._expect_device_info and \
+                now - self._last_received > AGGREGATE_REFRESH_QUIET
+        return now - self._last_activity > AGGREGATE_IDLE_TIMEOUT
+
+    def description(self):
+        # type: () -> List[bytes]
+        """
+        Device info and entity list of the node, when known
+        """
+        entry = ApiCache.instance().lookup(self._node, self._revision)
+        frames = []
+        if entry is not None and entry.device_info is not None:
+            frames.append(entry.device_info)
+        if entry is not None and entry.entities is not None:
+            frames += entry.entities
+        return frames
+
+    def states(self):
+        # type: () -> List[bytes]
+        return list(self._states.values())
+
+    def open(self, refresh=False):
+        # type: (bool) -> None
+        now = time.monotonic()
+        self._refresh = refresh
+        self._refreshed_at = now
+        self._last_activity = now
+        self._open_task = asyncio.get_running_loop().create_task(self._open())
+
+    async def _open(self):
+        # The revision is asked again only when the cache entry of the node was dropped or replaced
+        if self._revision is None or ApiCache.instance().revision(self._node) != self._revision:
+            self._revision = await fetch_revision(self._node)
+        try:
+            path = GraphNetwork.instance().shortest_path(self._node) if GraphNetwork.instance().is_network_loaded() \
+                else [self._node]
+        except (nx.NetworkXNoPath, nx.NodeNotFound):
+            logging.warning(f'NodeSession.open {self._node:06X} not reachable')
+            self._open_task = None
+            return
+        cp = ConnectedPathProtocol.get()  # type: ConnectedPathProtocol
+        self._reader = ApiFrameReader()
+        self._connection = cp.make_connection_async(path, AGGREGATE_NODE_PORT, self._init_done, self._data_received,
+                                                    self._disconnected)
+        self._open_task = None
+
+    def close(self):
+        if self._open_task is not None:
+            self._open_task.cancel()
+            self._open_task = None
+        if self._connection is not None:
+            # Also while the connection is still opening, or it would be left to the mesh
+            if self._connection.status != STATUS_CONN_ERROR:
+                logging.debug(f'NodeSession.close {self._node:06X}:{self._connection.handle:04X}')
+                self._connection.disconnect_from_client()
+            self._connection = None
+
+    def send(self, frame):
+        # type: (bytes) -> None
+        """
+        Send a message of a client to the node, the session is opened if needed
+        """
+        self._last_activity = time.monotonic()
+        self._refresh = False
+        if self.is_active:
+            ConnectedPathProtocol.get().send_data_async(frame, self._connection.handle)
+        else:
+            self._pending.append(frame)
+            self._parent.acquire(self)
+
+    def _init_done(self):
+        if self._connection.status != STATUS_CONN_ACTIVE:
+            logging.warning(f'NodeSession.init_done {self._node:06X} connection failed')
+            self._connection = None
+            self._pending = []
+            return
+        entry = ApiCache.instance().lookup(self._node, self._revision)
+        hello = b'\x0a' + write_varint(len(AGGREGATE_CLIENT_INFO)) + AGGREGATE_CLIENT_INFO
+        request = encode_api_message(API_HELLO_REQUEST, hello) + encode_api_message(API_CONNECT_REQUEST)
+        if entry is None or entry.device_info is None:
+            self._expect_device_info = True
+            request += encode_api_message(API_DEVICE_INFO_REQUEST)
+        if entry is None or entry.entities is None:
+            self._entities = []
+            request += encode_api_message(API_LIST_ENTITIES_REQUEST)
+        request += encode_api_message(API_SUBSCRIBE_STATES_REQUEST)
+        request += b''.join(self._pending)
+        self._pending = []
+        self._last_received = time.monotonic()
+        ConnectedPathProtocol.get().send_data_async(request, self._connection.handle)
+
+    def _data_received(self, data):
+        # type: (bytes) -> None
+        self._last_received = time.monotonic()
+        messages = self._reader.feed(data)
+        if self._reader.invalid:
+            logging.warning(f'NodeSession.data_received {self._node:06X} not a plaintext API stream')
+            self.close()
+            return
+        cache = ApiCache.instance()
+        for msg_type, payload, frame in messages:
+            if msg_type == API_PING_REQUEST:
+                ConnectedPathProtocol.get().send_data_async(encode_api_message(API_PING_RESPONSE), self._connection.handle)
+            elif self._expect_device_info and msg_type == API_DEVICE_INFO_RESPONSE:
+                self._expect_device_info = False
+                if self._revision is not None:
+                    cache.entry(self._node, self._revision).device_info = frame
+                self._parent.broadcast(self._node, [frame])
+            elif self._entities is not None and msg_type not in AGGREGATE_NOT_STATES:
+                self._entities.append(frame)
+                if msg_type == API_LIST_ENTITIES_DONE_RESPONSE:
+                    if self._revision is not None:
+                        cache.entry(self._node, self._revision).entities = self._entities
+                    self._parent.broadcast(self._node, self._entities)
+                    self._entities = None
+            elif msg_type not in AGGREGATE_NOT_STATES and payload[:1] == b'\x0d' and len(payload) >= 5:
+                # State responses start with the fixed32 key of the entity
+                self._state_received(msg_type, struct.unpack_from('<I', payload, 1)[0], frame)
+
+    def _state_received(self, msg_type, key, frame):
+        # type: (int, int, bytes) -> None
+        previous = self._states.get((msg_type, key))
+        if previous == frame:
+            return
+        self._states[(msg_type, key)] = frame
+        if previous is not None:
+            # A change of a state already known, the node is likely to change again soon
+            self._last_activity = time.monotonic()
+        self._parent.broadcast(self._node, [frame])
+
+    def _disconnected(self):
+        logging.debug(f'NodeSession.disconnected {self._node:06X}')
+        if self._connection is not None and self._connection.error == CONNPATH_INVALID_HANDLE:
+            ApiCache.instance().invalidate(self._node, 'invalid handle')
+        self._connection = None
+        self._pending = []
+
+
+class EsphomeAggregator(object):
+    """
+    Merge the ESPHome API sessions of many nodes in a single endpoint. Node sessions are opened only
+    for commands, for nodes whose states are changing and for periodic refreshes, so the number of
+    connpath connections follows the activity and never exceeds AGGREGATE_MAX_SESSIONS.
+    """
+    @staticmethod
+    def instance():
+        # type: () -> EsphomeAggregator
+        global GL_AGGREGATOR
+        if GL_AGGREGATOR is None:
+            GL_AGGREGATOR = EsphomeAggregator()
+        return GL_AGGREGATOR
+
+    def __init__(self):
+        self._sessions = {}  # type: Dict[int, NodeSession]
+        self._clients = []  # type: List[AggregateProtocol]
+
+    def add_node(self, node):
+        # type: (int) -> None
+        if node not in self._sessions:
+            self._sessions[node] = NodeSession(self, node)
+
+    def nodes(self):
+        # type: () -> List[int]
+        return list(self._sessions.keys())
+
+    def session(self, node):
+        # type: (int) -> Optional[NodeSession]
+        return self._sessions.get(node)
+
+    def open_sessions(self):
+        # type: () -> int
+        return sum(1 for s in self._sessions.values() if s.is_open)
+
+    def add_client(self, client):
+        # type: (AggregateProtocol) -> None
+        self._clients.append(client)
+
+    def remove_client(self, client):
+        # type: (AggregateProtocol) -> None
+        if client in self._clients:
+            self._clients.remove(client)
+
+    def broadcast(self, node, frames):
+        # type: (int, List[bytes]) -> None
+        for client in self._clients:
+            client.send_frames(node, frames)
+
+    def acquire(self, session):
+        # type: (NodeSession) -> None
+        """
+        Open the session of a command, the least active open session is closed when all are in use
+        """
+        if session.is_open:
+            return
+        if self.open_sessions() >= AGGREGATE_MAX_SESSIONS:
+            active = [s for s in self._sessions.values() if s.is_active and s is not session]
+            if not active:
+                logging.warning(f'EsphomeAggregator.acquire {session.node:06X} no session available')
+                return
+            # Refresh sessions go first, then the least recently active
+            min(active, key=lambda s: (not s.is_refresh, s.last_activity)).close()
+        session.open()
+
+    def tick(self, now):
+        # type: (float) -> None
+        for session in self._sessions.values():
+            if session.is_idle(now):
+                session.close()
+        due = sorted((s for s in self._sessions.values() if not s.is_open and now - s.refreshed_at > AGGREGATE_POLL_INTERVAL),
+                     key=lambda s: s.refreshed_at)
+        available = AGGREGATE_MAX_SESSIONS - AGGREGATE_COMMAND_SLOTS - self.open_sessions()
+        for session in due[:max(available, 0)]:
+            session.open(refresh=True)
+
+    async def run(self):
+        # type: () -> None
+        while True:
+            await asyncio.sleep(AGGREGATE_TICK)
+            self.tick(time.monotonic())
+
+    def close(self):
+        for session in self._sessions.values():
+            session.close()
+        for client in self._clients:
+            client.close_transport()
+
+
+class AggregateProtocol(asyncio.Protocol):
+    """
+    Client of the aggregated endpoint. Both directions carry ESPHome plaintext frames prefixed by the
+    little endian node id. On connection the client receives device info, entities and states of
+    every node, then the state changes. Client requests for device info, entities and states are
+    answered from memory, hello, connect and pings by the hub, every other message is sent to its node.
+    """
+    def __init__(self):
+        super().__init__()
+        self._transport = None
+        self._buffer = bytearray()  # type: bytearray
+
+    def connection_made(self, transport):
+        logging.warning('AggregateProtocol.connection_made')
+        self._transport = transport
+        aggregator = EsphomeAggregator.instance()
+        aggregator.add_client(self)
+        for node in aggregator.nodes():
+            session = aggregator.session(node)
+            self.send_frames(node, session.description() + session.states())
+
+    def connection_lost(self, exc):
+        logging.warning('AggregateProtocol.connection_lost')
+        EsphomeAggregator.instance().remove_client(self)
+
+    def close_transport(self):
+        if self._transport:
+            self._transport.close()
+
+    def send_frames(self, node, frames):
+        # type: (int, List[bytes]) -> None
+        if not frames or self._transport is None or self._transport.is_closing():
+            return
+        header = AGGREGATE_HEADER.pack(node)
+        self._transport.writelines([header + frame for frame in frames])
+
+    def data_received(self, data):
+        # type: (bytes) -> None
+        self._buffer += data
+        while len(self._buffer) > AGGREGATE_HEADER.size:
+            if self._buffer[AGGREGATE_HEADER.size] != 0:
+                logging.error('AggregateProtocol.data_received invalid frame. Closing connection')
+                self._transport.close()
+                return
+            length, pos = read_varint(self._buffer, AGGREGATE_HEADER.size + 1)
+            if length is None:
+                return
+            msg_type, pos = read_varint(self._buffer, pos)
+            if msg_type is None or len(self._buffer) < pos + length:
+                return
+            node, = AGGREGATE_HEADER.unpack_from(self._buffer)
+            frame = bytes(self._buffer[AGGREGATE_HEADER.size:pos + length])
+            del self._buffer[:pos + length]
+            self._message_received(node, msg_type, frame)
+
+    def _message_received(self, node, msg_type, frame):
+        # type: (int, int, bytes) -> None
+        if msg_type == API_PING_REQUEST:
+            self.send_frames(node, [encode_api_message(API_PING_RESPONSE)])
+            return
+        if msg_type == API_HELLO_REQUEST:
+            major, minor = AGGREGATE_API_VERSION
+            hello = b'\x08' + write_varint(major) + b'\x10' + write_varint(minor) + \
+                b'\x1a' + write_varint(len(AGGREGATE_CLIENT_INFO)) + AGGREGATE_CLIENT_INFO
+            self.send_frames(node, [encode_api_message(API_HELLO_RESPONSE, hello)])
+            return
+        if msg_type == API_CONNECT_REQUEST:
+            # No password on the aggregated endpoint
+            self.send_frames(node, [encode_api_message(API_CONNECT_RESPONSE)])
+            return
+        session = EsphomeAggregator.instance().session(node)
+        if session is None:
+            logging.warning(f'AggregateProtocol.message_received node {node:06X} is not aggregated')
+        elif msg_type in (API_DEVICE_INFO_REQUEST, API_LIST_ENTITIES_REQUEST):
+            self.send_frames(node, session.description())
+        elif msg_type == API_SUBSCRIBE_STATES_REQUEST:
+            self.send_frames(node, session.states())
+        else:
+            session.send(frame)
+
+    def eof_received(self):
+        return False
+
+
+def aggregator_setup(loop, port, nodes):
+    # type: (asyncio.AbstractEventLoop, int, List[int]) -> None
+    global server
+    aggregator = EsphomeAggregator.instance()
+    for node in nodes:
+        aggregator.add_node(node)
+    server = loop.run_until_complete(loop.create_server(AggregateProtocol, host='0.0.0.0', port=port))
+    loop.create_task(aggregator.run())
+
+
+def aggregator_shutdown():
+    if server:
+        server.close()
+    EsphomeAggregator.instance().close()
@@ -0,0 +1,60 @@
+import logging
+
+from typing import Optional, Dict, List
+
+GL_API_CACHE = None  # type: Optional[ApiCache]
+
+
+class ApiCacheEntry(object):
+    def __init__(self, revision):
+        # type: (bytes) -> None
+        self.revision = revision  # type: bytes
+        self.device_info = None  # type: Optional[bytes]
+        self.entities = None  # type: Optional[List[bytes]]
+
+
+class ApiCache(object):
+    """
+    ESPHome API responses that depend only on the node firmware: DeviceInfoResponse and the
+    ListEntities responses. Entries are keyed by node and firmware revision, they are dropped
+    when the node reboots, starts an OTA update or reports another revision. Until then the
+    revision of the entry is taken as the node revision and not asked again.
+    """
+    @staticmethod
+    def instance():
+        # type: () -> ApiCache
+        global GL_API_CACHE
+        if GL_API_CACHE is None:
+            GL_API_CACHE = ApiCache()
+        return GL_API_CACHE
+
+    def __init__(self):
+        self._entries = {}  # type: Dict[int, ApiCacheEntry]
+
+    def entry(self, node, revision):
+        # type: (int, bytes) -> ApiCacheEntry
+        """
+        Entry of node for the given firmware revision, an entry of another revision is discarded
+        """
+        entry = self._entries.get(node)
+        if entry is None or entry.revision != revision:
+            if entry is not None:
+                logging.info(f'ApiCache node {node:06X} firmware changed {entry.revision} -> {revision}')
+            entry = ApiCacheEntry(revision)
+            self._entries[node] = entry
+        return entry
+
+    def revision(self, node):
+        # type: (int) -> Optional[bytes]
+        entry = self._entries.get(node)
+        return entry.revision if entry is not None else None
+
+    def lookup(self, node, revision):
+        # type: (int, Optional[bytes]) -> Optional[ApiCacheEntry]
+        entry = self._entries.get(node)
+        return entry if entry is not None and revision is not None and entry.revision == revision else None
+
+    def invalidate(self, node, reason=''):
+        # type: (int, str) -> None
+        if self._entries.pop(node, None) is not None:
+            logging.info(f'ApiCache node {node:06X} invalidated {reason}')
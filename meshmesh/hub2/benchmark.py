@@ -0,0 +1,278 @@
+import argparse
+import json
+import platform
+import random
+import struct
+import sys
+import time
+
+from collections import deque
+
+from .frame import APIFrame, APIFrameDecoder
+from .direct import DirectBase
+from .connectedpath import CMD_CONNPATH_REQUEST, CMD_CONNPATH_REPLY, MESHMESH_PROTOCOL_CONNPATH, CONNPATH_SEND_DATA, \
+    ConnectionTable
+
+# python -m meshmesh.hub2.benchmark --save baseline.json
+# python -m meshmesh.hub2.benchmark --compare baseline.json
+
+MIXES = ['connpath', 'multipath', 'discovery', 'logevent']
+# Concurrent connections in the connection table benchmarks
+CONNECTIONS = [10, 1000, 10000]
+
+
+def _esphome_message(rnd, msg_type, size):
+    # ESPHome plaintext API framing: preamble, varint length, varint type, protobuf payload
+    def varint(value):
+        out = bytearray()
+        while value > 0x7F:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+        return bytes(out)
+    payload = bytes(rnd.getrandbits(8) for _ in range(size))
+    return b'\x00' + varint(size) + varint(msg_type) + payload
+
+
+def _connpath_frame(cmd, handle, seq, data):
+    return struct.pack("<BBBHHHH", cmd, MESHMESH_PROTOCOL_CONNPATH, CONNPATH_SEND_DATA, handle, 0, seq, len(data)) + data
+
+
+def make_mix(name, count, seed=1):
+    """
+    make_mix: (str, int) -> ([callable, ...], [bytes, ...])
+
+    make_mix returns the commands used to build the outgoing frames of a
+    traffic mix and the unescaped payloads of the matching incoming frames.
+    """
+    rnd = random.Random(seed)
+    commands = []
+    replies = []
+    for i in range(count):
+        serial = rnd.randrange(0x000001, 0xFFFFFF)
+        if name == 'connpath':
+            # Home assistant states and entity lists tunnelled over connpath
+            msg = _esphome_message(rnd, rnd.choice([7, 8, 11, 12, 21, 25, 26]), rnd.randint(8, 220))
+            commands.append(lambda h=i & 0xFFFF, m=msg: _connpath_frame(CMD_CONNPATH_REQUEST, h, h, m))
+            replies.append(_connpath_frame(CMD_CONNPATH_REPLY, i & 0xFFFF, i & 0xFFFF, msg))
+        elif name == 'multipath':
+            # Six hops: five repeaters plus the target
+            path = [rnd.randrange(0x000001, 0xFFFFFF) for _ in range(5)]
+            if i % 8 == 0:
+                payload = DirectBase.build_command('spiflash/write', address=i * 1024,
+                                                   payload=bytes(rnd.getrandbits(8) for _ in range(1024)))
+            else:
+                payload = DirectBase.build_command(rnd.choice(['nodeId', 'firm', 'nodetag', 'discovery/count']))
+            commands.append(lambda s=serial, p=path, b=payload: DirectBase.build_command(
+                'multipath', target=s, pathlen=len(p), path=p, payload=b))
+            replies.append(struct.pack('<BI', 5, serial) if i % 8 else struct.pack('<BBB', 31, 3, 0))
+        elif name == 'discovery':
+            commands.append(lambda s=serial, n=i & 0xFF: DirectBase.build_command(
+                'unicast', target=s, payload=DirectBase.build_command('discovery/get', index=n)))
+            replies.append(struct.pack('<BBBIhhH', 27, 5, i & 0xFF, serial, rnd.randint(-10, 45),
+                                       rnd.randint(-10, 45), 0))
+        elif name == 'logevent':
+            line = f'[D][sensor:{rnd.randint(0, 999)}]: \'Temperature\': Sending state {rnd.random() * 40:.2f} °C'
+            commands.append(lambda: DirectBase.build_command('nodeId'))
+            replies.append(struct.pack('<BHI', 0x39, rnd.randint(0, 7), serial) + line.encode())
+        else:
+            raise ValueError(f'Unknown mix {name}')
+    return commands, replies
+
+
+def _dispatch(data):
+    if data[0] == CMD_CONNPATH_REPLY:
+        return struct.unpack("<BBH", data[1:5])
+    return DirectBase.split_response(data)
+
+
+def _measure(func, min_time):
+    # Repeat the function until it run for at least min_time seconds, return the best run
+    best = None
+    runs = 0
+    start = time.perf_counter()
+    while True:
+        t0 = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None or elapsed < best else best
+        runs += 1
+        if time.perf_counter() - start >= min_time and runs >= 3:
+            return best
+
+
+def run_mix(name, count, min_time):
+    commands, replies = make_mix(name, count)
+    payloads = [c() for c in commands]
+    out_frames = [APIFrame(p, escaped=True) for p in payloads]
+    in_stream = b''.join(APIFrame(r, escaped=True).output() for r in replies)
+    out_bytes = sum(len(f.output()) for f in out_frames)
+    tx_buffer = bytearray()
+
+    def bench_build_command():
+        for c in commands:
+            c()
+
+    def bench_escape():
+        for p in payloads:
+            APIFrame.escape(p)
+
+    def bench_output():
+        for p in payloads:
+            APIFrame(p, escaped=True).output()
+
+    def bench_output_frames():
+        APIFrame.output_frames([APIFrame(p, escaped=True) for p in payloads], tx_buffer)
+
+    def bench_fill():
+        frame = None
+        for b in in_stream:
+            b = bytes([b])
+            if frame is None:
+                if b == APIFrame.START_BYTE:
+                    frame = APIFrame(escaped=True)
+                    frame.fill(b)
+            elif frame.fill(b):
+                frame.parse()
+                frame = None
+
+    def bench_decoder():
+        APIFrameDecoder(escaped=True).feed(in_stream)
+
+    def bench_reply_definition():
+        for r in replies:
+            if r[0] != CMD_CONNPATH_REPLY:
+                DirectBase._get_reply_definition(r)
+
+    def bench_split_response():
+        for r in replies:
+            _dispatch(r)
+
+    benches = [
+        ('encode.build_command', bench_build_command, out_bytes),
+        ('encode.escape', bench_escape, out_bytes),
+        ('encode.output', bench_output, out_bytes),
+        ('encode.output_frames', bench_output_frames, out_bytes),
+        ('decode.fill', bench_fill, len(in_stream)),
+        ('decode.stream', bench_decoder, len(in_stream)),
+        ('decode.reply_definition', bench_reply_definition, len(in_stream)),
+        ('decode.split_response', bench_split_response, len(in_stream)),
+    ]
+
+    results = {}
+    for bench_name, func, size in benches:
+        elapsed = _measure(func, min_time)
+        results[f'{name}.{bench_name}'] = {
+            'frames_s': count / elapsed,
+            'mb_s': size / elapsed / 1e6,
+        }
+    return results
+
+
+class _TableEntry(object):
+    # Stand in for Connection, the table only needs handle, target and port
+    def __init__(self, handle, target, port):
+        self.handle = handle
+        self.target = target
+        self.port = port
+
+
+def run_connections(count, frames, min_time):
+    """
+    Dispatch of incoming frames and connection churn with count connections open
+    """
+    rnd = random.Random(count)
+    table = ConnectionTable()
+    for _ in range(count):
+        table.add(_TableEntry(table.allocate_handle(), rnd.randrange(0x000001, 0xFFFFFF), rnd.choice([0, 6053])))
+    entries = deque(table)
+    handles = [rnd.choice(entries).handle for _ in range(frames)]
+    endpoints = [(e.target, e.port) for e in (rnd.choice(entries) for _ in range(frames))]
+
+    def bench_dispatch():
+        for h in handles:
+            table.by_handle(h)
+
+    def bench_find():
+        for t, p in endpoints:
+            table.by_endpoint(t, p)
+
+    def bench_churn():
+        # Close the oldest connection and open a new one, the table size stays the same
+        for _ in range(frames):
+            old = entries.popleft()
+            table.remove(old)
+            new = _TableEntry(table.allocate_handle(), old.target, old.port)
+            table.add(new)
+            entries.append(new)
+
+    results = {}
+    for bench_name, func in (('dispatch', bench_dispatch), ('find', bench_find), ('churn', bench_churn)):
+        elapsed = _measure(func, min_time)
+        results[f'connections{count}.{bench_name}'] = {'frames_s': frames / elapsed, 'mb_s': 0.0}
+    return results
+
+
+def compare_results(results, baseline, tolerance):
+    # type: (dict, dict, float) -> int
+    regressions = 0
+    print('')
+    print('|--------------------------------------------|--------------|--------------|---------|')
+    print('| Benchmark                                  | Baseline f/s | Current f/s  | Delta   |')
+    print('|--------------------------------------------|--------------|--------------|---------|')
+    for key, value in results.items():
+        if key not in baseline:
+            continue
+        base = baseline[key]['frames_s']
+        delta = (value['frames_s'] - base) / base
+        mark = ''
+        if delta < -tolerance:
+            mark = ' <<'
+            regressions += 1
+        print(f'| {key:42} | {base:12.0f} | {value["frames_s"]:12.0f} | {delta:+7.1%} |{mark}')
+    print('|--------------------------------------------|--------------|--------------|---------|')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the meshmesh hub frame codec')
+    parser.add_argument('--mix', dest='mix', default=None, choices=MIXES, action='append', help='traffic mix to run')
+    parser.add_argument('--frames', dest='frames', default=2000, type=int, help='frames per mix')
+    parser.add_argument('--min-time', dest='min_time', default=0.5, type=float, help='minimum seconds per benchmark')
+    parser.add_argument('--save', dest='save', default=None, help='save results as baseline file')
+    parser.add_argument('--compare', dest='compare', default=None, help='compare results with baseline file')
+    parser.add_argument('--connections', dest='connections', default=None, type=int, action='append',
+                        help='open connections in the connection table benchmark')
+    parser.add_argument('--tolerance', dest='tolerance', default=0.10, type=float, help='allowed slow down ratio')
+    args = parser.parse_args()
+
+    results = {}
+    print('|--------------------------------------------|--------------|----------|')
+    print('| Benchmark                                  | Frames/s     | MB/s     |')
+    print('|--------------------------------------------|--------------|----------|')
+    for mix in args.mix or MIXES:
+        for key, value in run_mix(mix, args.frames, args.min_time).items():
+            results[key] = value
+            print(f'| {key:42} | {value["frames_s"]:12.0f} | {value["mb_s"]:8.2f} |')
+    for count in args.connections or CONNECTIONS:
+        for key, value in run_connections(count, args.frames, args.min_time).items():
+            results[key] = value
+            print(f'| {key:42} | {value["frames_s"]:12.0f} | {"-":>8} |')
+    print('|--------------------------------------------|--------------|----------|')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(), 'frames': args.frames, 'results': results}, f, indent=2)
+        print(f'Baseline saved to {args.save}')
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare_results(results, baseline, args.tolerance)
+        if regressions > 0:
+            print(f'{regressions} benchmarks slower than baseline by more than {args.tolerance:.0%}')
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,18 @@ import asyncio
 import binascii
 import struct
 import logging
-import datetime
+import time
 
-from typing import Optional, List, Callable
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, List, Set, Tuple, Callable, Any, Iterator, AsyncIterator
 
-from .serialprotocol import SerialProtocol
+from .serialprotocol import SerialProtocol, TxFrameHandler, TX_PRIORITY_LINK, TX_PRIORITY_RPC, TX_PRIORITY_STREAM, \
+    TX_SOURCE_CONN
 from .network import GraphNetwork
+from .rtt import RttTable
+from .linkquality import LinkLearner
+from .connlog import ConnetionLogLine
 
 from .frame import APIFrame
 
@@ -23,6 +29,26 @@ CONNPATH_CLEAR_CONNECTIONS = 10
 CMD_CONNPATH_REQUEST = 122
 CMD_CONNPATH_REPLY = 123
 
+CONNPATH_HANDLE_MIN = 1
+CONNPATH_HANDLE_MAX = 65535
+# Largest payload of a single SEND_DATA frame
+CONNPATH_DATA_MTU = 1024
+# Size of the request header that precedes the data of a connpath frame
+CONNPATH_HEADER_SIZE = struct.calcsize("<BBBHHHH")
+
+# Connections of the connpath RPC pool, opening or leased or idle
+POOL_MAX_CONNECTIONS = 8
+# Idle pooled connections older than this are closed
+POOL_IDLE_TIMEOUT = 60.0
+
+
+def connection_source(handle):
+    # type: (int) -> Tuple[str, int]
+    """
+    TX queue source of the frames of a connection
+    """
+    return TX_SOURCE_CONN, handle
+
 
 def connectpath_receive_callback(data):
     ConnectedPathProtocol.get().receive_data(data)
@@ -45,52 +71,80 @@ STATUS_CONN_ACTIVE = 1
 STATUS_CONN_ERROR = 2
 
 
-class ConnetionLogLine(object):
-    def __init__(self, path, handle, port):
-        self._path = path
-        self._handle = handle
-        self._port = port
-        self._created_at = datetime.datetime.now()
-        self._finished_at = None
-        self._termination_reason = ''
-
-    def close_connection(self, reason):
-        self._termination_reason = reason
-        self._finished_at = datetime.datetime.now()
-
-    @property
-    def handle(self):
-        return self._handle
+class ConnectionTable(object):
+    """
+    Active connections indexed by handle and by (target, port).
+    Handles are allocated round robin skipping the live ones, so a handle is never shared and a
+    closed one is reused as late as possible: late frames of a closed connection do not reach a new one.
+    """
+    def __init__(self):
+        self._by_handle = {}  # type: Dict[int, Connection]
+        self._by_endpoint = {}  # type: Dict[Tuple[int, int], Dict[int, Connection]]
+        self._next_handle = CONNPATH_HANDLE_MIN  # type: int
 
-    @property
-    def port(self):
-        return self._port
+    def __len__(self):
+        return len(self._by_handle)
 
-    @property
-    def path(self):
-        return self._path
+    def __iter__(self):
+        # type: () -> Iterator[Connection]
+        return iter(list(self._by_handle.values()))
 
-    @property
-    def created_at(self):
-        return self._created_at
+    def __contains__(self, handle):
+        return handle in self._by_handle
 
-    @property
-    def finished_at(self):
-        return self._finished_at
+    def allocate_handle(self):
+        # type: () -> int
+        if len(self._by_handle) > CONNPATH_HANDLE_MAX - CONNPATH_HANDLE_MIN:
+            raise ConnectedPathError('No free connection handle')
+        handle = self._next_handle
+        while handle in self._by_handle:
+            handle = handle + 1 if handle < CONNPATH_HANDLE_MAX else CONNPATH_HANDLE_MIN
+        self._next_handle = handle + 1 if handle < CONNPATH_HANDLE_MAX else CONNPATH_HANDLE_MIN
+        return handle
 
-    @property
-    def termination_reason(self):
-        return self._termination_reason
+    def add(self, connection):
+        # type: (Connection) -> None
+        if connection.handle in self._by_handle:
+            raise ConnectedPathError(f'Connection handle {connection.handle:04X} already in use')
+        self._by_handle[connection.handle] = connection
+        self._by_endpoint.setdefault((connection.target, connection.port), {})[connection.handle] = connection
+
+    def remove(self, connection):
+        # type: (Connection) -> bool
+        if self._by_handle.get(connection.handle) is not connection:
+            return False
+        del self._by_handle[connection.handle]
+        key = (connection.target, connection.port)
+        endpoint = self._by_endpoint[key]
+        del endpoint[connection.handle]
+        if not endpoint:
+            del self._by_endpoint[key]
+        return True
+
+    def by_handle(self, handle):
+        # type: (int) -> Optional[Connection]
+        return self._by_handle.get(handle)
+
+    def by_endpoint(self, target, port):
+        # type: (int, int) -> Optional[Connection]
+        """
+        Oldest connection still open to target and port
+        """
+        endpoint = self._by_endpoint.get((target, port))
+        return next(iter(endpoint.values())) if endpoint else None
 
 
 class Connection(object):
-    def __init__(self, parent, target, handle, port):
-        #  type: (ConnectedPathProtocol, int, int, int) -> None
+    def __init__(self, parent, target, handle, port, path=None):
+        #  type: (ConnectedPathProtocol, int, int, int, Optional[List[int]]) -> None
         loop = asyncio.get_running_loop()
         self._handle = handle  # type: int
         self._target = target  # type: int
+        self._path = path  # type: Optional[List[int]]
+        self._tx_handler = None  # type: Optional[TxFrameHandler]
         self._port = port  # type: int
         self._status = STATUS_CONN_INIT  # type: int
+        self._error = 0  # type: int
         self._init_done = loop.create_future()  # type: asyncio.Future
         self._reply_received = None  # type: Optional[asyncio.Future]
         self._init_done_callback = None  # type: Optional[Callable]
@@ -108,13 +162,19 @@ class Connection(object):
             else:
                 logging.error('CONNPATH_OPEN_CONNECTION_ACK on already active connection for {self.target:06X}:{self._handle:04X}')
         elif subprot == CONNPATH_OPEN_CONNECTION_NACK:
+            # Refused by the target, the path itself delivered the request and the answer
+            LinkLearner.instance().path_result(self._path, True)
             self.init_error()
         elif subprot == CONNPATH_SEND_DATA:
+            LinkLearner.instance().path_result(self._path, True)
             if self.receive_callback is not None:
                 self.receive_callback(buffer)
             elif self._reply_received is not None and not self._reply_received.done():
                 self._reply_received.set_result(buffer)
         elif subprot in [CONNPATH_SEND_DATA_ERROR, CONNPATH_INVALID_HANDLE]:
+            self._error = subprot
+            if subprot == CONNPATH_SEND_DATA_ERROR:
+                LinkLearner.instance().path_result(self._path, False)
             self.data_error()
 
     def register_callbacks(self, init_done, receive, disconnect):
@@ -127,28 +187,41 @@ class Connection(object):
         self._receive_callback = None
         self._disconnect_callback = None
 
-    def make_connection(self):
+    def make_connection(self, tx_handler):
+        #  type: (TxFrameHandler) -> None
+        self._tx_handler = tx_handler
         asyncio.create_task(self.wait_init_done())
 
     def disconnect_from_client(self):
         logging.debug(f'Connection.disconnect_from_client {self.target:06X}:{self.handle:04X}')
         self.unregister_callbacks()
+        if not self._init_done.done():
+            # Closed while opening, the wait for the open ACK ends here
+            self._init_done.cancel()
         self._parent.request_disconnection(self.handle)
         self._log_line.close_connection('CD')
         self._parent.remove_connection(self)
 
-    def send_data_from_client(self, data):
-        #  type: (bytes) -> None
-        self._parent.send_data_async(data, self._handle)
+    def send_data_from_client(self, data, priority=TX_PRIORITY_STREAM):
+        #  type: (bytes, int) -> None
+        self._tx_handler = self._parent.send_data_async(data, self._handle, priority)
 
-    async def wait_reply_from_server(self):
-        #  type: () -> bytes
+    async def wait_reply_from_server(self, slow=False):
+        #  type: (bool) -> bytes
         loop = asyncio.get_running_loop()
         self._reply_received = loop.create_future()
+        rtt = RttTable.instance()
 
+        # The data may wait in the TX queue, the round trip and the deadline start when it is written
         try:
-            await asyncio.wait_for(self._reply_received, 5)
+            await self._tx_handler.wait_written()
         except asyncio.TimeoutError:
+            raise ConnectedPathError('Data not written to the serial port')
+        try:
+            await asyncio.wait_for(self._reply_received, rtt.timeout(self._target, self._path, 5.0, slow))
+        except asyncio.TimeoutError:
+            rtt.timed_out(self._target, self._path)
+            LinkLearner.instance().path_result(self._path, False)
             raise ConnectedPathError('Reply not received')
 
         try:
@@ -159,6 +232,8 @@ class Connection(object):
             raise ConnectedPathError('Invalid state error')
 
         self._reply_received = None
+        if not slow:
+            rtt.sample(self._target, time.monotonic() - self._tx_handler.written_at, self._path)
         return result
 
     def init_done_callback(self, fut):
@@ -174,13 +249,26 @@ class Connection(object):
             logging.debug(f'Connection.init_done_callback to {self.target:06X}:{self._handle:04X} InvalidStateError')
 
     async def wait_init_done(self):
+        rtt = RttTable.instance()
+        timeout = rtt.timeout(self._target, self._path, 1.3)
+        # The open request may wait in the TX queue, the deadline starts when it is written
         try:
-            await asyncio.wait_for(self._init_done, 1.3)
+            await self._tx_handler.wait_written()
         except asyncio.TimeoutError:
-            print('Connection.init_terminated TimeoutError after 1.3s')
+            logging.error(f'Connection.wait_init_done {self.target:06X}:{self._handle:04X} request not written')
+            self.init_error()
+            return
+        try:
+            await asyncio.wait_for(self._init_done, timeout)
+        except asyncio.TimeoutError:
+            print(f'Connection.init_terminated TimeoutError after {timeout:.2f}s')
+            rtt.timed_out(self._target, self._path)
+            LinkLearner.instance().path_result(self._path, False)
             self.init_error()
 
     def init_done(self):
+        RttTable.instance().sample(self._target, time.monotonic() - self._tx_handler.written_at, self._path)
+        LinkLearner.instance().path_result(self._path, True)
         self._status = STATUS_CONN_ACTIVE
         try:
             self._init_done.set_result(True)
@@ -212,6 +300,11 @@ class Connection(object):
     def handle(self):
         return self._handle
 
+    @property
+    def tx_source(self):
+        # type: () -> Tuple[str, int]
+        return connection_source(self._handle)
+
     @property
     def target(self):
         return self._target
@@ -220,10 +313,19 @@ class Connection(object):
     def port(self):
         return self._port
 
+    @property
+    def path(self):
+        return self._path
+
     @property
     def status(self):
         return self._status
 
+    @property
+    def error(self):
+        # Sub protocol of the error that closed the connection, 0 if none
+        return self._error
+
     @property
     def init_done_future(self):
         #  type: () -> asyncio.Future
@@ -248,6 +350,119 @@ class Connection(object):
         self._log_line = value
 
 
+class ConnectionPool(object):
+    """
+    Warm connections used by send_and_receive_data. A connection is leased to one request at a
+    time and then parked idle for its target, so following requests skip the handshake.
+    Connections are capped at POOL_MAX_CONNECTIONS: when the cap is reached the least recently
+    used idle connection is closed, if none is idle requests wait for a lease to end.
+    """
+    def __init__(self, parent, port=0, max_connections=POOL_MAX_CONNECTIONS, idle_timeout=POOL_IDLE_TIMEOUT):
+        #  type: (ConnectedPathProtocol, int, int, float) -> None
+        self._parent = parent  # type: ConnectedPathProtocol
+        self._port = port  # type: int
+        self._max_connections = max_connections  # type: int
+        self._idle_timeout = idle_timeout  # type: float
+        self._idle = OrderedDict()  # type: OrderedDict[Connection, float]
+        self._leased = set()  # type: Set[Connection]
+        self._opening = 0  # type: int
+        self._changed = asyncio.Condition()  # type: asyncio.Condition
+
+    def __len__(self):
+        return len(self._idle) + len(self._leased) + self._opening
+
+    @property
+    def idle_count(self):
+        return len(self._idle)
+
+    def _take_idle(self, target, path):
+        #  type: (int, List[int]) -> Optional[Connection]
+        for conn in reversed(self._idle):
+            if conn.target == target:
+                del self._idle[conn]
+                if conn.status == STATUS_CONN_ACTIVE and conn.path == path:
+                    return conn
+                # Broken or routed on an old path
+                conn.disconnect_from_client()
+                return self._take_idle(target, path)
+        return None
+
+    def _close_lru(self):
+        #  type: () -> bool
+        if not self._idle:
+            return False
+        conn, _ = self._idle.popitem(last=False)
+        logging.debug(f'ConnectionPool.close_lru {conn.target:06X}:{conn.handle:04X}')
+        conn.disconnect_from_client()
+        return True
+
+    async def _acquire(self, target):
+        #  type: (int) -> Connection
+        path = GraphNetwork.instance().shortest_path(target)
+        async with self._changed:
+            while True:
+                conn = self._take_idle(target, path)
+                if conn is not None:
+                    self._leased.add(conn)
+                    return conn
+                if len(self) < self._max_connections or self._close_lru():
+                    self._opening += 1
+                    break
+                await self._changed.wait()
+
+        try:
+            conn = self._parent.make_connection_async(path, self._port)
+        finally:
+            self._opening -= 1
+        self._leased.add(conn)
+        if not await conn.init_done_future:
+            await self._release(conn, False)
+            raise ConnectedPathError(f'Connection to {target:06X} refused')
+        return conn
+
+    async def _release(self, conn, reusable):
+        #  type: (Connection, bool) -> None
+        self._leased.discard(conn)
+        if reusable and conn.status == STATUS_CONN_ACTIVE:
+            self._idle[conn] = time.monotonic()
+        elif conn.status != STATUS_CONN_ERROR:
+            conn.disconnect_from_client()
+        async with self._changed:
+            self._changed.notify()
+
+    @asynccontextmanager
+    async def lease(self, target):
+        #  type: (int) -> AsyncIterator[Connection]
+        conn = await self._acquire(target)
+        reusable = False
+        try:
+            yield conn
+            reusable = True
+        finally:
+            await self._release(conn, reusable)
+
+    def discard(self, conn):
+        #  type: (Connection) -> None
+        """
+        Forget a connection closed by the mesh
+        """
+        self._idle.pop(conn, None)
+
+    def expire(self):
+        #  type: () -> None
+        now = time.monotonic()
+        for conn, last_used in list(self._idle.items()):
+            if now - last_used > self._idle_timeout:
+                del self._idle[conn]
+                conn.disconnect_from_client()
+
+    async def expire_periodically(self):
+        #  type: () -> None
+        while True:
+            await asyncio.sleep(self._idle_timeout / 4)
+            self.expire()
+
+
 class ConnectedPathProtocol(object):
     _singleton = None  # type: Optional[ConnectedPathProtocol]
 
@@ -260,12 +475,11 @@ class ConnectedPathProtocol(object):
 
     def __init__(self):
         super().__init__()
-        self._next_handle = 1  # type: int
         self._sequence_number = 1  # type: int
         self._timeout = 3.0  # type: float
-        self._connections = []  # type: List[Connection]
+        self._connections = ConnectionTable()  # type: ConnectionTable
         self._serial_lock = asyncio.Lock()  # type: asyncio.Lock
-        self._log_lines = []  # type: List[ConnetionLogLine]
+        self._pool = ConnectionPool(self)  # type: ConnectionPool
         logging.info("ConnectedPathProtocol.__init__")
 
     @property
@@ -282,45 +496,42 @@ class ConnectedPathProtocol(object):
 
     @property
     def next_handle(self):
-        handle = self._next_handle
-        self._next_handle += 1
-        if self._next_handle > 65535:
-            self._next_handle = 1
-        return handle
+        return self._connections.allocate_handle()
 
     @property
     def version(self):
         return '1.0.0'
 
-    async def send_and_receive_data(self, data, target):
-        #  type: (bytes, int) -> bytes
+    @property
+    def pool(self):
+        #  type: () -> ConnectionPool
+        return self._pool
+
+    async def send_and_receive_data(self, data, target, priority=TX_PRIORITY_RPC, slow=False):
+        #  type: (bytes, int, int, bool) -> bytes
         logging.debug(f"send_and_receive_data target:0x{target:06X} {binascii.hexlify(data)}")
-        conn = self._find_connection(target, 0)
-        if conn is None:
-            targets = GraphNetwork.instance().shortest_path(target)
-            conn = self.make_connection_async(targets, 0)
-            await conn.init_done_future
-        conn.send_data_from_client(data)
-        return await conn.wait_reply_from_server()
+        async with self._pool.lease(target) as conn:
+            conn.send_data_from_client(data, priority)
+            return await conn.wait_reply_from_server(slow)
 
     def send_clear_all_connections(self):
         # type: () -> None
-        self.send_sub_protocol(0, CONNPATH_CLEAR_CONNECTIONS)
+        self.send_sub_protocol(0, CONNPATH_CLEAR_CONNECTIONS, priority=TX_PRIORITY_LINK)
 
     def send_invalid_handle(self, handle):
         # type: (int) -> None
-        self.send_sub_protocol(handle, CONNPATH_INVALID_HANDLE)
+        self.send_sub_protocol(handle, CONNPATH_INVALID_HANDLE, priority=TX_PRIORITY_LINK)
 
-    def send_data_async(self, data, handle):
-        # type: (bytes, int) -> None
-        self.send_sub_protocol(handle, CONNPATH_SEND_DATA, data)
+    def send_data_async(self, data, handle, priority=TX_PRIORITY_STREAM):
+        # type: (bytes, int, int) -> TxFrameHandler
+        return self.send_sub_protocol(handle, CONNPATH_SEND_DATA, data, priority)
 
-    def send_sub_protocol(self, handle, subprot, data=b''):
-        # type: (int, int, bytes) -> None
+    def send_sub_protocol(self, handle, subprot, data=b'', priority=TX_PRIORITY_STREAM):
+        # type: (int, int, bytes, int) -> TxFrameHandler
         buffer = struct.pack(f"<BBBHHHH", CMD_CONNPATH_REQUEST, MESHMESH_PROTOCOL_CONNPATH, subprot, handle, 0, self.sequence_number, len(data))
         if len(data) > 0:
             buffer += data
-        self._send_api_frame(buffer)
+        return self._send_api_frame(buffer, priority=priority, source=connection_source(handle))
 
     def make_connection_async(self, targets, port, init_done=None, receive=None, disconnect=None):
         # type: (List[int], int, Optional[Callable], Optional[Callable], Optional[Callable]) -> Connection
@@ -334,35 +545,42 @@ class ConnectedPathProtocol(object):
             buffer += struct.pack(f"{path_len}I", *targets)
 
         log_line = ConnetionLogLine(targets, handle, port)
-        self._log_lines.append(log_line)
 
-        conn = Connection(self, targets[-1], handle, port)
-        self._connections.append(conn)
+        conn = Connection(self, targets[-1], handle, port, targets)
+        self._connections.add(conn)
         conn.log_line = log_line
         conn.register_callbacks(init_done, receive, disconnect)
-        conn.make_connection()
-        self._send_api_frame(buffer, 0.5)
+        conn.make_connection(self._send_api_frame(buffer, RttTable.instance().timeout(targets[-1], targets, 0.5),
+                                                  TX_PRIORITY_LINK, connection_source(handle)))
 
-        logging.debug(f"make_connection_async active connections {len(self._connections)}")
-        for i in range(len(self._connections)):
-            c = self._connections[i]
-            logging.debug(f"make_connection_async {i} {c.target:06X}:{c.handle:04X}")
+        logging.debug(f"make_connection_async {conn.target:06X}:{conn.handle:04X} active connections {len(self._connections)}")
         return conn
 
+    @staticmethod
+    def take_unsent_data(handle):
+        # type: (int) -> bytes
+        """
+        Remove the data of handle still waiting for the serial link, it never reached the mesh
+        """
+        data = bytearray()
+        for handler in SerialProtocol.get().take_tx_source(connection_source(handle)):
+            for frame in handler.frames:
+                if frame.data[2] == CONNPATH_SEND_DATA:
+                    data += frame.data[CONNPATH_HEADER_SIZE:]
+        return bytes(data)
+
     def request_disconnection(self, handle):
         # type: (int) -> None
         buffer = struct.pack(f"<BBBHHHH", CMD_CONNPATH_REQUEST, MESHMESH_PROTOCOL_CONNPATH, CONNPATH_DISCONNECT_REQ,
                              handle, 0, self._sequence_number, 0)
         self._sequence_number += 1
-        self._send_api_frame(buffer)
+        self._send_api_frame(buffer, priority=TX_PRIORITY_LINK, source=connection_source(handle))
 
     def receive_data(self, buffer):
         #  type: (bytes) -> None
         prot, subprot, handle = struct.unpack("<BBH", buffer[0:4])
-        for conn in self._connections:
-            if handle == conn.handle:
-                break
-        else:
+        conn = self._connections.by_handle(handle)
+        if conn is None:
             logging.error(f'receive_data invalid handle {handle}')
             self.send_invalid_handle(handle)
             return
@@ -385,9 +603,8 @@ class ConnectedPathProtocol(object):
 
     def remove_connection(self, connection):
         #  type: (Connection) -> None
-        try:
-            self._connections.remove(connection)
-        except ValueError:
+        self._pool.discard(connection)
+        if not self._connections.remove(connection):
             logging.error(f'remove_connection already removed!')
 
     def connection_error(self, connection):
@@ -397,56 +614,22 @@ class ConnectedPathProtocol(object):
             connection.disconnect_callback()
         self._connections.remove(connection)
 
-    async def save_log_lines(self):
-        #  type: () -> None
-        while True:
-            with open('/dev/shm/connectedpath.log', 'w') as f:
-                f.write('indx | port | hndl | Created on           | Elapsed         | Tr | path\n')
-                f.write('-----|------|------|----------------------|-----------------|----|-------------------------------\n')
-                for i in range(len(self._log_lines)):
-                    line = self._log_lines[i]
-                    path = self._format_path(line.path)
-                    created = line.created_at.strftime("%m/%d/%Y, %H:%M:%S")
-                    endtime = line.finished_at if line.finished_at is not None else datetime.datetime.now()
-                    delta = endtime - line.created_at  # type: datetime.timedelta
-                    elapsed = f'{delta}'
-                    f.write(f'{i:04d} | {line.port:04d} | {line.handle:04X} | {created:20} | {elapsed:15} | {line.termination_reason:2} | { path}\n')
-            await asyncio.sleep(5)
-
     def _connection(self, handle):
         #  type: (int) -> Optional[Connection]
-        for c in self._connections:
-            if c.handle == handle:
-                return c
-        else:
-            return None
+        return self._connections.by_handle(handle)
 
     def _find_connection(self, target, port):
         #  type: (int, int) -> Optional[Connection]
-        for c in self._connections:
-            if c.target == target and c.port == port:
-                return c
-        else:
-            return None
-
-    @staticmethod
-    def _format_path(targets):
-        path = None
-        for target in targets:
-            if path is None:
-                path = f'{target:06X}'
-            else:
-                path += f' -> {target:06X}'
-        return path
+        return self._connections.by_endpoint(target, port)
 
     @staticmethod
-    def _send_api_frame(buffer, timeout=0):
-        #  type: (bytes, float) -> None
+    def _send_api_frame(buffer, timeout=0, priority=TX_PRIORITY_STREAM, source=None):
+        #  type: (bytes, float, int, Any) -> TxFrameHandler
         serial = SerialProtocol.get()  # type: SerialProtocol
         if serial is None:
             raise Exception('Serial protocol not initialized')
         frame = APIFrame(buffer, escaped=True)
-        serial.send_api_frame(frame, timeout)
+        return serial.send_api_frame(frame, timeout, priority, source)
 
     @staticmethod
     def _unlock_frame():
@@ -466,4 +649,4 @@ def connectedpath_setup():
 def connectedpath_pre_run(loop):
     #  type: (asyncio.AbstractEventLoop) -> None
     cp = ConnectedPathProtocol.get()  # type: ConnectedPathProtocol
-    loop.create_task(cp.save_log_lines())
+    loop.create_task(cp.pool.expire_periodically())
@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import sqlite3
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Deque, List, Tuple
+
+# Connections kept in memory, open ones included
+CONNLOG_RING_SIZE = 1024
+# Closed connections waiting to be written, the oldest are dropped when the database is not writable
+CONNLOG_PENDING_MAX = 8192
+CONNLOG_FLUSH_INTERVAL = 5.0
+# Rows older than this are deleted from the database
+CONNLOG_RETENTION = 30 * 86400
+CONNLOG_QUERY_LIMIT = 1000
+
+CONNLOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS connection_log (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    target INTEGER NOT NULL,
+    port INTEGER NOT NULL,
+    handle INTEGER NOT NULL,
+    path VARCHAR NOT NULL,
+    created_at REAL NOT NULL,
+    finished_at REAL NOT NULL,
+    reason VARCHAR NOT NULL);
+CREATE INDEX IF NOT EXISTS connection_log_target ON connection_log (target, created_at);
+CREATE INDEX IF NOT EXISTS connection_log_created ON connection_log (created_at);
+'''
+
+CONNLOG_COLUMNS = ['target', 'port', 'handle', 'path', 'created_at', 'finished_at', 'reason']
+
+GL_CONNECTION_LOG = None  # type: Optional[ConnectionLog]
+
+
+def format_path(path):
+    # type: (List[int]) -> str
+    # Separators on both ends so a hop can be matched with LIKE '%,0x123456,%'
+    return ',' + ','.join(f'0x{i:06X}' for i in path) + ','
+
+
+class ConnectionLog(object):
+    """
+    Log of the connpath connections. The last CONNLOG_RING_SIZE connections stay in memory, closed
+    connections are appended to a SQLite table in batches by a worker thread, so the event loop pays
+    only for the new events.
+    """
+    def __init__(self):
+        self._ring = deque(maxlen=CONNLOG_RING_SIZE)  # type: Deque[ConnetionLogLine]
+        self._pending = deque(maxlen=CONNLOG_PENDING_MAX)  # type: Deque[Tuple]
+        self._filename = None  # type: Optional[str]
+        self._db = None  # type: Optional[sqlite3.Connection]
+        # A single worker: the database connection is used by one thread only, writes are ordered
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='connlog')  # type: ThreadPoolExecutor
+        self._flush_task = None  # type: Optional[asyncio.Task]
+
+    @staticmethod
+    def instance():
+        # type: () -> ConnectionLog
+        global GL_CONNECTION_LOG
+        if GL_CONNECTION_LOG is None:
+            GL_CONNECTION_LOG = ConnectionLog()
+        return GL_CONNECTION_LOG
+
+    def opened(self, line):
+        # type: (ConnetionLogLine) -> None
+        self._ring.append(line)
+
+    def closed(self, line):
+        # type: (ConnetionLogLine) -> None
+        if self._filename is not None:
+            self._pending.append((line.path[-1] if line.path else 0, line.port, line.handle, format_path(line.path),
+                                  line.created_at, line.finished_at, line.termination_reason))
+
+    def recent(self):
+        # type: () -> List[dict]
+        now = time.time()
+        return [{
+            'target': line.path[-1] if line.path else 0,
+            'port': line.port,
+            'handle': line.handle,
+            'path': format_path(line.path),
+            'created_at': line.created_at,
+            'elapsed': (line.finished_at or now) - line.created_at,
+            'reason': line.termination_reason,
+        } for line in self._ring]
+
+    def _open(self):
+        # type: () -> sqlite3.Connection
+        if self._db is None:
+            self._db = sqlite3.connect(self._filename, check_same_thread=False)
+            self._db.executescript(CONNLOG_SCHEMA)
+        return self._db
+
+    def _write(self, rows):
+        # type: (List[Tuple]) -> None
+        db = self._open()
+        with db:
+            db.executemany(f'INSERT INTO connection_log ({",".join(CONNLOG_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            db.execute('DELETE FROM connection_log WHERE created_at < ?', (time.time() - CONNLOG_RETENTION,))
+
+    def _select(self, node, since, until, reason, limit):
+        # type: (int, float, float, str, int) -> List[dict]
+        where, args = [], []
+        if node:
+            where.append('(target = ? OR path LIKE ?)')
+            args += [node, f'%,0x{node:06X},%']
+        if since:
+            where.append('created_at >= ?')
+            args.append(since)
+        if until:
+            where.append('created_at < ?')
+            args.append(until)
+        if reason:
+            where.append('reason = ?')
+            args.append(reason)
+        sql = f'SELECT {",".join(CONNLOG_COLUMNS)} FROM connection_log'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY created_at DESC LIMIT ?'
+        args.append(min(limit, CONNLOG_QUERY_LIMIT) if limit > 0 else CONNLOG_QUERY_LIMIT)
+        return [dict(zip(CONNLOG_COLUMNS, row)) for row in self._open().execute(sql, args)]
+
+    async def flush(self):
+        # type: () -> None
+        if not self._pending or self._filename is None:
+            return
+        rows = list(self._pending)
+        self._pending.clear()
+        try:
+            # Rows taken from the queue are written even if the flush is cancelled
+            await asyncio.shield(asyncio.get_running_loop().run_in_executor(self._executor, self._write, rows))
+        except sqlite3.Error as ex:
+            logging.error(f'ConnectionLog.flush {len(rows)} rows lost {str(ex)}')
+
+    async def query(self, node=0, since=0.0, until=0.0, reason='', limit=CONNLOG_QUERY_LIMIT):
+        # type: (int, float, float, str, int) -> List[dict]
+        """
+        Closed connections, newest first. Zero or empty arguments do not filter, node matches the
+        target and every hop of the path.
+        """
+        if self._filename is None:
+            return []
+        await self.flush()
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._select, node, since, until, reason, limit)
+
+    def setup(self, loop, filename):
+        # type: (asyncio.AbstractEventLoop, str) -> None
+        self._filename = filename
+        self._flush_task = loop.create_task(self.flush_periodically())
+
+    async def close(self):
+        # type: () -> None
+        # The periodic flush must be over before the executor goes away
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        self._executor.shutdown()
+
+    async def flush_periodically(self):
+        # type: () -> None
+        while True:
+            await asyncio.sleep(CONNLOG_FLUSH_INTERVAL)
+            await self.flush()
+
+
+class ConnetionLogLine(object):
+    def __init__(self, path, handle, port):
+        self._path = path
+        self._handle = handle
+        self._port = port
+        self._created_at = time.time()  # type: float
+        self._finished_at = None  # type: Optional[float]
+        self._termination_reason = ''
+        ConnectionLog.instance().opened(self)
+
+    def close_connection(self, reason):
+        self._termination_reason = reason
+        self._finished_at = time.time()
+        ConnectionLog.instance().closed(self)
+
+    @property
+    def handle(self):
+        return self._handle
+
+    @property
+    def port(self):
+        return self._port
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def created_at(self):
+        return self._created_at
+
+    @property
+    def finished_at(self):
+        return self._finished_at
+
+    @property
+    def termination_reason(self):
+        return self._termination_reason
+
+
+def connlog_setup(loop, filename):
+    # type: (asyncio.AbstractEventLoop, str) -> None
+    ConnectionLog.instance().setup(loop, filename)
+
+
+async def connlog_shutdown():
+    await ConnectionLog.instance().close()
@@ -0,0 +1,184 @@
+import asyncio
+import binascii
+import logging
+import time
+
+from collections import OrderedDict
+from typing import Optional, Dict, Tuple, Callable, List, Set
+
+from .api import api_replies
+from .serialprotocol import SerialProtocol, TxFrameHandler
+from .rtt import RttTable, is_slow_command
+from .linkquality import LinkLearner
+from .network import GraphNetwork
+
+REPLY_ERROR_ID = 127
+ANY_REPLY = ('*',)
+# Replies that carry the serial of the node that sent them, at this offset
+SOURCE_REPLIES = {(5,): 1}
+
+
+class ReplyTimeoutError(Exception):
+    pass
+
+
+def _build_reply_index():
+    # type: () -> Dict[Tuple[str, ...], Tuple[int, ...]]
+    index = {}
+    for key, packet in api_replies.items():
+        if isinstance(packet, list):
+            packet = packet[0]
+        if 'submenu' in packet:
+            for subkey, subpacket in packet['submenu'].items():
+                index[(packet['id'], subpacket['id'])] = (int(key), int(subkey))
+        else:
+            index[(packet['id'],)] = (int(key),)
+    return index
+
+
+class PendingRequest(object):
+    def __init__(self, serial, key, future):
+        # type: (int, Tuple, asyncio.Future) -> None
+        self.serial = serial  # type: int
+        self.key = key  # type: Tuple
+        self.future = future  # type: asyncio.Future
+
+
+class ReplyCorrelator(object):
+    """
+    Matches replies received from the coordinator with the request waiting for them.
+
+    Replies forwarded by the coordinator do not carry a sequence number, so a reply is
+    recognized by its command (and subcommand) id, and by its source node when the reply
+    carries it. Only one request for each of these can be in flight and at most one request
+    for each node, requests that differ in both run concurrently. For replies without the
+    source a reply id is quarantined for a timeout after a request timed out: a late reply
+    arriving meanwhile is dropped, and the next request waits for the end of the quarantine.
+    """
+    _singleton = None  # type: Optional[ReplyCorrelator]
+
+    @staticmethod
+    def get():
+        # type: () -> ReplyCorrelator
+        if ReplyCorrelator._singleton is None:
+            ReplyCorrelator._singleton = ReplyCorrelator()
+        return ReplyCorrelator._singleton
+
+    def __init__(self):
+        self._reply_index = _build_reply_index()  # type: Dict[Tuple[str, ...], Tuple[int, ...]]
+        self._pending = OrderedDict()  # type: OrderedDict
+        self._node_locks = {}  # type: Dict[int, asyncio.Lock]
+        self._slot_locks = {}  # type: Dict[Tuple, asyncio.Lock]
+        self._quarantine = {}  # type: Dict[Tuple, float]
+        self._known_keys = set(self._reply_index.values())  # type: Set[Tuple[int, ...]]
+
+    def reply_key(self, cmd):
+        # type: (str) -> Tuple
+        key = self._reply_index.get(tuple(cmd.split('/')))
+        return key if key is not None else ANY_REPLY
+
+    @staticmethod
+    def frame_key(data):
+        # type: (bytes) -> Tuple
+        packet = api_replies.get(str(data[0]))
+        if isinstance(packet, dict) and 'submenu' in packet and len(data) > 1:
+            return data[0], data[1]
+        return data[0],
+
+    def _quarantined(self, key, now):
+        # type: (Tuple, float) -> float
+        """
+        Seconds left of the quarantine of the key
+        """
+        until = self._quarantine.get(key)
+        if until is None:
+            return 0.0
+        if until <= now:
+            del self._quarantine[key]
+            return 0.0
+        return until - now
+
+    @staticmethod
+    def _slot(key, serial):
+        # type: (Tuple, int) -> Tuple
+        """
+        Pending request slot of a reply: the reply id, with the node when the reply carries it
+        """
+        if key not in SOURCE_REPLIES:
+            return key
+        # The coordinator answers with its own serial
+        return key, serial if serial != 0 else GraphNetwork.instance().local_node_id
+
+    def _lock_for(self, locks, key):
+        lock = locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            locks[key] = lock
+        return lock
+
+    async def request(self, serial, cmd, send, default_timeout, path=None):
+        # type: (int, str, Callable[[], TxFrameHandler], float, Optional[List[int]]) -> bytes
+        key = self.reply_key(cmd)
+        slot = ReplyCorrelator._slot(key, serial)
+        rtt = RttTable.instance()
+        async with self._lock_for(self._node_locks, serial):
+            async with self._lock_for(self._slot_locks, slot):
+                wait = self._quarantined(key, time.monotonic())
+                if wait > 0.0:
+                    await asyncio.sleep(wait)
+                future = asyncio.get_running_loop().create_future()
+                self._pending[slot] = PendingRequest(serial, key, future)
+                slow = is_slow_command(cmd)
+                timeout = rtt.timeout(serial, path, default_timeout, slow)
+                try:
+                    # The frame may wait in the TX queue, the round trip and the deadline start when it is written
+                    try:
+                        sent_at = await send().wait_written()
+                    except asyncio.TimeoutError:
+                        logging.error(f"ReplyCorrelator.request {cmd} for node {serial:08x} not written to the serial port")
+                        raise ReplyTimeoutError('Request not sent, serial link busy')
+                    result = await asyncio.wait_for(future, timeout=timeout)
+                    if not slow:
+                        rtt.sample(serial, time.monotonic() - sent_at, path)
+                    LinkLearner.instance().path_result(path, True)
+                    return result
+                except asyncio.TimeoutError:
+                    logging.error(f"ReplyCorrelator.request timeout after {timeout:.2f}s waiting {cmd} from node {serial:08x}")
+                    rtt.timed_out(serial, path)
+                    if key not in SOURCE_REPLIES:
+                        self._quarantine[key] = time.monotonic() + timeout
+                    LinkLearner.instance().path_result(path, False)
+                    raise ReplyTimeoutError('Timeout error while waiting for reply')
+                finally:
+                    self._pending.pop(slot, None)
+
+    def frame_received(self, data):
+        # type: (bytes) -> None
+        key = ReplyCorrelator.frame_key(data)
+        now = time.monotonic()
+        pending = None
+        if data[0] == REPLY_ERROR_ID:
+            # Error replies don't tell which request failed, they are accepted only when there is no doubt
+            if len(self._pending) == 1 and not any(self._quarantined(k, now) for k in list(self._quarantine)):
+                pending = next(iter(self._pending.values()))
+        elif key in SOURCE_REPLIES:
+            offset = SOURCE_REPLIES[key]
+            if len(data) >= offset + 4:
+                pending = self._pending.get((key, int.from_bytes(data[offset:offset + 4], 'little')))
+        elif key in self._known_keys:
+            if not self._quarantined(key, now):
+                pending = self._pending.get(key)
+        elif not self._quarantined(ANY_REPLY, now):
+            pending = self._pending.get(ANY_REPLY)
+        if pending is None:
+            # Late reply of a request already timed out, never hand it to the next caller
+            logging.warning(f'ReplyCorrelator.frame_received unexpected reply {binascii.hexlify(data)}')
+            return
+
+        if not pending.future.done():
+            pending.future.set_result(data)
+
+
+def correlator_setup():
+    correlator = ReplyCorrelator.get()  # type: ReplyCorrelator
+    SerialProtocol.get().register_reply_handler(correlator.frame_received)
@@ -0,0 +1,458 @@
+import asyncio
+import heapq
+import logging
+import math
+import time
+
+from collections import deque
+from typing import Optional, Dict, List, Set, Tuple, Any
+
+from .network import GraphNetwork
+from .noderpc import rpc_node_tag, rpc_firmware_version, rpc_discovery_reset, rpc_discovery_start
+from .noderpc import rpc_discovery_count, rpc_discovery_get
+from .rtt import RttTable
+from .linkquality import LinkEstimate, LinkEstimator, LinkLearner, LINK_CONFIDENCE, LINK_SIGHTING
+
+DISCOVERY_NODE_SEEN = 'inuse'
+DISCOVERY_DISCOVERED = 'discover'
+DISCOVERY_BUGGY = 'buggy'
+DISCOVERY_COST1 = 'weight'
+DISCOVERY_COST2 = 'weight2'
+DISCOVERY_MEASURED = 'measured'
+
+DISCOVERY_POLL_INTERVAL = 0.5
+DISCOVERY_STABLE_POLLS = 2
+DISCOVERY_SLOT_TIME = 0.03
+DISCOVERY_MAX_WAIT = 5.0
+DISCOVERY_EVENTS_SIZE = 1024
+# Nodes discovered in the same round must be more than this number of hops apart
+DISCOVERY_SEPARATION_HOPS = 2
+DISCOVERY_CONCURRENCY = 1
+DISCOVERY_SCAN_FACTOR = 4
+# Incremental rediscovery: links older than this get the maximum staleness score
+DISCOVERY_STALE_AGE = 86400.0
+DISCOVERY_STALENESS_MAX = 10.0
+DISCOVERY_FAILURE_WEIGHT = 1.0
+# Airtime spent to discover a node until it is measured
+DISCOVERY_NODE_AIRTIME = 3.0
+
+
+class DiscoveryError(Exception):
+    pass
+
+
+class DiscoveryPlanner(object):
+    """
+    Frontier of the discovery: nodes already seen but not yet discovered, kept in a heap
+    ordered by the cost of the link that connects them to their parent in the route tree.
+    Keys are refreshed when links are added and checked again when popped, stale heap
+    entries are skipped.
+    """
+    def __init__(self, network):
+        # type: (GraphNetwork) -> None
+        self._network = network  # type: GraphNetwork
+        self._heap = []  # type: List[Tuple[float, int, int]]
+        self._costs = {}  # type: Dict[int, float]
+        self._counter = 0  # type: int
+
+    def __len__(self):
+        return len(self._costs)
+
+    def __contains__(self, node_id):
+        return node_id in self._costs
+
+    def _link_cost(self, node_id):
+        # type: (int) -> float
+        if node_id == self._network.local_node_id:
+            return 0.0
+        tree = self._network.route_tree()
+        parent = tree.parent(node_id) if tree is not None else None
+        if parent is None:
+            return math.inf
+        return max(self._network.edge_weights(parent, node_id))
+
+    def _push(self, node_id, cost):
+        # type: (int, float) -> None
+        self._costs[node_id] = cost
+        self._counter += 1
+        heapq.heappush(self._heap, (cost, self._counter, node_id))
+
+    def add(self, node_id):
+        # type: (int) -> None
+        if node_id not in self._costs:
+            self._push(node_id, self._link_cost(node_id))
+
+    def update(self, nodes):
+        # type: (List[int]) -> None
+        for node_id in nodes:
+            if node_id in self._costs:
+                cost = self._link_cost(node_id)
+                if cost != self._costs[node_id]:
+                    self._push(node_id, cost)
+
+    def discard(self, node_id):
+        # type: (int) -> None
+        self._costs.pop(node_id, None)
+
+    def pop(self):
+        # type: () -> Tuple[Optional[int], float]
+        while self._heap:
+            cost, _, node_id = heapq.heappop(self._heap)
+            if self._costs.get(node_id) != cost:
+                continue
+            current = self._link_cost(node_id)
+            if current > cost:
+                # Parent link got worse since the node was queued
+                self._push(node_id, current)
+                continue
+            del self._costs[node_id]
+            return node_id, current
+        return None, math.inf
+
+
+class DiscoveryEngine(object):
+    """
+    Maps the mesh from inside the hub. Nodes are visited starting from the coordinator,
+    each visited node runs a neighbour discovery and the found links are written in the
+    GraphNetwork as soon as they are known. Only one discovery job can run at time.
+
+    Node commands are sent with the helpers of noderpc.
+    """
+    _singleton = None  # type: Optional[DiscoveryEngine]
+
+    @staticmethod
+    def instance():
+        # type: () -> DiscoveryEngine
+        if DiscoveryEngine._singleton is None:
+            DiscoveryEngine._singleton = DiscoveryEngine()
+        return DiscoveryEngine._singleton
+
+    def __init__(self):
+        self._task = None  # type: Optional[asyncio.Task]
+        self._events = deque(maxlen=DISCOVERY_EVENTS_SIZE)  # type: deque
+        self._event_seq = 0  # type: int
+        self._new_event = asyncio.Event()  # type: asyncio.Event
+        self._status = 'idle'  # type: str
+        self._discovered = 0  # type: int
+        self._failed = 0  # type: int
+
+    @property
+    def running(self):
+        # type: () -> bool
+        return self._task is not None and not self._task.done()
+
+    def status(self):
+        # type: () -> Dict[str, Any]
+        return {'status': self._status, 'discovered': self._discovered, 'failed': self._failed,
+                'last_event': self._event_seq}
+
+    def _emit(self, event, **kwargs):
+        self._event_seq += 1
+        kwargs.update({'seq': self._event_seq, 'time': time.time(), 'event': event})
+        self._events.append(kwargs)
+        self._new_event.set()
+        self._new_event = asyncio.Event()
+
+    def events(self, since=0):
+        # type: (int) -> List[Dict[str, Any]]
+        return [e for e in self._events if e['seq'] > since]
+
+    async def wait_events(self, since=0, timeout=None):
+        # type: (int, Optional[float]) -> List[Dict[str, Any]]
+        """
+        Wait until events newer than since are available and return them
+        """
+        if self._event_seq <= since:
+            try:
+                await asyncio.wait_for(self._new_event.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.events(since)
+
+    def _start_job(self, job, **info):
+        # type: (Any, Any) -> bool
+        if self.running:
+            job.close()
+            return False
+        self._discovered = 0
+        self._failed = 0
+        self._task = asyncio.get_event_loop().create_task(self._run(job, info))
+        return True
+
+    def start(self, repeats=1, slots=100, mask=0, filter_=0, concurrency=DISCOVERY_CONCURRENCY):
+        # type: (int, int, int, int, int) -> bool
+        concurrency = max(1, concurrency)
+        return self._start_job(self._discover_network(repeats, slots, mask, filter_, concurrency),
+                               mode='full', repeats=repeats, slots=slots, concurrency=concurrency)
+
+    def start_incremental(self, budget, interval=0.0, slots=100):
+        # type: (float, float, int) -> bool
+        """
+        Rediscover the nodes with the most stale or failing links spending at most budget seconds
+        of airtime, then repeat every interval seconds if interval is not zero.
+        """
+        return self._start_job(self._rediscover_periodically(budget, interval, slots),
+                               mode='incremental', budget=budget, interval=interval, slots=slots)
+
+    def stop(self):
+        # type: () -> bool
+        if not self.running:
+            return False
+        self._task.cancel()
+        return True
+
+    async def _run(self, job, info):
+        self._status = 'running'
+        self._emit('started', **info)
+        try:
+            await job
+            self._status = 'completed'
+            self._emit('completed', discovered=self._discovered, failed=self._failed)
+        except asyncio.CancelledError:
+            self._status = 'cancelled'
+            self._emit('cancelled', discovered=self._discovered, failed=self._failed)
+            raise
+        except Exception as ex:
+            logging.exception('DiscoveryEngine failed')
+            self._status = 'failed'
+            self._emit('failed', error=str(ex))
+
+    def _prepare_graph(self, network, local_id):
+        # type: (GraphNetwork, int) -> None
+        if not network.has_node(local_id):
+            network.add_node(local_id, 'Main')
+        for n in network.node_ids():
+            network.set_node_attributes(n, **{DISCOVERY_DISCOVERED: False, DISCOVERY_NODE_SEEN: False,
+                                              DISCOVERY_BUGGY: False})
+        network.set_node_attributes(local_id, **{DISCOVERY_NODE_SEEN: True})
+
+    def _node_failed(self, network, node_id, error):
+        # type: (GraphNetwork, int, str) -> None
+        network.set_node_attributes(node_id, **{DISCOVERY_DISCOVERED: True, DISCOVERY_BUGGY: True})
+        self._failed += 1
+        self._emit('node_failed', node=node_id, error=error)
+
+    def _select_nodes(self, network, planner, count, busy):
+        # type: (GraphNetwork, DiscoveryPlanner, int, Set[int]) -> List[Tuple[int, float, Set[int]]]
+        """
+        Take from the frontier up to count nodes whose neighbourhoods do not overlap with the busy
+        nodes nor between them, so their discovery bursts can't hear each other. Skipped nodes go
+        back to the frontier.
+        """
+        selected, skipped = [], []
+        busy = set(busy)
+        scanned = 0
+        while len(selected) < count and scanned < count * DISCOVERY_SCAN_FACTOR:
+            node_id, cost = planner.pop()
+            if node_id is None:
+                break
+            scanned += 1
+            if math.isinf(cost):
+                # Seen by someone but no usable link to reach it
+                self._node_failed(network, node_id, 'Node not reachable')
+                continue
+            ball = network.neighbourhood(node_id, DISCOVERY_SEPARATION_HOPS)
+            if not busy.isdisjoint(ball):
+                skipped.append(node_id)
+                continue
+            selected.append((node_id, cost, ball))
+            busy.update(ball)
+        for node_id in skipped:
+            planner.add(node_id)
+        return selected
+
+    async def _discover_network(self, repeats, slots, mask, filter_, concurrency):
+        network = GraphNetwork.instance()
+        if not network.is_network_loaded():
+            network.init_empty()
+        local_id = network.local_node_id
+        if not local_id:
+            raise DiscoveryError('Local node id is unknown')
+        self._prepare_graph(network, local_id)
+        planner = DiscoveryPlanner(network)
+        planner.add(local_id)
+
+        running = {}  # type: Dict[asyncio.Task, Tuple[int, Set[int]]]
+        try:
+            while True:
+                busy = set()
+                for _, ball in running.values():
+                    busy.update(ball)
+                for node_id, cost, ball in self._select_nodes(network, planner, concurrency - len(running), busy):
+                    network.set_node_attributes(node_id, **{DISCOVERY_DISCOVERED: True})
+                    self._emit('node_selected', node=node_id, cost=cost, parallel=len(running) + 1)
+                    task = asyncio.ensure_future(self._discover_node(network, node_id, 0 if node_id == local_id
+                                                                     else node_id, repeats, slots, mask, filter_))
+                    running[task] = node_id, ball
+                if len(running) == 0:
+                    if len(planner) == 0:
+                        break
+                    continue
+
+                done, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+                # The neighbour table of a node is merged only when its discovery is over
+                for task in done:
+                    node_id, _ = running.pop(task)
+                    result = task.result()
+                    if result is None:
+                        continue
+                    tag, tnt = result
+                    links = self._merge_neighbours(network, planner, node_id, tnt)
+                    self._discovered += 1
+                    self._emit('node_discovered', node=node_id, tag=tag, links=len(links))
+        finally:
+            for task in running:
+                task.cancel()
+
+        if network.last_filename:
+            await network.save_network_async('*')
+
+    @staticmethod
+    def rank_nodes(network, now=None):
+        # type: (GraphNetwork, Optional[float]) -> List[Tuple[float, int]]
+        """
+        Reachable nodes sorted by need of rediscovery, the score grows with the age of the links
+        measured from the node and with the timeouts seen by traffic after the last measure.
+        A link is as fresh as the last discovery of any of its two ends.
+        """
+        now = time.time() if now is None else now
+        failed = RttTable.instance().failed_nodes()
+        tree = network.route_tree()
+        ranked = []
+        for node_id in network.node_ids():
+            if node_id != network.local_node_id and (tree is None or tree.parent(node_id) is None):
+                continue
+            measured = network.node_attributes(node_id).get(DISCOVERY_MEASURED, 0.0)
+            age = now - measured
+            neighbours = network.neighbours(node_id)
+            if neighbours:
+                age = max(now - max(measured, network.node_attributes(k).get(DISCOVERY_MEASURED, 0.0))
+                          for k in neighbours)
+            score = min(age / DISCOVERY_STALE_AGE, DISCOVERY_STALENESS_MAX)
+            failures, last_failure = failed.get(node_id, (0.0, 0.0))
+            if last_failure > measured:
+                score += DISCOVERY_FAILURE_WEIGHT * failures
+            ranked.append((score, node_id))
+        ranked.sort(reverse=True)
+        return ranked
+
+    async def _rediscover(self, budget, slots):
+        # type: (float, int) -> None
+        network = GraphNetwork.instance()
+        local_id = network.local_node_id
+        if not network.is_network_loaded() or not local_id:
+            raise DiscoveryError('Network graph or local node id is unknown')
+
+        spent, estimate, nodes = 0.0, DISCOVERY_NODE_AIRTIME, 0
+        for score, node_id in DiscoveryEngine.rank_nodes(network):
+            if spent + estimate > budget:
+                break
+            self._emit('node_selected', node=node_id, score=score)
+            started = time.monotonic()
+            result = await self._discover_node(network, node_id, 0 if node_id == local_id else node_id,
+                                               1, slots, 0, 0)
+            elapsed = time.monotonic() - started
+            spent += elapsed
+            estimate = elapsed if nodes == 0 else (3 * estimate + elapsed) / 4
+            nodes += 1
+            if result is None:
+                continue
+            tag, tnt = result
+            links = self._merge_neighbours(network, None, node_id, tnt)
+            self._discovered += 1
+            self._emit('node_discovered', node=node_id, tag=tag, links=len(links))
+
+        self._emit('pass_completed', nodes=nodes, airtime=spent)
+        if nodes > 0 and network.last_filename:
+            await network.save_network_async('*')
+
+    async def _rediscover_periodically(self, budget, interval, slots):
+        # type: (float, float, int) -> None
+        while True:
+            await self._rediscover(budget, slots)
+            if interval <= 0:
+                return
+            await asyncio.sleep(interval)
+
+    async def _discover_node(self, network, node_id, serial, repeats, slots, mask, filter_):
+        # type: (GraphNetwork, int, int, int, int, int, int) -> Optional[Tuple[str, Dict[int, LinkEstimate]]]
+        try:
+            tag = await rpc_node_tag(serial)
+            firmware = await rpc_firmware_version(serial)
+            network.set_node_attributes(node_id, tag=tag, firmware=firmware.decode('ascii', 'ignore')
+                                        if isinstance(firmware, bytes) else firmware)
+            tnt = await self._measure_neighbours(network, node_id, serial, repeats, slots, mask, filter_)
+            network.set_node_attributes(node_id, **{DISCOVERY_MEASURED: time.time()})
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            logging.error(f'DiscoveryEngine node 0x{node_id:06X} communication error {str(ex)}')
+            self._node_failed(network, node_id, str(ex))
+            return None
+        return tag, tnt
+
+    @staticmethod
+    async def _wait_discovery_count(serial, slots):
+        # type: (int, int) -> int
+        """
+        Wait the slot window of the discovery, then poll the table size until it does not grow anymore
+        """
+        window = slots * DISCOVERY_SLOT_TIME
+        started = time.monotonic()
+        await asyncio.sleep(window)
+        last, stable = -1, 0
+        while True:
+            size = await rpc_discovery_count(serial)
+            stable = stable + 1 if size == last else 1
+            last = size
+            if size > 0 and stable >= DISCOVERY_STABLE_POLLS:
+                return size
+            if time.monotonic() - started > window + DISCOVERY_MAX_WAIT:
+                return size
+            await asyncio.sleep(DISCOVERY_POLL_INTERVAL)
+
+    async def _measure_neighbours(self, network, node_id, serial, repeats, slots, mask, filter_):
+        # type: (GraphNetwork, int, int, int, int, int, int) -> Dict[int, LinkEstimate]
+        estimator = LinkEstimator.instance()
+        for neighbour in network.neighbours(node_id):
+            # Links known only from the graph start from their measured weight
+            estimator.seed(node_id, neighbour, *LinkLearner.base_weights(network, node_id, neighbour))
+
+        for _i in range(0, repeats):
+            await rpc_discovery_reset(serial)
+            await rpc_discovery_start(mask, filter_, slots, serial)
+            size = await self._wait_discovery_count(serial, slots)
+
+            entries = {}  # type: Dict[int, Tuple[float, float]]
+            for j in range(0, size):
+                disc_ser, disc_rssi, disc_rssi2 = await rpc_discovery_get(j, serial)
+                if not network.has_node(disc_ser):
+                    network.add_node(disc_ser)
+                    self._emit('node_found', node=disc_ser, by=node_id)
+                network.set_node_attributes(disc_ser, **{DISCOVERY_NODE_SEEN: True})
+                entries[disc_ser] = disc_rssi, disc_rssi2
+            estimator.add_round(node_id, entries)
+
+        return estimator.estimate_node(node_id)
+
+    @staticmethod
+    def _merge_neighbours(network, planner, node_id, tnt):
+        # type: (GraphNetwork, Optional[DiscoveryPlanner], int, Dict[int, LinkEstimate]) -> List[int]
+        links = []
+        for k, estimate in tnt.items():
+            if not estimate.usable:
+                network.remove_edge(node_id, k)
+                if estimate.sighting == 0.0:
+                    LinkEstimator.instance().forget(node_id, k)
+            else:
+                LinkLearner.set_measured_weights(network, node_id, k, estimate.weight, estimate.weight2)
+                network.set_edge_attributes(node_id, k, **{LINK_CONFIDENCE: estimate.confidence,
+                                                           LINK_SIGHTING: estimate.sighting})
+                links.append(k)
+        if planner is not None:
+            for k in tnt:
+                attrs = network.node_attributes(k)
+                if attrs.get(DISCOVERY_NODE_SEEN) and not attrs.get(DISCOVERY_DISCOVERED):
+                    planner.add(k)
+            planner.update(links)
+        return links
@@ -5,15 +5,153 @@ import time
 
 from xmlrpc.client import Fault
 
-from typing import Optional, List, Any
+from collections import deque
+from typing import Optional, Deque, List, Tuple, Union, Any
 
-from .connectedpath import ConnectedPathProtocol, Connection, STATUS_CONN_ACTIVE
+import networkx as nx
+
+from .connectedpath import ConnectedPathProtocol, Connection, STATUS_CONN_ACTIVE, CONNPATH_DATA_MTU, \
+    CONNPATH_INVALID_HANDLE
 from .serialprotocol import SerialProtocol
 from .network import GraphNetwork
+from .noderpc import rpc_firmware_version
+from .apicache import ApiCache
 
 server = None  # type: Optional[Any]
 clients = []  # type: List[SocketProtocol]
 
+# Small writes in both directions are gathered for this many seconds and sent together, 0 disables
+ESPHOME_COALESCE_WINDOW = 0.005
+# Data from the node gathered before the client socket is written anyway
+ESPHOME_COALESCE_RX_MAX = 16384
+
+coalesce_window = ESPHOME_COALESCE_WINDOW  # type: float
+
+# ESPHome native API message types used by the bridge
+API_HELLO_REQUEST = 1
+API_HELLO_RESPONSE = 2
+API_CONNECT_REQUEST = 3
+API_CONNECT_RESPONSE = 4
+API_PING_REQUEST = 7
+API_PING_RESPONSE = 8
+API_DEVICE_INFO_REQUEST = 9
+API_DEVICE_INFO_RESPONSE = 10
+API_LIST_ENTITIES_REQUEST = 11
+API_LIST_ENTITIES_DONE_RESPONSE = 19
+API_SUBSCRIBE_LOGS_RESPONSE = 29
+API_SUBSCRIBE_STATES_REQUEST = 20
+API_SUBSCRIBE_LOGS_REQUEST = 28
+API_SUBSCRIBE_HOMEASSISTANT_SERVICES_REQUEST = 34
+API_SUBSCRIBE_HOMEASSISTANT_STATES_REQUEST = 38
+
+# Requests that build the API session on the node, replayed when the connection is rerouted
+API_SESSION_REQUESTS = [API_HELLO_REQUEST, API_CONNECT_REQUEST, API_SUBSCRIBE_STATES_REQUEST, API_SUBSCRIBE_LOGS_REQUEST,
+                        API_SUBSCRIBE_HOMEASSISTANT_SERVICES_REQUEST, API_SUBSCRIBE_HOMEASSISTANT_STATES_REQUEST]
+# Replies to replayed requests not forwarded to the client, it already had them
+API_SESSION_REPLIES = {API_HELLO_REQUEST: API_HELLO_RESPONSE, API_CONNECT_REQUEST: API_CONNECT_RESPONSE}
+
+# Reroute attempts allowed in FAILOVER_WINDOW seconds before the client socket is closed
+FAILOVER_MAX_ATTEMPTS = 3
+FAILOVER_WINDOW = 60.0
+# Client data held while a new route is opened, above this the client socket is closed
+FAILOVER_HELD_MAX = 16384
+
+# Pings from the client are answered by the hub while the node sent something in the last PING_LOCAL_MAX_AGE seconds,
+# at most PING_LOCAL_MAX_RUN in a row so that the node is still tested on every other keepalive
+PING_LOCAL_MAX_AGE = 20.0
+PING_LOCAL_MAX_RUN = 1
+
+# Messages the node can send while it lists its entities that are not part of the list
+API_NOT_ENTITIES = (API_PING_REQUEST, API_PING_RESPONSE, API_SUBSCRIBE_LOGS_RESPONSE)
+
+
+def read_varint(buffer, pos):
+    # type: (bytearray, int) -> Tuple[Optional[int], int]
+    value = 0
+    shift = 0
+    while pos < len(buffer):
+        byte = buffer[pos]
+        value |= (byte & 0x7F) << shift
+        pos += 1
+        if byte & 0x80 == 0:
+            return value, pos
+        shift += 7
+    return None, pos
+
+
+def write_varint(value):
+    # type: (int) -> bytes
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def encode_api_message(msg_type, payload=b''):
+    # type: (int, bytes) -> bytes
+    return b'\x00' + write_varint(len(payload)) + write_varint(msg_type) + payload
+
+
+async def fetch_revision(node):
+    # type: (int) -> Optional[bytes]
+    """
+    Firmware revision of the node, the key of its cached API responses
+    """
+    revision = ApiCache.instance().revision(node)
+    if revision is not None:
+        return revision
+    try:
+        revision = await rpc_firmware_version(node)
+    except Exception as ex:
+        logging.warning(f'fetch_revision {node:06X} {str(ex)}')
+        return None
+    ApiCache.instance().entry(node, revision)
+    return revision
+
+
+class ApiFrameReader(object):
+    """
+    Split an ESPHome plaintext API stream in messages, partial messages are kept until completed.
+    Parsing stops at the first byte that is not a plaintext preamble, the stream is then marked invalid.
+    """
+    def __init__(self):
+        self._buffer = bytearray()
+        self._invalid = False
+
+    @property
+    def invalid(self):
+        # type: () -> bool
+        return self._invalid
+
+    def feed(self, data):
+        # type: (bytes) -> List[Tuple[int, bytes, bytes]]
+        """
+        Returns the complete messages as (type, payload, frame) tuples
+        """
+        self._buffer += data
+        messages = []
+        while self._buffer and not self._invalid:
+            if self._buffer[0] != 0:
+                self._invalid = True
+                break
+            length, pos = read_varint(self._buffer, 1)
+            if length is None:
+                break
+            msg_type, pos = read_varint(self._buffer, pos)
+            if msg_type is None or len(self._buffer) < pos + length:
+                break
+            messages.append((msg_type, bytes(self._buffer[pos:pos + length]), bytes(self._buffer[:pos + length])))
+            del self._buffer[:pos + length]
+        return messages
+
+    def take_pending(self):
+        # type: () -> bytes
+        pending = bytes(self._buffer)
+        self._buffer.clear()
+        return pending
+
 
 class SocketProtocol(asyncio.Protocol):
     def __init__(self):
@@ -28,6 +166,30 @@ class SocketProtocol(asyncio.Protocol):
         self._connection = None  # type: Optional[Connection]
         self._timeout = 0
         self._timeout_task = None  # type: Optional[asyncio.Task]
+        # Failover state, only for plaintext API sessions
+        self._plaintext = None  # type: Optional[bool]
+        self._client_reader = ApiFrameReader()  # type: ApiFrameReader
+        self._session = []  # type: List[Tuple[int, bytes]]
+        self._last_remote_data = 0.0  # type: float
+        self._local_pings = 0  # type: int
+        self._rerouting = False  # type: bool
+        self._held = []  # type: List[bytes]
+        self._held_size = 0  # type: int
+        self._failovers = deque()  # type: Deque[float]
+        self._swallow = []  # type: List[int]
+        self._remote_reader = None  # type: Optional[ApiFrameReader]
+        # Cache of the responses that depend only on the firmware
+        self._revision = None  # type: Optional[bytes]
+        self._revision_task = None  # type: Optional[asyncio.Task]
+        self._revision_wait = None  # type: Optional[List[Tuple[int, bytes, bytes]]]
+        self._expect_device_info = False  # type: bool
+        self._entities = None  # type: Optional[List[bytes]]
+        # Write coalescing, client to node and node to client
+        self._tx_pending = bytearray()  # type: bytearray
+        self._tx_flush = None  # type: Optional[asyncio.TimerHandle]
+        self._rx_pending = []  # type: List[bytes]
+        self._rx_pending_size = 0  # type: int
+        self._rx_flush = None  # type: Optional[asyncio.TimerHandle]
 
     @property
     def serial(self):
@@ -66,12 +228,37 @@ class SocketProtocol(asyncio.Protocol):
         logging.warning(f'SocketProtocol.connection_lost handshake {self._handshake}')
         if self._timeout_task and not self._timeout_task.done():
             self._timeout_task.cancel()
+        if self._revision_task and not self._revision_task.done():
+            self._revision_task.cancel()
+        for handle in (self._tx_flush, self._rx_flush):
+            if handle is not None:
+                handle.cancel()
         if self._handshake:
+            self._unwatch_tx()
             self._connection.disconnect_from_client()
         clients.remove(self)
 
+    def _pause_reading(self):
+        if not self._transport.is_closing():
+            self._transport.pause_reading()
+
+    def _resume_reading(self):
+        if not self._transport.is_closing():
+            self._transport.resume_reading()
+
+    def _watch_tx(self):
+        # Stop reading from the client while too much of its data waits for the serial link
+        self._serial.watch_tx_source(self._connection.tx_source, self._pause_reading, self._resume_reading)
+
+    def _unwatch_tx(self):
+        self._serial.unwatch_tx_source(self._connection.tx_source)
+
     def init_done_remote(self):
-        if self._connection.status == STATUS_CONN_ACTIVE:
+        if self._rerouting:
+            self._watch_tx()
+            self._reroute_done()
+        elif self._connection.status == STATUS_CONN_ACTIVE:
+            self._watch_tx()
             self._handshake = True
             self._transport.write(b'!!OK!')
             logging.warning(f'SocketProtocol.make_connection_done {self._address:06X}:{self._connection.handle:04x}')
@@ -79,11 +266,273 @@ class SocketProtocol(asyncio.Protocol):
             self.close_transport()
 
     def data_received_remote(self, data):
-        self._transport.write(data)
+        self._last_remote_data = time.monotonic()
+        if self._remote_reader is not None:
+            data = self._node_messages(data)
+        if data:
+            self._write_client(data)
+
+    def _write_client(self, data):
+        # type: (bytes) -> None
+        if coalesce_window <= 0:
+            self._transport.write(data)
+            return
+        self._rx_pending.append(data)
+        self._rx_pending_size += len(data)
+        if self._rx_pending_size >= ESPHOME_COALESCE_RX_MAX:
+            self._flush_rx()
+        elif self._rx_flush is None:
+            self._rx_flush = asyncio.get_running_loop().call_later(coalesce_window, self._flush_rx)
+
+    def _flush_rx(self):
+        if self._rx_flush is not None:
+            self._rx_flush.cancel()
+            self._rx_flush = None
+        if self._rx_pending and not self._transport.is_closing():
+            self._transport.writelines(self._rx_pending)
+        self._rx_pending = []
+        self._rx_pending_size = 0
+
+    def _send_remote(self, data):
+        # type: (bytes) -> None
+        """
+        Gather the client data for the coalescing window, full MTU frames are sent at once
+        """
+        if coalesce_window <= 0:
+            ConnectedPathProtocol.get().send_data_async(data, self._connection.handle)
+            return
+        self._tx_pending += data
+        if len(self._tx_pending) >= CONNPATH_DATA_MTU:
+            self._flush_tx()
+        elif self._tx_flush is None:
+            self._tx_flush = asyncio.get_running_loop().call_later(coalesce_window, self._flush_tx)
+
+    def _flush_tx(self):
+        if self._tx_flush is not None:
+            self._tx_flush.cancel()
+            self._tx_flush = None
+        if not self._tx_pending:
+            return
+        if self._rerouting:
+            self._hold(bytes(self._tx_pending))
+        else:
+            self._send_frames(self._tx_pending)
+        self._tx_pending.clear()
+
+    def _send_frames(self, data):
+        # type: (Union[bytes, bytearray]) -> None
+        cp = ConnectedPathProtocol.get()  # type: ConnectedPathProtocol
+        for pos in range(0, len(data), CONNPATH_DATA_MTU):
+            cp.send_data_async(bytes(data[pos:pos + CONNPATH_DATA_MTU]), self._connection.handle)
 
     def disconnect_remote(self):
         logging.debug(f"SocketProtocol.disconnect_remote {self._connection.target:06X}:{self._connection.handle:04X}")
-        self._transport.close()
+        if self._connection.error == CONNPATH_INVALID_HANDLE:
+            # The node forgot the connection, it probably rebooted
+            ApiCache.instance().invalidate(self._connection.target, 'invalid handle')
+        if not self._start_reroute():
+            self._unwatch_tx()
+            self._transport.close()
+
+    def _client_messages(self, data):
+        # type: (bytes) -> bytes
+        """
+        Data of the client to forward to the node. Plaintext sessions are forwarded by whole messages:
+        pings are answered here when possible, session requests are remembered to resume the session
+        on a new route.
+        """
+        if self._plaintext is None:
+            self._plaintext = data[0] == 0
+            if self._plaintext:
+                self._remote_reader = ApiFrameReader()
+                # Only plaintext sessions use the cache
+                self._revision = ApiCache.instance().revision(self._address)
+                if self._revision is None:
+                    self._revision_task = asyncio.get_running_loop().create_task(self._fetch_revision())
+        if not self._plaintext:
+            return data
+        messages = self._client_reader.feed(data)
+        if self._revision_wait is not None:
+            self._revision_wait += messages
+            messages = []
+        out = self._filter_client_messages(messages)
+        if self._client_reader.invalid:
+            logging.warning(f'SocketProtocol.client_messages not a plaintext API stream, failover disabled')
+            self._plaintext = False
+            out += self._client_reader.take_pending()
+        return bytes(out)
+
+    def _filter_client_messages(self, messages):
+        # type: (List[Tuple[int, bytes, bytes]]) -> bytearray
+        now = time.monotonic()
+        out = bytearray()
+        for i, (msg_type, _, frame) in enumerate(messages):
+            if msg_type == API_PING_REQUEST and self._answer_ping(now):
+                continue
+            if msg_type in (API_DEVICE_INFO_REQUEST, API_LIST_ENTITIES_REQUEST):
+                if self._revision_task is not None and not self._revision_task.done():
+                    # The cache key is not known yet, hold the client messages until it is
+                    self._revision_wait = messages[i:]
+                    self._revision_task.add_done_callback(self._revision_ready)
+                    break
+                if self._answer_cached(msg_type):
+                    continue
+            if msg_type in API_SESSION_REQUESTS:
+                if (msg_type, frame) not in self._session:
+                    self._session.append((msg_type, frame))
+            out += frame
+        return out
+
+    def _revision_ready(self, _task):
+        messages, self._revision_wait = self._revision_wait, None
+        if self._transport.is_closing():
+            return
+        self._forward_client(bytes(self._filter_client_messages(messages)))
+
+    def _answer_cached(self, msg_type):
+        # type: (int) -> bool
+        """
+        Serve device info and entity list from the cache, when not cached the response of the node is recorded
+        """
+        entry = ApiCache.instance().lookup(self._connection.target, self._revision)
+        if msg_type == API_DEVICE_INFO_REQUEST:
+            if entry is not None and entry.device_info is not None:
+                self._write_client(entry.device_info)
+                return True
+            self._expect_device_info = True
+        else:
+            if entry is not None and entry.entities is not None:
+                self._write_client(b''.join(entry.entities))
+                return True
+            self._entities = []
+        return False
+
+    def _record_response(self, msg_type, frame):
+        # type: (int, bytes) -> None
+        if self._expect_device_info and msg_type == API_DEVICE_INFO_RESPONSE:
+            self._expect_device_info = False
+            if self._revision is not None:
+                ApiCache.instance().entry(self._connection.target, self._revision).device_info = frame
+        elif self._entities is not None and msg_type not in API_NOT_ENTITIES:
+            self._entities.append(frame)
+            if msg_type == API_LIST_ENTITIES_DONE_RESPONSE:
+                if self._revision is not None:
+                    ApiCache.instance().entry(self._connection.target, self._revision).entities = self._entities
+                    logging.info(f'SocketProtocol.record_response {self._connection.target:06X} '
+                                 f'{len(self._entities)} entities cached')
+                self._entities = None
+
+    async def _fetch_revision(self):
+        self._revision = await fetch_revision(self._address)
+
+    def _answer_ping(self, now):
+        # type: (float) -> bool
+        """
+        Answer a ping of the client without crossing the mesh, only while the route is up and the node is
+        known alive from its recent traffic. Otherwise the ping goes to the node and tests it for real.
+        """
+        if self._rerouting or self._connection.status != STATUS_CONN_ACTIVE:
+            return False
+        if now - self._last_remote_data > PING_LOCAL_MAX_AGE or self._local_pings >= PING_LOCAL_MAX_RUN:
+            self._local_pings = 0
+            return False
+        self._local_pings += 1
+        # After the node data already waiting for the client
+        self._write_client(encode_api_message(API_PING_RESPONSE))
+        return True
+
+    def _start_reroute(self):
+        # type: () -> bool
+        if not self._handshake or not self._plaintext or self._transport.is_closing():
+            return False
+        if not GraphNetwork.instance().is_network_loaded():
+            return False
+        now = time.monotonic()
+        while self._failovers and now - self._failovers[0] > FAILOVER_WINDOW:
+            self._failovers.popleft()
+        if len(self._failovers) >= FAILOVER_MAX_ATTEMPTS:
+            logging.warning(f'SocketProtocol.reroute {self._address:06X} too many failures')
+            return False
+
+        failed = self._connection
+        self._serial.unwatch_tx_source(failed.tx_source)
+        # No backpressure from the serial link without a route, stop reading the client until the new one is up
+        self._pause_reading()
+        try:
+            # Prefer a route that shares no repeater with the failed one
+            path = GraphNetwork.instance().shortest_path_avoiding(failed.target, set(failed.path[:-1]))
+        except (nx.NetworkXNoPath, nx.NodeNotFound):
+            try:
+                path = GraphNetwork.instance().shortest_path(failed.target)
+            except (nx.NetworkXNoPath, nx.NodeNotFound):
+                return False
+
+        self._failovers.append(now)
+        # Only data that never left the hub is sent again: the node may have executed anything already
+        # written, and commands like button presses or service calls must not run twice
+        unsent = ConnectedPathProtocol.take_unsent_data(failed.handle)
+        if not self._rerouting:
+            self._held = [unsent] if unsent else []
+            self._held_size = len(unsent)
+            self._rerouting = True
+            # Data still in the coalescing buffer was never sent, it goes after the unsent one
+            self._flush_tx()
+        logging.warning(f'SocketProtocol.reroute {failed.target:06X}:{failed.handle:04X} '
+                        f'{failed.path} -> {path} resend {len(self._held)}')
+        cp = ConnectedPathProtocol.get()  # type: ConnectedPathProtocol
+        self._connection = cp.make_connection_async(path, failed.port, self.init_done_remote, self.data_received_remote,
+                                                    self.disconnect_remote)  # type: Connection
+        return True
+
+    def _reroute_done(self):
+        # Replay the session, swallow the replies the client already received, then resend the pending data
+        self._swallow = []
+        replay = bytearray()
+        for msg_type, frame in self._session:
+            if msg_type in API_SESSION_REPLIES:
+                self._swallow.append(API_SESSION_REPLIES[msg_type])
+            replay += frame
+        # The new connection is a new stream from the node
+        self._remote_reader = ApiFrameReader()
+        self._expect_device_info = False
+        self._entities = None
+        for frame in self._held:
+            replay += frame
+        self._held = []
+        self._held_size = 0
+        self._rerouting = False
+        logging.warning(f'SocketProtocol.reroute_done {self._address:06X}:{self._connection.handle:04X}')
+        self._resume_reading()
+        if replay:
+            self._send_frames(replay)
+
+    def _hold(self, data):
+        # type: (bytes) -> None
+        self._held.append(data)
+        self._held_size += len(data)
+        if self._held_size > FAILOVER_HELD_MAX:
+            logging.warning(f'SocketProtocol.hold {self._address:06X} {self._held_size} bytes held while rerouting')
+            self._transport.close()
+
+    def _node_messages(self, data):
+        # type: (bytes) -> bytes
+        """
+        Data of the node to forward to the client: replies to replayed requests are dropped and
+        the responses to cache are recorded
+        """
+        messages = self._remote_reader.feed(data)
+        out = bytearray()
+        for msg_type, _, frame in messages:
+            if self._swallow and msg_type == self._swallow[0]:
+                self._swallow.pop(0)
+                continue
+            self._record_response(msg_type, frame)
+            out += frame
+        if self._remote_reader.invalid:
+            self._swallow = []
+            out += self._remote_reader.take_pending()
+            self._remote_reader = None
+        return bytes(out)
 
     def data_received(self, data: bytes):
         global clients
@@ -110,7 +559,16 @@ class SocketProtocol(asyncio.Protocol):
         else:
             # cmd = data[0]
             self._timeout = time.time()
-            ConnectedPathProtocol.get().send_data_async(data, self._connection.handle)
+            self._forward_client(self._client_messages(data))
+
+    def _forward_client(self, data):
+        # type: (bytes) -> None
+        if not data:
+            return
+        if self._rerouting:
+            self._hold(data)
+        else:
+            self._send_remote(data)
 
     def eof_received(self):
         return False
@@ -129,8 +587,9 @@ class SocketProtocol(asyncio.Protocol):
                                                         self.disconnect_remote)  # type: Connection
 
 
-def esphomeapi_setup(loop: asyncio.AbstractEventLoop, port: int):
-    global server
+def esphomeapi_setup(loop: asyncio.AbstractEventLoop, port: int, window: float = ESPHOME_COALESCE_WINDOW):
+    global server, coalesce_window
+    coalesce_window = window
     coro = loop.create_server(SocketProtocol, host='0.0.0.0', port=port)
     server = loop.run_until_complete(coro)
 
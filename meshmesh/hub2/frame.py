@@ -1,3 +1,4 @@
+import re
 import struct
 from enum import Enum
 
@@ -42,6 +43,8 @@ class APIFrame:
     ESCAPE_BYTE = b'\xEA'
     END_BYTE = b'\xEF'
     ESCAPE_BYTES = (START_BYTE, ESCAPE_BYTE, END_BYTE)
+    ESCAPE_PATTERN = re.compile(b'([' + re.escape(START_BYTE + ESCAPE_BYTE + END_BYTE) + b'])')
+    ESCAPE_REPLACE = ESCAPE_BYTE + b'\\1'
 
     def __init__(self, data=b'', escaped=False):
         self.data = data
@@ -118,17 +121,52 @@ class APIFrame:
         # Never escape start byte
         return APIFrame.START_BYTE + data + APIFrame.END_BYTE
 
+    def output_into(self, buffer):
+        """
+        output_into: bytearray -> int
+
+        output_into appends the start byte, the (escaped) payload and the
+        end byte to a caller supplied buffer and returns the number of
+        bytes written.
+        """
+        data = self.data
+        if self.escaped and len(self.raw_data) < 1:
+            self.raw_data = APIFrame.escape(data)
+
+        if self.escaped:
+            data = self.raw_data
+
+        buffer += APIFrame.START_BYTE
+        buffer += data
+        buffer += APIFrame.END_BYTE
+        return len(data) + 2
+
+    @staticmethod
+    def output_frames(frames, buffer=None):
+        """
+        output_frames: [APIFrame, ...] -> bytearray
+
+        output_frames encodes several frames back to back so that they can
+        be sent with a single write. If buffer is given it is cleared and
+        reused.
+        """
+        if buffer is None:
+            buffer = bytearray()
+        else:
+            buffer.clear()
+        for frame in frames:
+            frame.output_into(buffer)
+        return buffer
+
     @staticmethod
     def escape(data):
-        escaped_data = b""
-        for byte in data:
-            if intToByte(byteToInt(byte)) in APIFrame.ESCAPE_BYTES:
-                escaped_data += APIFrame.ESCAPE_BYTE
-                escaped_data += intToByte(byteToInt(byte))
-            else:
-                escaped_data += intToByte(byteToInt(byte))
+        """
+        escape: bytes -> bytes
 
-        return escaped_data
+        escape puts the escape byte in front of every start, escape and
+        end byte found in data. The whole buffer is scanned once.
+        """
+        return APIFrame.ESCAPE_PATTERN.sub(APIFrame.ESCAPE_REPLACE, data)
 
     def fill(self, byte):
         escaped = False
@@ -164,6 +202,123 @@ class APIFrame:
         self.data = self.raw_data[1:-1]
 
 
+class APIFrameDecoder:
+    """
+    Streaming decoder that splits the serial byte stream into API frames
+
+    Data is consumed a whole chunk at a time: frame delimiters are located with
+    bytes.find and every complete frame is unescaped in a single pass. Bytes
+    received outside of a frame are collected as text and handed to the
+    text callback one line at a time.
+    """
+
+    START = APIFrame.START_BYTE[0]
+    ESCAPE = APIFrame.ESCAPE_BYTE[0]
+    END = APIFrame.END_BYTE[0]
+
+    def __init__(self, escaped=True, text_callback=None):
+        self._escaped = escaped
+        self._text_callback = text_callback
+        self._in_frame = False
+        self._buffer = bytearray()
+        self._text = bytearray()
+
+    def clear(self):
+        self._in_frame = False
+        self._buffer.clear()
+        self._text.clear()
+
+    def feed(self, data):
+        """
+        feed: bytes -> [bytes, ...]
+
+        feed appends a chunk of received bytes to the decoder state and
+        returns the unescaped payload of every frame completed by it.
+        """
+        frames = []
+        view = memoryview(data)
+        pos = 0
+        size = len(data)
+        while pos < size:
+            if not self._in_frame:
+                start = data.find(APIFrame.START_BYTE, pos)
+                if start < 0:
+                    self._text_received(view[pos:])
+                    break
+                if start > pos:
+                    self._text_received(view[pos:start])
+                self._in_frame = True
+                pos = start + 1
+            else:
+                end = self._find_end(data, pos)
+                if end < 0:
+                    self._buffer += view[pos:]
+                    break
+                self._buffer += view[pos:end]
+                payload = self.unescape(self._buffer) if self._escaped else bytes(self._buffer)
+                if len(payload) > 0:
+                    frames.append(payload)
+                self._in_frame = False
+                self._buffer.clear()
+                pos = end + 1
+        return frames
+
+    def _find_end(self, data, pos):
+        end = data.find(APIFrame.END_BYTE, pos)
+        while end >= 0 and self._escaped and self._is_escaped(data, pos, end):
+            end = data.find(APIFrame.END_BYTE, end + 1)
+        return end
+
+    def _is_escaped(self, data, pos, index):
+        # A delimiter is escaped when preceded by an odd run of escape bytes
+        count = 0
+        i = index - 1
+        while i >= pos and data[i] == APIFrameDecoder.ESCAPE:
+            count += 1
+            i -= 1
+        if i < pos:
+            j = len(self._buffer) - 1
+            while j >= 0 and self._buffer[j] == APIFrameDecoder.ESCAPE:
+                count += 1
+                j -= 1
+        return count % 2 == 1
+
+    @staticmethod
+    def unescape(raw):
+        """
+        unescape: escaped bytes -> bytes
+
+        unescape removes the escape byte in front of every escaped byte.
+        """
+        index = raw.find(APIFrame.ESCAPE_BYTE)
+        if index < 0:
+            return bytes(raw)
+        data = bytearray()
+        pos = 0
+        size = len(raw)
+        while index >= 0:
+            data += raw[pos:index]
+            if index + 1 < size:
+                data.append(raw[index + 1])
+            pos = index + 2
+            index = raw.find(APIFrame.ESCAPE_BYTE, pos)
+        data += raw[pos:]
+        return bytes(data)
+
+    def _text_received(self, chunk):
+        if self._text_callback is None:
+            return
+        self._text += chunk
+        last = max(self._text.rfind(b'\n'), self._text.rfind(b'\r'))
+        if last < 0:
+            return
+        lines = self._text[:last].replace(b'\r', b'\n').split(b'\n')
+        del self._text[:last + 1]
+        for line in lines:
+            if len(line) > 0:
+                self._text_callback(line.decode('utf-8', 'ignore'))
+
+
 class APIFrameEcho(APIFrame):
     def __init__(self, data, escaped=False):
         super().__init__(CMD_UART_ECHO_REQ + data, escaped=escaped)
@@ -0,0 +1,296 @@
+import asyncio
+import logging
+import time
+import warnings
+
+from typing import Optional, Dict, List, Tuple, Union
+
+import numpy as np
+
+from .network import GraphNetwork, EDGE_PENALTY
+
+LINK_RSSI_MAX = 45.0
+LINK_WEIGHT_MIN = 0.05
+# Discovery rounds remembered for every link, older ones are overwritten
+LINK_HISTORY = 32
+# Samples farther than this number of (scaled) MADs from the median are outliers
+LINK_OUTLIER_MADS = 2.5
+# Weight factor of every remembered round where the link was not seen, a link above 1.0 is dropped
+LINK_MISS_FACTOR = 1.1
+# RSSI standard deviation that halves the confidence
+LINK_STD_REF = 6.0
+
+# Traffic learning: EWMA gain of a success, a failure gain is shared between the edges of the path
+LEARN_ALPHA = 0.25
+# Penalty of an edge that never succeeds is 1 + LEARN_PENALTY
+LEARN_PENALTY = 3.0
+LEARN_HYSTERESIS = 0.15
+LEARN_RECOVERY_INTERVAL = 30.0
+LEARN_HALF_LIFE = 600.0
+LEARN_RELAX_INTERVAL = 30.0
+LEARN_FORGET = 0.02
+
+LINK_CONFIDENCE = 'confidence'
+LINK_SIGHTING = 'sighting'
+LINK_PENALTY = EDGE_PENALTY
+
+
+def rssi_to_weight(rssi):
+    # type: (Union[int, float, np.ndarray]) -> Union[float, np.ndarray]
+    """
+    Convert the RSSI reported by discovery (0 worst, 45 and above best) to a link weight in [0.05, 1.0].
+    A negative RSSI -n is taken as 2n.
+    """
+    rssi = np.where(np.asarray(rssi) <= -1, -2 * np.asarray(rssi), rssi)
+    weight = 1.0 - np.clip(rssi, 0.0, LINK_RSSI_MAX) / LINK_RSSI_MAX
+    weight = np.maximum(weight, LINK_WEIGHT_MIN)
+    return float(weight) if np.ndim(weight) == 0 else weight
+
+
+def weight_to_rssi(weight):
+    # type: (float) -> float
+    return (1.0 - weight) * LINK_RSSI_MAX
+
+
+class LinkEstimate(object):
+    def __init__(self, weight, weight2, confidence, sighting):
+        # type: (float, float, float, float) -> None
+        self.weight = weight  # type: float
+        self.weight2 = weight2  # type: float
+        self.confidence = confidence  # type: float
+        self.sighting = sighting  # type: float
+
+    @property
+    def usable(self):
+        # type: () -> bool
+        return self.weight <= 1.0 and self.weight2 <= 1.0
+
+
+class _LinkHistory(object):
+    """
+    Ring of the last discovery rounds of a link as seen by one node, NaN marks a round where
+    the neighbour was not seen.
+    """
+    def __init__(self):
+        self.rssi = np.full((2, LINK_HISTORY), np.nan, dtype=np.float32)  # type: np.ndarray
+        self.rounds = 0  # type: int
+
+    def add(self, rssi1, rssi2):
+        # type: (float, float) -> None
+        pos = self.rounds % LINK_HISTORY
+        self.rssi[0, pos] = rssi1
+        self.rssi[1, pos] = rssi2
+        self.rounds += 1
+
+
+class LinkEstimator(object):
+    """
+    Link quality from repeated discovery rounds. Every node keeps the RSSI history of the
+    links it measured, the estimate of all links of a node is computed at once with:
+    outlier rejection around the median, mean RSSI converted to weight, a penalty for the
+    rounds where the neighbour was not seen and a confidence from sample count and variance.
+    """
+    _singleton = None  # type: Optional[LinkEstimator]
+
+    @staticmethod
+    def instance():
+        # type: () -> LinkEstimator
+        if LinkEstimator._singleton is None:
+            LinkEstimator._singleton = LinkEstimator()
+        return LinkEstimator._singleton
+
+    def __init__(self):
+        self._links = {}  # type: Dict[int, Dict[int, _LinkHistory]]
+
+    def _history(self, node_id, neighbour):
+        # type: (int, int) -> _LinkHistory
+        links = self._links.setdefault(node_id, {})
+        history = links.get(neighbour)
+        if history is None:
+            history = _LinkHistory()
+            links[neighbour] = history
+        return history
+
+    def has_history(self, node_id, neighbour):
+        # type: (int, int) -> bool
+        return neighbour in self._links.get(node_id, {})
+
+    def seed(self, node_id, neighbour, weight, weight2):
+        # type: (int, int, float, float) -> None
+        """
+        Use a weight already known, for example from the graph, as first sample of a link
+        """
+        if not self.has_history(node_id, neighbour):
+            self._history(node_id, neighbour).add(weight_to_rssi(weight), weight_to_rssi(weight2))
+
+    def add_round(self, node_id, entries):
+        # type: (int, Dict[int, Tuple[float, float]]) -> None
+        """
+        Record a discovery round of node_id, entries maps the neighbours seen to their (rssi1, rssi2).
+        Every other link known for node_id gets a missed round.
+        """
+        for neighbour, (rssi1, rssi2) in entries.items():
+            self._history(node_id, neighbour).add(rssi1, rssi2)
+        for neighbour, history in self._links.get(node_id, {}).items():
+            if neighbour not in entries:
+                history.add(np.nan, np.nan)
+
+    def forget(self, node_id, neighbour):
+        # type: (int, int) -> None
+        self._links.get(node_id, {}).pop(neighbour, None)
+
+    def estimate_node(self, node_id):
+        # type: (int) -> Dict[int, LinkEstimate]
+        links = self._links.get(node_id)
+        if not links:
+            return {}
+        neighbours = list(links.keys())  # type: List[int]
+        # links x (rssi1, rssi2) x rounds
+        rssi = np.stack([links[n].rssi for n in neighbours]).astype(np.float64)
+        rounds = np.minimum(np.array([links[n].rounds for n in neighbours], dtype=np.float64), LINK_HISTORY)
+
+        with warnings.catch_warnings():
+            # Links never seen are all NaN, they come out as NaN and are handled below
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median = np.nanmedian(rssi, axis=2, keepdims=True)
+            mad = np.nanmedian(np.abs(rssi - median), axis=2, keepdims=True) * 1.4826
+            outlier = np.abs(rssi - median) > LINK_OUTLIER_MADS * np.where(mad > 0, mad, np.inf)
+            kept = np.where(outlier, np.nan, rssi)
+            mean = np.nanmean(kept, axis=2)
+            std = np.nanstd(kept, axis=2)
+
+        seen = np.count_nonzero(~np.isnan(rssi[:, 0, :]), axis=1).astype(np.float64)
+        sighting = seen / np.maximum(rounds, 1.0)
+        weights = rssi_to_weight(np.nan_to_num(mean, nan=0.0)) * np.power(LINK_MISS_FACTOR, rounds - seen)[:, None]
+        spread = np.nan_to_num(np.max(std, axis=1), nan=0.0)
+        confidence = sighting * seen / (seen + 2.0) / (1.0 + spread / LINK_STD_REF)
+
+        return {n: LinkEstimate(float(weights[i, 0]), float(weights[i, 1]), float(confidence[i]), float(sighting[i]))
+                for i, n in enumerate(neighbours)}
+
+
+class LinkLearner(object):
+    """
+    Passive link quality from live traffic. Every reply, ACK or timeout is attributed to the
+    edges of the path used: a success to all of them, a failure shared between them. Each
+    edge keeps an EWMA of its success ratio that relaxes back to good when the edge is idle.
+
+    The routing weight of an edge is its measured weight times a penalty derived from the
+    EWMA, the penalty is stored in the edge so the measured weight can always be recovered.
+    Penalties are not saved with the graph, after a restart they are learned again.
+    To avoid route flapping a new penalty is applied only when it differs enough from the
+    current one, and a lower penalty no sooner than LEARN_RECOVERY_INTERVAL after the last
+    change.
+    """
+    _singleton = None  # type: Optional[LinkLearner]
+
+    @staticmethod
+    def instance():
+        # type: () -> LinkLearner
+        if LinkLearner._singleton is None:
+            LinkLearner._singleton = LinkLearner()
+        return LinkLearner._singleton
+
+    def __init__(self):
+        self._success = {}  # type: Dict[Tuple[int, int], Tuple[float, float]]
+        self._changed_at = {}  # type: Dict[Tuple[int, int], float]
+
+    @staticmethod
+    def _key(_from, _to):
+        # type: (int, int) -> Tuple[int, int]
+        return (_from, _to) if _from < _to else (_to, _from)
+
+    @staticmethod
+    def penalty(network, _from, _to):
+        # type: (GraphNetwork, int, int) -> float
+        return network.edge_attributes(_from, _to).get(LINK_PENALTY, 1.0)
+
+    @staticmethod
+    def base_weights(network, _from, _to):
+        # type: (GraphNetwork, int, int) -> Tuple[float, float]
+        """
+        Measured weights of an edge, without the penalty learned from traffic
+        """
+        penalty = LinkLearner.penalty(network, _from, _to)
+        weight, weight2 = network.edge_weights(_from, _to)
+        return weight / penalty, weight2 / penalty
+
+    @staticmethod
+    def set_measured_weights(network, _from, _to, weight, weight2):
+        # type: (GraphNetwork, int, int, float, float) -> None
+        """
+        Store new measured weights of an edge keeping the penalty learned from traffic
+        """
+        penalty = LinkLearner.penalty(network, _from, _to) if network.has_edge(_from, _to) else 1.0
+        network.set_edge_weight(_from, _to, weight * penalty, weight2 * penalty)
+
+    def success_ratio(self, _from, _to, now=None):
+        # type: (int, int, Optional[float]) -> float
+        value, updated = self._success.get(LinkLearner._key(_from, _to), (1.0, 0.0))
+        now = time.monotonic() if now is None else now
+        return 1.0 - (1.0 - value) * 0.5 ** ((now - updated) / LEARN_HALF_LIFE)
+
+    def path_result(self, path, success):
+        # type: (Optional[List[int]], bool) -> None
+        """
+        Account a request sent along path (hops after the coordinator, target included)
+        """
+        network = GraphNetwork.instance()
+        if not path or not network.is_network_loaded() or not network.local_node_id:
+            return
+        hops = [network.local_node_id] + list(path)
+        edges = [(u, v) for u, v in zip(hops, hops[1:]) if network.has_edge(u, v)]
+        if not edges:
+            return
+        now = time.monotonic()
+        alpha = LEARN_ALPHA if success else LEARN_ALPHA / len(edges)
+        for u, v in edges:
+            value = self.success_ratio(u, v, now)
+            value += alpha * ((1.0 if success else 0.0) - value)
+            self._success[LinkLearner._key(u, v)] = value, now
+            self._update_penalty(network, u, v, value, now)
+
+    def relax(self):
+        # type: () -> None
+        """
+        Let the penalty of edges without traffic decay
+        """
+        network = GraphNetwork.instance()
+        now = time.monotonic()
+        for key in list(self._success.keys()):
+            if not network.has_edge(*key):
+                del self._success[key]
+                continue
+            value = self.success_ratio(key[0], key[1], now)
+            self._update_penalty(network, key[0], key[1], value, now)
+            if value > 1.0 - LEARN_FORGET and LinkLearner.penalty(network, *key) == 1.0:
+                del self._success[key]
+
+    def _update_penalty(self, network, _from, _to, value, now):
+        # type: (GraphNetwork, int, int, float, float) -> None
+        current = LinkLearner.penalty(network, _from, _to)
+        penalty = 1.0 + LEARN_PENALTY * (1.0 - value)
+        if penalty - 1.0 < LEARN_FORGET:
+            penalty = 1.0
+        # Small changes are ignored, except the final step back to the measured weight
+        if penalty == current or (penalty != 1.0 and abs(penalty - current) < LEARN_HYSTERESIS * current):
+            return
+        key = LinkLearner._key(_from, _to)
+        if penalty < current and now - self._changed_at.get(key, 0.0) < LEARN_RECOVERY_INTERVAL:
+            return
+        weight, weight2 = LinkLearner.base_weights(network, _from, _to)
+        network.set_edge_weight(_from, _to, weight * penalty, weight2 * penalty)
+        network.set_edge_attributes(_from, _to, **{LINK_PENALTY: penalty})
+        self._changed_at[key] = now
+        logging.info(f'LinkLearner edge 0x{_from:06X}-0x{_to:06X} success {value:.2f} penalty {current:.2f} -> {penalty:.2f}')
+
+    async def relax_periodically(self):
+        # type: () -> None
+        while True:
+            await asyncio.sleep(LEARN_RELAX_INTERVAL)
+            self.relax()
+
+
+def linklearner_setup(loop):
+    # type: (asyncio.AbstractEventLoop) -> None
+    loop.create_task(LinkLearner.instance().relax_periodically())
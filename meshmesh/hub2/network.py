@@ -1,14 +1,21 @@
+import asyncio
 import math
 import os
 import logging
 import shutil
 
-from typing import Optional
+from typing import Optional, Dict, List, Set, Tuple
 
 import networkx as nx
 
+from .topology import CompactTopology, RouteTree
+from .snapshot import SnapshotError, snapshot_filename, read_snapshot, write_snapshot
+
 GL_NETWORK_GRAPH = None  # type: Optional[GraphNetwork]
 
+# Edge attribute with the factor applied to the measured weights by traffic learning, it lives only in memory
+EDGE_PENALTY = 'penalty'
+
 
 class GraphNetworkError(Exception):
     pass
@@ -19,21 +26,47 @@ class GraphNetwork(object):
         self._network: Optional[nx.Graph] = None
         self._last_filename: Optional[str] = None
         self._local_node_id: int = 0
+        self._local_node_text_id: str = "0x000000"
+        self._version: int = 0
+        self._topology: Optional[CompactTopology] = None
+        self._route_tree: Optional[RouteTree] = None
+        self._route_text: Dict[int, str] = {}
+        self._routes_version: int = -1
 
     def _debug_path(self, s_path):
         p_ = None
         d = None
         for p in s_path:
             if p_ is None:
-                d = p
+                d = GraphNetwork.id2hex(p)
                 p_ = p
             else:
                 d += " -> "
-                d += "(%1.2f)" % self._network[p_][p]['weight']
-                d += " -> "
-                d += p
+                d += GraphNetwork.id2hex(p)
                 p_ = p
-        logging.debug("shortest_path " + d)
+        d += " (%1.2f)" % self._route_tree.distance(p_)
+        return d
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def last_filename(self) -> Optional[str]:
+        return self._last_filename
+
+    @property
+    def topology(self) -> Optional[CompactTopology]:
+        return self._topology
+
+    def graph_changed(self, structure=True):
+        """
+        Must be called after every change of nodes, edges or weights, it invalidates the route cache.
+        The compact topology is rebuilt only when nodes or edges were added or removed.
+        """
+        self._version += 1
+        if structure:
+            self._topology = None
 
     @property
     def local_node_id(self) -> int:
@@ -42,6 +75,7 @@ class GraphNetwork(object):
     @local_node_id.setter
     def local_node_id(self, value: int):
         self._local_node_id = value
+        self._local_node_text_id = "0x%06X" % value if value is not None else "0x000000"
         if self._network is None:
             self._local_node_id = None
             logging.error(f'GraphNetwork.local_node_id network is not loaded')
@@ -52,10 +86,11 @@ class GraphNetwork(object):
             logging.error(f'GraphNetwork.local_node_id {self.local_node_text_id} is not present in graph')
 
         self._network.nodes[self.local_node_text_id]['coordinator'] = True
+        self.graph_changed()
 
     @property
     def local_node_text_id(self):
-        return "0x%06X" % self.local_node_id
+        return self._local_node_text_id
 
     @staticmethod
     def node_text_id(value):
@@ -78,40 +113,212 @@ class GraphNetwork(object):
 
     def add_node(self, _id: int, _tag=''):
         self._network.add_node(GraphNetwork.id2hex(_id), tag=_tag, inuse=False, discover=False, buggy=False)
+        self.graph_changed()
+
+    def has_node(self, _id: int) -> bool:
+        return self._network is not None and GraphNetwork.id2hex(_id) in self._network
+
+    def node_ids(self) -> List[int]:
+        return [int(n[2:], 16) for n in self._network.nodes] if self._network is not None else []
+
+    def node_attributes(self, _id: int) -> dict:
+        return self._network.nodes[GraphNetwork.id2hex(_id)]
+
+    def set_node_attributes(self, _id: int, **attrs):
+        # Node attributes are not used for routing, the route cache stays valid
+        self._network.nodes[GraphNetwork.id2hex(_id)].update(attrs)
+
+    def neighbours(self, _id: int) -> List[int]:
+        return [int(n[2:], 16) for n in self._network.neighbors(GraphNetwork.id2hex(_id))]
+
+    def neighbourhood(self, _id: int, hops: int) -> Set[int]:
+        """
+        Nodes within the given number of hops, the node itself included
+        """
+        lengths = nx.single_source_shortest_path_length(self._network, GraphNetwork.id2hex(_id), cutoff=hops)
+        return {int(n[2:], 16) for n in lengths}
+
+    def has_edge(self, _from: int, _to: int) -> bool:
+        return self._network is not None and \
+            self._network.has_edge(GraphNetwork.id2hex(_from), GraphNetwork.id2hex(_to))
+
+    def edge_attributes(self, _from: int, _to: int) -> dict:
+        return self._network[GraphNetwork.id2hex(_from)][GraphNetwork.id2hex(_to)]
+
+    def edge_weights(self, _from: int, _to: int) -> Tuple[float, float]:
+        data = self._network[GraphNetwork.id2hex(_from)][GraphNetwork.id2hex(_to)]
+        return data['weight'], data.get('weight2', data['weight'])
+
+    def set_edge_weight(self, _from: int, _to: int, weight: float, weight2: Optional[float] = None):
+        f, t = GraphNetwork.id2hex(_from), GraphNetwork.id2hex(_to)
+        weight2 = weight if weight2 is None else weight2
+        existing = self._network.has_edge(f, t)
+        self._network.add_edge(f, t, weight=weight, weight2=weight2)
+        if existing and self._topology is not None and self._topology.set_edge_cost(_from, _to, weight, weight2):
+            self.graph_changed(structure=False)
+        else:
+            self.graph_changed()
+
+    def set_edge_attributes(self, _from: int, _to: int, **attrs):
+        # Only for attributes not used for routing, weights go through set_edge_weight
+        self._network[GraphNetwork.id2hex(_from)][GraphNetwork.id2hex(_to)].update(attrs)
+
+    def remove_edge(self, _from: int, _to: int):
+        f, t = GraphNetwork.id2hex(_from), GraphNetwork.id2hex(_to)
+        if self._network.has_edge(f, t):
+            self._network.remove_edge(f, t)
+            self.graph_changed()
+
+    def precompute_routes(self):
+        """
+        Build the route to every node with a single shortest path tree pass from the coordinator
+        """
+        self._route_tree = None
+        self._route_text = {}
+        self._routes_version = self._version
+        if self._network is None:
+            return
+        if self._topology is None:
+            self._topology = CompactTopology.from_graph(self._network)
+        if self.local_node_id not in self._topology:
+            return
+        self._route_tree = RouteTree(self._topology, self.local_node_id)
+        logging.debug(f'GraphNetwork.precompute_routes version {self._version} nodes {len(self._topology)} '
+                      f'size {self._topology.nbytes} bytes')
+
+    def route_tree(self) -> Optional[RouteTree]:
+        if self._routes_version != self._version:
+            self.precompute_routes()
+        return self._route_tree
 
     def shortest_path(self, target, full_path=False):
-        try:
-            s_path = nx.astar_path(self._network, self.local_node_text_id, self.node_text_id(target), weight=GraphNetwork.exp_weight)
-        except nx.exception.NodeNotFound as ex:
-            logging.error(f'Node not found {self.local_node_text_id} -> {self.node_text_id(target)}')
-            raise ex
-        self._debug_path(s_path)
-        if not full_path:
-            s_path = s_path[1:]
-        path = [int(i[2:], 16) for i in s_path]
-        return path
+        tree = self.route_tree()
+        s_path = tree.path(target) if tree is not None else None
+        if s_path is None:
+            if self._topology is None or target not in self._topology:
+                logging.error(f'Node not found {self.local_node_text_id} -> {self.node_text_id(target)}')
+                raise nx.exception.NodeNotFound(f'Node {self.node_text_id(target)} not found')
+            raise nx.exception.NetworkXNoPath(f'Node {self.node_text_id(target)} not reachable from {self.local_node_text_id}')
+        text = self._route_text.get(target)
+        if text is None:
+            text = self._debug_path(s_path)
+            self._route_text[target] = text
+        logging.debug("shortest_path " + text)
+        return s_path[:] if full_path else s_path[1:]
+
+    def shortest_path_avoiding(self, target: int, avoid: Set[int]) -> List[int]:
+        """
+        Route to target that does not cross the avoided nodes, computed on demand and not cached.
+        Same format as shortest_path: coordinator excluded, target included.
+        """
+        excluded = {GraphNetwork.id2hex(n) for n in avoid if n not in (target, self.local_node_id)}
+        view = nx.subgraph_view(self._network, filter_node=lambda n: n not in excluded)
+        s_path = nx.shortest_path(view, self.local_node_text_id, GraphNetwork.id2hex(target), weight=GraphNetwork.exp_weight)
+        return [int(n[2:], 16) for n in s_path[1:]]
 
     def init_empty(self):
         self._network = nx.Graph()
+        self.graph_changed()
+
+    @staticmethod
+    def _read_files(filename):
+        # type: (str) -> Tuple[Optional[nx.Graph], Optional[CompactTopology]]
+        """
+        Read the graph from its snapshot when it is not older than the GraphML file, from GraphML otherwise
+        """
+        snapshot = snapshot_filename(filename)
+        if os.path.exists(snapshot) and (not os.path.exists(filename) or
+                                         os.path.getmtime(snapshot) >= os.path.getmtime(filename)):
+            try:
+                return read_snapshot(snapshot)
+            except (SnapshotError, ValueError, KeyError) as ex:
+                logging.error(f'GraphNetwork invalid snapshot {snapshot} {str(ex)}')
+        if os.path.exists(filename):
+            return nx.readwrite.read_graphml(filename), None
+        return None, None
+
+    @staticmethod
+    def _write_files(graph, filename, backup_filename=None):
+        # type: (nx.Graph, str, Optional[str]) -> None
+        if backup_filename and os.path.exists(backup_filename):
+            shutil.copyfile(backup_filename, "%s.backup" % backup_filename)
+        tmp = filename + '.tmp'
+        nx.readwrite.write_graphml(graph, tmp)
+        os.replace(tmp, filename)
+        write_snapshot(graph, snapshot_filename(filename))
+
+    def _set_network(self, graph, topology=None):
+        # type: (nx.Graph, Optional[CompactTopology]) -> None
+        self._network = graph
+        self.graph_changed()
+        self._topology = topology
+        logging.info(f'GraphNetwork loaded {graph.number_of_nodes()} nodes {graph.number_of_edges()} edges')
 
     def load_network(self, filename, is_temporary=False):
         if not is_temporary:
             self._last_filename = filename
-        if os.path.exists(filename):
-            self._network = nx.readwrite.read_graphml(filename)
-            print(nx.info(self._network))
+        graph, topology = GraphNetwork._read_files(filename)
+        if graph is not None:
+            self._set_network(graph, topology)
 
-    def save_network(self, filename, temporary=False, backup=False):
+    async def load_network_async(self, filename, is_temporary=False):
+        """
+        Same as load_network but files are parsed in the default executor
+        """
+        if not is_temporary:
+            self._last_filename = filename
+        loop = asyncio.get_running_loop()
+        graph, topology = await loop.run_in_executor(None, GraphNetwork._read_files, filename)
+        if graph is not None:
+            self._set_network(graph, topology)
+
+    def _export_graph(self):
+        # type: () -> nx.Graph
+        """
+        Copy of the graph to write: edges keep their measured weights, the penalties learned
+        from traffic are not saved.
+        """
+        graph = self._network.copy()
+        for _, _, data in graph.edges(data=True):
+            penalty = data.pop(EDGE_PENALTY, None)
+            if penalty:
+                data['weight'] /= penalty
+                if 'weight2' in data:
+                    data['weight2'] /= penalty
+        return graph
+
+    def _prepare_save(self, filename, temporary, backup):
+        # type: (str, bool, bool) -> Tuple[str, Optional[str]]
+        backup_filename = None
         if not temporary:
             if self._last_filename and backup:
-                shutil.move(self._last_filename, "%s.backup" % self._last_filename)
+                backup_filename = self._last_filename
             if len(filename) < 1 or filename[0] == '*':
                 filename = self._last_filename
         if self._network is None:
             self._network = nx.Graph()
-            # self._network.add_node(_id, tag=_tag, inuse=False, discover=False, buggy=False)
-        print(filename, self._network.nodes(data=True))
-        nx.readwrite.write_graphml(self._network, filename)
+            self.graph_changed()
+        return filename, backup_filename
+
+    def save_network(self, filename, temporary=False, backup=False):
+        filename, backup_filename = self._prepare_save(filename, temporary, backup)
+        GraphNetwork._write_files(self._export_graph(), filename, backup_filename)
+
+    async def save_network_async(self, filename, temporary=False, backup=False):
+        """
+        Same as save_network but files are written in the default executor from a copy of the graph
+        """
+        filename, backup_filename = self._prepare_save(filename, temporary, backup)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, GraphNetwork._write_files, self._export_graph(), filename, backup_filename)
+
+    async def graphml_async(self):
+        # type: () -> str
+        if self._network is None:
+            self.init_empty()
+        loop = asyncio.get_running_loop()
+        graph = self._export_graph()
+        return await loop.run_in_executor(None, lambda: '\n'.join(nx.readwrite.generate_graphml(graph)))
 
     def is_network_loaded(self):
         return self._network is not None
@@ -0,0 +1,171 @@
+import binascii
+import logging
+
+from asyncio import sleep
+from typing import Any, Tuple, Union
+
+from .direct import DirectBase
+from .frame import APIFrame
+from .serialprotocol import SerialProtocol, TX_PRIORITY_RPC, TX_PRIORITY_BULK, TX_SOURCE_NODE
+from .connectedpath import ConnectedPathProtocol
+from .network import GraphNetwork
+from .correlator import ReplyCorrelator, ReplyTimeoutError
+from .rtt import is_slow_command
+
+RPC_TIMEOUT = 3.0
+
+globalProtocol = 'unicast'
+
+# Commands that move firmware or flash contents, queued behind interactive traffic
+BULK_COMMANDS = ['updateChunk', 'updateMemMD5', 'spiflash/write', 'spiflash/erase', 'spiflash/getmd5']
+
+
+def set_global_protocol(value):
+    # type: (str) -> None
+    global globalProtocol
+
+    if value in ['unicast', 'beacons', 'multipath', 'polite', 'connpath']:
+        globalProtocol = value
+    else:
+        logging.error('Invalid protocol requested')
+
+
+def get_global_protocol():
+    # type: () -> str
+    return globalProtocol
+
+
+async def rpc_standard_request(buffer, serial, protocol, cmd, priority=TX_PRIORITY_RPC, timeout=RPC_TIMEOUT):
+    # type: (bytes, int, str, str, int, float) -> bytes
+    """
+    Send a command to a node with the unicast or multipath protocol and wait its reply
+    """
+    serprot = SerialProtocol.get()  # type: SerialProtocol
+    rtt_path = None
+    if serial == 0:
+        frame = APIFrame(buffer, escaped=True)
+    elif protocol == 'unicast':
+        buffer = DirectBase.build_command('unicast', target=serial, payload=buffer)
+        frame = APIFrame(buffer, escaped=True)
+        rtt_path = [serial]
+    elif GraphNetwork.instance().is_network_loaded():
+        path = GraphNetwork.instance().shortest_path(serial)
+        rtt_path = path
+        if len(path) == 0:
+            pass
+        elif len(path) == 1:
+            buffer = DirectBase.build_command('unicast', target=serial, payload=buffer)
+        else:
+            path = path[0:-1]
+            buffer = DirectBase.build_command('multipath', target=serial, pathlen=len(path), path=path,
+                                              payload=buffer)
+        frame = APIFrame(buffer, escaped=True)
+    else:
+        buffer = DirectBase.build_command('unicast', target=serial, payload=buffer)
+        frame = APIFrame(buffer, escaped=True)
+
+    def _send():
+        return serprot.send_api_frame(frame, priority=priority, source=(TX_SOURCE_NODE, serial))
+
+    try:
+        buffer = await ReplyCorrelator.get().request(serial, cmd, _send, timeout, rtt_path)
+    except ReplyTimeoutError:
+        logging.error(f"Timeout error while waiting for reply from node {serial:08x}")
+        raise Exception('Timeout error while waiting for reply')
+
+    return buffer
+
+
+async def rpc_connpath_request(buffer, serial, priority=TX_PRIORITY_RPC, slow=False):
+    # type: (bytes, int, int, bool) -> bytes
+    connpath = ConnectedPathProtocol.get()
+    return await connpath.send_and_receive_data(buffer, serial, priority, slow)
+
+
+async def rpc_request(serial, reply, cmd, timeout=RPC_TIMEOUT, **cmdkwargs):
+    # type: (Union[int, str], Any, str, float, Any) -> Any
+    """
+    Send cmd to the node serial with the global protocol and return the reply fields named by reply:
+    a field name, a tuple of names where optional ones start with '*', or None for no fields.
+    """
+    commands = cmd.split('/')
+    in_buffer = DirectBase.build_command(cmd, **cmdkwargs)
+
+    if isinstance(serial, str):
+        serial = int(serial, 16)
+
+    priority = TX_PRIORITY_BULK if cmd in BULK_COMMANDS else TX_PRIORITY_RPC
+    if serial > 0 and globalProtocol == 'connpath':
+        buffer = await rpc_connpath_request(in_buffer, serial, priority, is_slow_command(cmd))
+    else:
+        buffer = await rpc_standard_request(in_buffer, serial, globalProtocol, cmd, priority, timeout)
+
+    frame = DirectBase.split_response(buffer)
+    if frame['id'] != commands[-1]:
+        if frame['id'] == 'error':
+            logging.error(f"Reply Error from node {serial:08x} data is {binascii.hexlify(frame['data'])}")
+            raise Exception('Error request %s' % binascii.hexlify(frame['data']))
+        else:
+            print(frame['id'], commands[-1])
+            logging.error(f"Reply mismateched from node {serial:08x}")
+            raise Exception('Malformed meshmesh packet %s' % binascii.hexlify(buffer))
+    else:
+        if globalProtocol == 'polite':
+            await sleep(0.5)
+        if reply is None:
+            return True
+        if isinstance(reply, str):
+            if reply not in frame:
+                raise Exception(f'Invalid reply received {reply} not found')
+            return frame[reply]
+        elif isinstance(reply, tuple):
+            result = []
+            replies = list(reply)
+            for reply in replies:
+                optional = False
+                if reply[0] == '*':
+                    reply = reply[1:]
+                    optional = True
+                if reply not in frame:
+                    if not optional:
+                        raise Exception('Invalid reply received')
+                else:
+                    result.append(frame[reply])
+            return tuple(result)
+
+    return frame[reply]
+
+
+async def rpc_node_tag(serial):
+    # type: (int) -> str
+    tag = await rpc_request(serial, 'tag', 'nodetag')
+    tag = tag[0:tag.find(b'\x00')]
+    return tag.decode('ascii')
+
+
+async def rpc_firmware_version(serial):
+    # type: (int) -> bytes
+    revision = await rpc_request(serial, 'revision', 'firm')
+    return revision.rstrip(b'\r\n\0')
+
+
+async def rpc_discovery_reset(serial):
+    # type: (int) -> bool
+    return await rpc_request(serial, None, 'discovery/reset')
+
+
+async def rpc_discovery_start(mask, filter_, slots, serial):
+    # type: (int, int, int, int) -> bool
+    return await rpc_request(serial, None, 'discovery/start', mask=mask, filter=filter_, slots=slots)
+
+
+async def rpc_discovery_count(serial):
+    # type: (int) -> int
+    return await rpc_request(serial, 'size', 'discovery/count')
+
+
+async def rpc_discovery_get(index, serial):
+    # type: (int, int) -> Tuple[int, int, int]
+    index, serial, rssi1, rssi2, flags = await rpc_request(serial, ('index', 'serial', 'rssi1', 'rssi2', 'flags'),
+                                                           'discovery/get', index=index)
+    return serial, rssi1, (rssi2 if rssi2 >= 0 else rssi1)
@@ -0,0 +1,224 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from typing import Optional, Dict, Tuple, List
+
+GL_RTT_TABLE = None  # type: Optional[RttTable]
+
+RTT_ALPHA = 1.0 / 8.0
+RTT_BETA = 1.0 / 4.0
+RTT_K = 4
+RTO_MIN = 0.3
+RTO_MAX = 15.0
+RTT_SAVE_INTERVAL = 60
+# Commands whose reply waits for flash or radio work on the node, their time is not round trip time.
+# They are not sampled and their timeout is never shorter than the default of the caller.
+RTT_SLOW_COMMANDS = ['updateStart', 'updateChunk', 'updateDigest', 'updateMemMD5', 'spiflash', 'discovery', 'rssicheck']
+
+
+def is_slow_command(cmd):
+    # type: (str) -> bool
+    return cmd.split('/')[0] in RTT_SLOW_COMMANDS
+
+
+class RttEstimator(object):
+    """
+    Smoothed round trip time estimator (SRTT/RTTVAR as in RFC 6298).
+    """
+    def __init__(self, srtt=None, rttvar=None, samples=0):
+        # type: (Optional[float], Optional[float], int) -> None
+        self._srtt = srtt  # type: Optional[float]
+        self._rttvar = rttvar  # type: Optional[float]
+        self._samples = samples  # type: int
+        self._backoff = 1  # type: int
+        self._failures = 0  # type: int
+        self._last_failure = 0.0  # type: float
+
+    @property
+    def srtt(self):
+        # type: () -> Optional[float]
+        return self._srtt
+
+    @property
+    def rttvar(self):
+        # type: () -> Optional[float]
+        return self._rttvar
+
+    @property
+    def samples(self):
+        # type: () -> int
+        return self._samples
+
+    @property
+    def failures(self):
+        # type: () -> int
+        """
+        Timeouts since the last valid sample
+        """
+        return self._failures
+
+    @property
+    def last_failure(self):
+        # type: () -> float
+        return self._last_failure
+
+    def sample(self, rtt):
+        # type: (float) -> None
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2.0
+        else:
+            self._rttvar = (1 - RTT_BETA) * self._rttvar + RTT_BETA * abs(self._srtt - rtt)
+            self._srtt = (1 - RTT_ALPHA) * self._srtt + RTT_ALPHA * rtt
+        self._samples += 1
+        self._backoff = 1
+        self._failures = 0
+
+    def timed_out(self):
+        # Exponential backoff until next valid sample
+        if self._backoff < 8:
+            self._backoff *= 2
+        self._failures += 1
+        self._last_failure = time.time()
+
+    def rto(self, default):
+        # type: (float) -> float
+        if self._srtt is None:
+            return default
+        rto = (self._srtt + RTT_K * self._rttvar) * self._backoff
+        return min(max(rto, RTO_MIN), RTO_MAX)
+
+    def to_dict(self):
+        return {'srtt': self._srtt, 'rttvar': self._rttvar, 'samples': self._samples}
+
+    @staticmethod
+    def from_dict(value):
+        return RttEstimator(value.get('srtt'), value.get('rttvar'), value.get('samples', 0))
+
+
+class RttTable(object):
+    """
+    Round trip time estimators for every node and for every path used to reach it.
+    Timeouts are derived from the path estimator, then from the node one, finally
+    from the default given by caller when nothing was measured yet. Slow commands
+    never get less than the default.
+    """
+    def __init__(self):
+        self._nodes = {}  # type: Dict[int, RttEstimator]
+        self._paths = {}  # type: Dict[Tuple[int, ...], RttEstimator]
+        self._filename = None  # type: Optional[str]
+
+    @staticmethod
+    def instance():
+        # type: () -> RttTable
+        global GL_RTT_TABLE
+        if GL_RTT_TABLE is None:
+            GL_RTT_TABLE = RttTable()
+        return GL_RTT_TABLE
+
+    def node(self, serial):
+        # type: (int) -> RttEstimator
+        est = self._nodes.get(serial)
+        if est is None:
+            est = RttEstimator()
+            self._nodes[serial] = est
+        return est
+
+    def path(self, path):
+        # type: (List[int]) -> RttEstimator
+        key = tuple(path)
+        est = self._paths.get(key)
+        if est is None:
+            est = RttEstimator()
+            self._paths[key] = est
+        return est
+
+    def timeout(self, serial, path=None, default=3.0, slow=False):
+        # type: (int, Optional[List[int]], float, bool) -> float
+        est = self._paths.get(tuple(path)) if path else None
+        if est is None or est.samples == 0:
+            est = self._nodes.get(serial)
+        if est is None or est.samples == 0:
+            return default
+        return max(default, est.rto(default)) if slow else est.rto(default)
+
+    def sample(self, serial, rtt, path=None):
+        # type: (int, float, Optional[List[int]]) -> None
+        self.node(serial).sample(rtt)
+        if path:
+            self.path(path).sample(rtt)
+
+    def timed_out(self, serial, path=None):
+        # type: (int, Optional[List[int]]) -> None
+        self.node(serial).timed_out()
+        if path:
+            self.path(path).timed_out()
+
+    def failed_nodes(self):
+        # type: () -> Dict[int, Tuple[float, float]]
+        """
+        Timeouts and time of the last one for every node, the timeouts of a path are shared between its hops
+        """
+        failed = {}  # type: Dict[int, Tuple[float, float]]
+
+        def _add(serial, failures, last):
+            count, last_ = failed.get(serial, (0.0, 0.0))
+            failed[serial] = count + failures, max(last, last_)
+
+        for serial, est in self._nodes.items():
+            if est.failures > 0:
+                _add(serial, est.failures, est.last_failure)
+        for path, est in self._paths.items():
+            if est.failures > 0:
+                for hop in path:
+                    _add(hop, est.failures / len(path), est.last_failure)
+        return failed
+
+    def load(self, filename):
+        # type: (str) -> None
+        self._filename = filename
+        if not os.path.exists(filename):
+            return
+        try:
+            with open(filename, 'r') as f:
+                data = json.load(f)
+            for key, value in data.get('nodes', {}).items():
+                self._nodes[int(key, 16)] = RttEstimator.from_dict(value)
+            for key, value in data.get('paths', {}).items():
+                self._paths[tuple(int(i, 16) for i in key.split(','))] = RttEstimator.from_dict(value)
+            logging.info(f'RttTable.load {len(self._nodes)} nodes {len(self._paths)} paths from {filename}')
+        except (ValueError, KeyError) as ex:
+            logging.error(f'RttTable.load invalid file {filename} {str(ex)}')
+
+    def save(self, filename=None):
+        # type: (Optional[str]) -> None
+        filename = filename or self._filename
+        if filename is None:
+            return
+        data = {
+            'nodes': {f'0x{k:06X}': v.to_dict() for k, v in self._nodes.items() if v.samples > 0},
+            'paths': {','.join(f'0x{i:06X}' for i in k): v.to_dict() for k, v in self._paths.items() if v.samples > 0},
+        }
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(filename + '.tmp', filename)
+
+    async def save_periodically(self):
+        # type: () -> None
+        while True:
+            await asyncio.sleep(RTT_SAVE_INTERVAL)
+            self.save()
+
+
+def rtt_setup(loop, filename):
+    # type: (asyncio.AbstractEventLoop, str) -> None
+    table = RttTable.instance()
+    table.load(filename)
+    loop.create_task(table.save_periodically())
+
+
+def rtt_shutdown():
+    RttTable.instance().save()
@@ -2,27 +2,333 @@ import asyncio
 import binascii
 import logging
 import time
-from typing import Optional, List
+from collections import OrderedDict, deque
+from typing import Optional, List, Union, Dict, Any, Callable
 
-from .frame import APIFrame
+from .frame import APIFrame, APIFrameDecoder
 from .direct import DirectBase
 
 
+TX_PRIORITY_LINK = 0
+TX_PRIORITY_RPC = 1
+TX_PRIORITY_STREAM = 2
+TX_PRIORITY_BULK = 3
+TX_PRIORITIES = (TX_PRIORITY_LINK, TX_PRIORITY_RPC, TX_PRIORITY_STREAM, TX_PRIORITY_BULK)
+
+# Sources are (kind, id) tuples, connpath handles and node serials are separate key spaces
+TX_SOURCE_CONN = 'conn'
+TX_SOURCE_NODE = 'node'
+
+# Flow control of watched sources: queued bytes that pause a source and that resume it
+TX_SOURCE_HIGH_WATER = 4096
+TX_SOURCE_LOW_WATER = 1024
+# Same for the whole queue, when above all the watched sources are paused
+TX_QUEUE_HIGH_WATER = 32768
+TX_QUEUE_LOW_WATER = 8192
+# A frame not written to the serial port after this many seconds is dropped by the waiter
+TX_WRITE_TIMEOUT = 10.0
+# Seconds before a writer task that died is started again
+TX_WRITER_RESTART_DELAY = 1.0
+
+
 class TxFrameHandler:
-    def __init__(self, frame, lock_timeout=0):
-        #  type: (APIFrame, float) -> None
-        self._frame = frame  # type: APIFrame
+    def __init__(self, frame, lock_timeout=0, priority=TX_PRIORITY_RPC, source=None):
+        #  type: (Union[APIFrame, List[APIFrame]], float, int, Any) -> None
+        self._frame = frame  # type: Union[APIFrame, List[APIFrame]]
         self._lock_timeout = lock_timeout  # type: float
+        self._priority = priority  # type: int
+        self._source = source  # type: Any
+        self._written_at = 0.0  # type: float
+        self._written = None  # type: Optional[asyncio.Future]
+        self._cancelled = False  # type: bool
 
     @property
     def frame(self):
         return self._frame
 
+    @property
+    def frames(self):
+        #  type: () -> List[APIFrame]
+        return self._frame if isinstance(self._frame, list) else [self._frame]
+
     @property
     def lock_timeout(self):
         #  type: () -> float
         return self._lock_timeout
 
+    @property
+    def priority(self):
+        #  type: () -> int
+        return self._priority
+
+    @property
+    def source(self):
+        return self._source
+
+    @property
+    def size(self):
+        #  type: () -> int
+        return sum(len(f.data) for f in self.frames)
+
+    @property
+    def written_at(self):
+        #  type: () -> float
+        """
+        Monotonic time the frame was written to the serial port, 0 if not yet
+        """
+        return self._written_at
+
+    @property
+    def cancelled(self):
+        #  type: () -> bool
+        return self._cancelled
+
+    def set_written(self):
+        #  type: () -> None
+        self._written_at = time.monotonic()
+        if self._written is not None and not self._written.done():
+            self._written.set_result(self._written_at)
+
+    async def wait_written(self, timeout=TX_WRITE_TIMEOUT):
+        #  type: (float) -> float
+        """
+        Wait until the frame is written to the serial port and return the monotonic time it was.
+        A frame still queued after timeout is cancelled and asyncio.TimeoutError raised.
+        """
+        if self._written_at > 0.0:
+            return self._written_at
+        if self._written is None:
+            self._written = asyncio.get_running_loop().create_future()
+        try:
+            return await asyncio.wait_for(asyncio.shield(self._written), timeout)
+        except asyncio.TimeoutError:
+            self._cancelled = True
+            raise
+
+
+class TxFlowControl:
+    """
+    Pause and resume callbacks of a source, called when its queued bytes cross the watermarks
+    """
+    def __init__(self, pause, resume):
+        #  type: (Callable[[], None], Callable[[], None]) -> None
+        self.pause = pause  # type: Callable[[], None]
+        self.resume = resume  # type: Callable[[], None]
+        self.paused = False  # type: bool
+
+
+class TxScheduler:
+    """
+    Queue of frames waiting for the serial link. Frames are served by priority class
+    (link control, interactive RPC, esphome stream data, bulk/OTA), sources inside a class
+    are served round robin. A lower class that was skipped STARVATION_LIMIT times in a row
+    is served before the higher ones. Frames of the same source are never reordered: a frame
+    is queued in the lowest class that still holds frames of its source.
+
+    Queued bytes are counted per source and for the whole queue, a watched source is paused when
+    its bytes or the queue bytes pass the high watermark and resumed when both are under the low one.
+    """
+    STARVATION_LIMIT = {TX_PRIORITY_RPC: 4, TX_PRIORITY_STREAM: 8, TX_PRIORITY_BULK: 16}
+
+    def __init__(self):
+        self._classes = {p: OrderedDict() for p in TX_PRIORITIES}  # type: Dict[int, OrderedDict]
+        self._skipped = {p: 0 for p in TX_PRIORITIES}  # type: Dict[int, int]
+        self._size = 0  # type: int
+        self._not_empty = asyncio.Event()  # type: asyncio.Event
+        self._bytes = 0  # type: int
+        self._source_bytes = {}  # type: Dict[Any, int]
+        self._watched = {}  # type: Dict[Any, TxFlowControl]
+        self._paused = 0  # type: int
+
+    def qsize(self):
+        #  type: () -> int
+        return self._size
+
+    def empty(self):
+        #  type: () -> bool
+        return self._size == 0
+
+    @property
+    def bytes(self):
+        #  type: () -> int
+        return self._bytes
+
+    def source_bytes(self, source):
+        #  type: (Any) -> int
+        return self._source_bytes.get(source, 0)
+
+    def watch(self, source, pause, resume):
+        #  type: (Any, Callable[[], None], Callable[[], None]) -> None
+        self.unwatch(source)
+        self._watched[source] = TxFlowControl(pause, resume)
+        self._check_pause(source)
+
+    def unwatch(self, source):
+        #  type: (Any) -> None
+        # A source no longer watched is not left paused
+        flow = self._watched.pop(source, None)
+        if flow is not None and flow.paused:
+            self._paused -= 1
+            flow.resume()
+
+    def _check_pause(self, source):
+        #  type: (Any) -> None
+        if self._bytes > TX_QUEUE_HIGH_WATER:
+            if self._paused == len(self._watched):
+                return
+            for s in list(self._watched.keys()):
+                self._pause(s)
+        elif self._source_bytes.get(source, 0) > TX_SOURCE_HIGH_WATER:
+            self._pause(source)
+
+    def _pause(self, source):
+        #  type: (Any) -> None
+        flow = self._watched.get(source)
+        if flow is not None and not flow.paused:
+            flow.paused = True
+            self._paused += 1
+            logging.debug(f'TxScheduler.pause {source} bytes {self.source_bytes(source)} queue {self._bytes}')
+            flow.pause()
+
+    def _check_resume(self):
+        #  type: () -> None
+        if self._bytes > TX_QUEUE_LOW_WATER:
+            return
+        for source, flow in list(self._watched.items()):
+            if flow.paused and self._source_bytes.get(source, 0) <= TX_SOURCE_LOW_WATER:
+                flow.paused = False
+                self._paused -= 1
+                logging.debug(f'TxScheduler.resume {source} bytes {self.source_bytes(source)} queue {self._bytes}')
+                flow.resume()
+
+    def class_size(self, priority):
+        #  type: (int) -> int
+        return sum(len(q) for q in self._classes[priority].values())
+
+    def put_nowait(self, handler):
+        #  type: (TxFrameHandler) -> None
+        priority = handler.priority
+        if handler.source is not None:
+            for p in TX_PRIORITIES:
+                if p > priority and handler.source in self._classes[p]:
+                    priority = p
+        sources = self._classes[priority]
+        if handler.source not in sources:
+            sources[handler.source] = deque()
+        sources[handler.source].append(handler)
+        self._size += 1
+        size = handler.size
+        self._bytes += size
+        self._source_bytes[handler.source] = self._source_bytes.get(handler.source, 0) + size
+        self._not_empty.set()
+        if handler.source in self._watched or self._bytes > TX_QUEUE_HIGH_WATER:
+            self._check_pause(handler.source)
+
+    def get_nowait(self):
+        #  type: () -> TxFrameHandler
+        if self._size == 0:
+            raise asyncio.QueueEmpty()
+
+        active = [p for p in TX_PRIORITIES if len(self._classes[p]) > 0]
+        selected = active[0]
+        for p in active[1:]:
+            if self._skipped[p] >= TxScheduler.STARVATION_LIMIT[p]:
+                selected = p
+                break
+        for p in TX_PRIORITIES:
+            if p == selected or p not in active:
+                self._skipped[p] = 0
+            elif p > selected:
+                self._skipped[p] += 1
+
+        # Round robin among sources of the selected class
+        sources = self._classes[selected]
+        source, frames = sources.popitem(last=False)
+        handler = frames.popleft()
+        if len(frames) > 0:
+            sources[source] = frames
+        self._size -= 1
+        if self._size == 0:
+            self._not_empty.clear()
+        size = handler.size
+        self._bytes -= size
+        remaining = self._source_bytes[source] - size
+        if remaining > 0:
+            self._source_bytes[source] = remaining
+        else:
+            del self._source_bytes[source]
+        if self._paused > 0:
+            self._check_resume()
+        return handler
+
+    def take(self, source):
+        #  type: (Any) -> List[TxFrameHandler]
+        """
+        Remove and return the frames of source not written yet, in queue order
+        """
+        taken = []  # type: List[TxFrameHandler]
+        for p in TX_PRIORITIES:
+            frames = self._classes[p].pop(source, None)
+            if frames:
+                taken += frames
+        if not taken:
+            return taken
+        size = sum(h.size for h in taken)
+        self._size -= len(taken)
+        self._bytes -= size
+        self._source_bytes.pop(source, None)
+        if self._size == 0:
+            self._not_empty.clear()
+        if self._paused > 0:
+            self._check_resume()
+        return taken
+
+    async def get(self):
+        #  type: () -> TxFrameHandler
+        while self._size == 0:
+            await self._not_empty.wait()
+        return self.get_nowait()
+
+
+class TxTokenBucket:
+    """
+    Token bucket used to pace the bytes written to the coordinator serial port.
+    Tokens are refilled at the serial line rate, the bucket size is the burst the
+    coordinator receive buffer can absorb.
+    """
+    def __init__(self, rate, capacity):
+        #  type: (float, int) -> None
+        self._rate = rate  # type: float
+        self._capacity = capacity  # type: int
+        self._tokens = float(capacity)  # type: float
+        self._last = time.monotonic()  # type: float
+
+    @property
+    def rate(self):
+        #  type: () -> float
+        return self._rate
+
+    @property
+    def capacity(self):
+        #  type: () -> int
+        return self._capacity
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+
+    def delay(self, size):
+        #  type: (int) -> float
+        self._refill()
+        missing = min(size, self._capacity) - self._tokens
+        return missing / self._rate if missing > 0 else 0.0
+
+    def consume(self, size):
+        #  type: (int) -> None
+        self._refill()
+        self._tokens -= size
+
 
 class RxFrameHandler:
     def __init__(self, byte1, byte2=None):
@@ -55,6 +361,7 @@ class RxFrameHandler:
 
 class SerialProtocol(asyncio.Protocol):
     _singleton = None  # type: Optional[SerialProtocol]
+    TX_CHUNK_SIZE = 0x40
 
     @staticmethod
     def get():
@@ -70,64 +377,113 @@ class SerialProtocol(asyncio.Protocol):
         # type: () -> asyncio.Lock
         return self._lock
 
-    def __init__(self):
+    def __init__(self, baudrate=115200, rx_buffer_size=2048):
+        #  type: (int, int) -> None
         super().__init__()
         print('SerialProtocol.__init__')
-        self._input_frame = None  # type: Optional[APIFrame]
+        self._decoder = APIFrameDecoder(escaped=True, text_callback=self.text_received)  # type: APIFrameDecoder
         self._transport = None  # type: Optional[asyncio.Transport]
         self._rx_frames = asyncio.Queue()  # type: asyncio.Queue
-        self._tx_frames = asyncio.Queue()  # type: asyncio.Queue
+        self._tx_frames = TxScheduler()  # type: TxScheduler
         self._callbacks = []  # type: List[RxFrameHandler]
+        self._reply_handler = None  # type: Optional[Callable[[bytes], None]]
         self._lock = asyncio.Lock()  # type: asyncio.Lock
         self._tx_lock = False  # type: bool
         self._tx_lock_event = asyncio.Event()  # type: asyncio.Event
-        self._tx_lock_time = 0  # type: int
+        self._tx_lock_event.set()
+        self._tx_lock_time = 0  # type: float
+        self._tx_buffer = bytearray()  # type: bytearray
+        # Serial line carries 10 bits per byte, allow bursts of half the coordinator rx buffer
+        self._tx_bucket = TxTokenBucket(int(baudrate) / 10.0, int(rx_buffer_size) // 2)  # type: TxTokenBucket
+        self._tx_writable = asyncio.Event()  # type: asyncio.Event
+        self._tx_writable.set()
+        self._writer_task = None  # type: Optional[asyncio.Task]
         self._file = None
-        self.spare_bytes = ''
 
     def connection_made(self, transport: asyncio.Transport):
         print('SerialProtocol.connection_made')
         self._transport = transport
+        self._transport.set_write_buffer_limits(high=SerialProtocol.TX_CHUNK_SIZE * 2, low=SerialProtocol.TX_CHUNK_SIZE)
+        self._start_writer()
         self._file = open('/tmp/serial_received.dat', 'wb')
         SerialProtocol._singleton = self
 
     def connection_lost(self, exc):
         print('SerialProtocol.connection_lost', exc)
+        if self._writer_task is not None and not self._writer_task.done():
+            self._writer_task.cancel()
         self._file.close()
 
+    def pause_writing(self):
+        logging.debug(f'SerialProtocol.pause_writing buffer {self._transport.get_write_buffer_size()}')
+        self._tx_writable.clear()
+
+    def resume_writing(self):
+        self._tx_writable.set()
+
+    def _start_writer(self):
+        self._writer_task = asyncio.get_event_loop().create_task(self._writer())
+        self._writer_task.add_done_callback(self._writer_done)
+
+    def _writer_done(self, task):
+        #  type: (asyncio.Task) -> None
+        if task.cancelled():
+            return
+        logging.error('SerialProtocol.writer stopped', exc_info=task.exception())
+        asyncio.get_event_loop().call_later(TX_WRITER_RESTART_DELAY, self._restart_writer)
+
+    def _restart_writer(self):
+        if self._transport is not None and not self._transport.is_closing() and self._writer_task.done():
+            logging.warning('SerialProtocol.writer restarted')
+            self._start_writer()
+
+    async def _writer(self):
+        #  type: () -> None
+        # Only this task writes to the serial transport. Output is paced by the token bucket
+        # and by the transport write buffer limits, so the event loop is never blocked.
+        while True:
+            # Frames sent with a lock timeout hold the link until the coordinator replies
+            await self._tx_lock_event.wait()
+            txhandler = await self._tx_frames.get()  # type: TxFrameHandler
+            if txhandler.cancelled:
+                continue
+            try:
+                await self._write_frame(txhandler)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception(f'SerialProtocol.writer frame of source {txhandler.source} dropped')
+
+    async def _write_frame(self, txhandler):
+        #  type: (TxFrameHandler) -> None
+        if txhandler.lock_timeout > 0:
+            self._lock_tx(txhandler.lock_timeout)
+        data = bytes(APIFrame.output_frames(txhandler.frames, self._tx_buffer))
+        # logging.info(f'send_api_frame {binascii.hexlify(data)}')
+        pos = 0
+        while pos < len(data):
+            await self._tx_writable.wait()
+            size = min(len(data) - pos, SerialProtocol.TX_CHUNK_SIZE)
+            delay = self._tx_bucket.delay(size)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._tx_bucket.consume(size)
+            self._transport.write(data[pos:pos + size])
+            pos += size
+        txhandler.set_written()
+
     def data_received(self, data: bytes):
         self._file.write(data)
-        for b in data:
-            b = bytes([b])
-            # Print every character the is not inside an API frame.
-            if b != APIFrame.START_BYTE and self._input_frame is None:
-                try:
-                    if b == b'\x0A' or b == b'\x0D':
-                        if len(self.spare_bytes) > 0:
-                            logging.debug(f'Node said: {self.spare_bytes}')
-                            self.spare_bytes = ''
-                    else:
-                        self.spare_bytes += b.decode('utf-8')
-                except UnicodeDecodeError:
-                    pass
-
-            if self._input_frame is None:
-                if b == APIFrame.START_BYTE:
-                    # print('start')
-                    self._input_frame = APIFrame(escaped=True)
-                    self._input_frame.fill(b)
-            else:
-                if self._input_frame.fill(b):
-                    try:
-                        self._input_frame.parse()
-                        # if self._input_frame.data[0] != 0x39:
-                        #   logging.debug(f'SerialProtocol.data_received  frame
-                        #   {len(self._input_frame.data)} {binascii.hexlify(self._input_frame.data)}')
-                        self.frame_received(self._input_frame.data)
-                        self._input_frame = None
-                    except ValueError:
-                        # Bad frame, so restarts
-                        self._input_frame = None
+        for frame in self._decoder.feed(data):
+            # if frame[0] != 0x39:
+            #   logging.debug(f'SerialProtocol.data_received  frame {len(frame)} {binascii.hexlify(frame)}')
+            self.frame_received(frame)
+
+    @staticmethod
+    def text_received(line):
+        # type: (str) -> None
+        # Print every line that is not inside an API frame.
+        logging.debug(f'Node said: {line}')
 
     def frame_received(self, data):
         # print('SerialProtocol.frame_received', data[0])
@@ -139,7 +495,10 @@ class SerialProtocol(asyncio.Protocol):
                 if cb.is_mine(data):
                     cb.frame_received(data)
                     data = None
-            if data is not None:
+            if data is not None and self._reply_handler is not None:
+                self._reply_handler(data)
+            elif data is not None:
+                # Replies read directly by the setup before the reply handler is registered
                 self._rx_frames.put_nowait(data)
 
     def unlock_tx_frame(self):
@@ -147,25 +506,23 @@ class SerialProtocol(asyncio.Protocol):
         if self._tx_lock:
             self._tx_lock = False
             self._tx_lock_event.set()
-        try:
-            txhandler = self._tx_frames.get_nowait()  # type: TxFrameHandler
-            self._send_api_frame(txhandler.frame, txhandler.lock_timeout)
-        except asyncio.QueueEmpty:
-            pass
 
-    def send_api_frame(self, frame, timeout=0):
-        #  type: (APIFrame, float) -> None
-        if self._tx_lock:
-            self._tx_frames.put_nowait(TxFrameHandler(frame, timeout))
-            if time.time() - self._tx_lock_time > 0.250:
-                logging.error("SerialProtocol.send_api_frame lock active for too much time! Foce unlock ")
-                self.unlock_tx_frame()
-        else:
-            self._send_api_frame(frame, timeout)
-        if not self._tx_frames.empty():
+    def send_api_frame(self, frame, timeout=0, priority=TX_PRIORITY_RPC, source=None):
+        #  type: (Union[APIFrame, List[APIFrame]], float, int, Any) -> TxFrameHandler
+        handler = TxFrameHandler(frame, timeout, priority, source)
+        self._tx_frames.put_nowait(handler)
+        if self._tx_lock and time.time() - self._tx_lock_time > 0.250:
+            logging.error("SerialProtocol.send_api_frame lock active for too much time! Foce unlock ")
+            self.unlock_tx_frame()
+        if self._tx_frames.qsize() > 1:
             logging.debug(f'SerialProtocol.send_api_frame queue {self._tx_frames.qsize()}')
+        return handler
 
-    def _lock_timeout(self, timeout):
+    def send_api_frames(self, frames, timeout=0, priority=TX_PRIORITY_RPC, source=None):
+        #  type: (List[APIFrame], float, int, Any) -> TxFrameHandler
+        return self.send_api_frame(frames, timeout, priority, source)
+
+    def _lock_tx(self, timeout):
         #  type: (float) -> None
         async def _timeout(to):
             try:
@@ -173,40 +530,26 @@ class SerialProtocol(asyncio.Protocol):
             except asyncio.TimeoutError:
                 logging.error("SerialProtocol._lock_timeout force unlock after reach timeout")
                 self.unlock_tx_frame()
+
+        self._tx_lock = True
+        self._tx_lock_time = time.time()
+        self._tx_lock_event.clear()
         asyncio.create_task(_timeout(timeout))
 
-    def _send_next_frame(self):
-        try:
-            txhandler = self._tx_frames.get_nowait()  # type: TxFrameHandler
-            self._send_api_frame(txhandler.frame, txhandler.lock_timeout)
-        except asyncio.QueueEmpty:
-            pass
-
-    def _send_api_frame(self, frame, timeout=0):
-        #  type: (APIFrame, float) -> None
-        async def _wait_tx_future():
-            #  type: () -> None
-            await asyncio.sleep(0.02)
-            self._send_next_frame()
-
-        self._tx_lock = True if timeout > 0 else False
-        if self._tx_lock:
-            self._tx_lock_time = time.time()
-            self._lock_timeout(timeout)
+    def take_tx_source(self, source):
+        # type: (Any) -> List[TxFrameHandler]
+        return self._tx_frames.take(source)
 
-        if not self._tx_frames.empty():
-            # if queue is not empty i must create a future for send next frame
-            asyncio.create_task(_wait_tx_future())
+    def watch_tx_source(self, source, pause, resume):
+        #  type: (Any, Callable[[], None], Callable[[], None]) -> None
+        """
+        Flow control for a source of queued frames, see TxScheduler
+        """
+        self._tx_frames.watch(source, pause, resume)
 
-        chunksize = 0x40
-        data = frame.output()
-        # logging.info(f'send_api_frame {binascii.hexlify(data)}')
-        outdatachunks = int(len(data) / chunksize + 1)
-        for i in range(0, outdatachunks):
-            chunk = data[i * chunksize:(i + 1) * chunksize]
-            self._transport.write(chunk)
-            # FIXME we lose some byte over serial.
-            time.sleep(0.005)
+    def unwatch_tx_source(self, source):
+        #  type: (Any) -> None
+        self._tx_frames.unwatch(source)
 
     def register_callback(self, callback, byte1, byte2=None):
         cb = RxFrameHandler(byte1, byte2)
@@ -214,6 +557,10 @@ class SerialProtocol(asyncio.Protocol):
         self._callbacks.append(cb)
         return cb
 
+    def register_reply_handler(self, handler):
+        #  type: (Optional[Callable[[bytes], None]]) -> None
+        self._reply_handler = handler
+
 
 async def test_serial_device():
     pass
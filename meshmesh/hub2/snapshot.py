@@ -0,0 +1,126 @@
+import json
+import math
+import mmap
+import os
+import struct
+
+from typing import Tuple
+
+import networkx as nx
+import numpy as np
+
+from .topology import CompactTopology
+
+SNAPSHOT_MAGIC = b'MMGS'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_EXTENSION = '.snap'
+
+# magic, version, flags, nodes, edges, attributes length, reserved
+SNAPSHOT_HEADER = struct.Struct('<4sHHIIII')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def snapshot_filename(filename):
+    # type: (str) -> str
+    return os.path.splitext(filename)[0] + SNAPSHOT_EXTENSION
+
+
+def write_snapshot(graph, filename):
+    # type: (nx.Graph, str) -> None
+    """
+    Write the graph as a binary snapshot: fixed size header, edge weights as float64,
+    node ids and edge endpoints as uint32 then node names and node and edge attributes as JSON.
+    Every section is aligned so the file can be memory mapped.
+    The file is written aside and renamed, readers never see a partial snapshot.
+    """
+    names = list(graph.nodes)
+    index = {n: i for i, n in enumerate(names)}
+    ids = np.array([int(n[2:], 16) for n in names], dtype=np.uint32)
+    n_edges = graph.number_of_edges()
+    src = np.empty(n_edges, dtype=np.uint32)
+    dst = np.empty(n_edges, dtype=np.uint32)
+    weights = np.full(n_edges, np.nan, dtype=np.float64)
+    weights2 = np.full(n_edges, np.nan, dtype=np.float64)
+    edge_attrs = {}
+    for i, (f, t, data) in enumerate(graph.edges(data=True)):
+        src[i], dst[i] = index[f], index[t]
+        extra = {}
+        for key, value in data.items():
+            if key == 'weight':
+                weights[i] = value
+            elif key == 'weight2':
+                weights2[i] = value
+            else:
+                extra[key] = value
+        if extra:
+            edge_attrs[i] = extra
+
+    attrs = json.dumps({
+        'graph': graph.graph,
+        # The names as they are in the graph, the uint32 ids do not keep their formatting
+        'names': names,
+        'nodes': [graph.nodes[n] for n in names],
+        'edges': edge_attrs,
+    }, separators=(',', ':')).encode('utf-8')
+
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, len(ids), n_edges, len(attrs), 0))
+        for array in (weights, weights2, ids, src, dst):
+            f.write(array.tobytes())
+        f.write(attrs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
+def read_snapshot(filename):
+    # type: (str) -> Tuple[nx.Graph, CompactTopology]
+    """
+    Read a snapshot written by write_snapshot, returns the graph and its routing topology
+    """
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if len(mm) < SNAPSHOT_HEADER.size:
+                raise SnapshotError(f'Snapshot {filename} is truncated')
+            magic, version, _, n_nodes, n_edges, attrs_len, _ = SNAPSHOT_HEADER.unpack_from(mm, 0)
+            if magic != SNAPSHOT_MAGIC:
+                raise SnapshotError(f'File {filename} is not a graph snapshot')
+            if version != SNAPSHOT_VERSION:
+                raise SnapshotError(f'Snapshot {filename} version {version} is not supported')
+            size = SNAPSHOT_HEADER.size + 16 * n_edges + 4 * n_nodes + 8 * n_edges + attrs_len
+            if len(mm) != size:
+                raise SnapshotError(f'Snapshot {filename} size {len(mm)} expected {size}')
+
+            offset = SNAPSHOT_HEADER.size
+            arrays = []
+            for dtype, count in ((np.float64, n_edges), (np.float64, n_edges), (np.uint32, n_nodes),
+                                 (np.uint32, n_edges), (np.uint32, n_edges)):
+                array = np.frombuffer(mm, dtype=dtype, count=count, offset=offset)
+                arrays.append(array.copy())
+                offset += array.nbytes
+                del array
+            attrs = json.loads(mm[offset:offset + attrs_len].decode('utf-8'))
+
+    weights, weights2, ids, src, dst = arrays
+    names = attrs.get('names') or ["0x%06X" % i for i in ids.tolist()]
+    graph = nx.Graph()
+    graph.graph.update(attrs['graph'])
+    graph.add_nodes_from(zip(names, attrs['nodes']))
+    edge_attrs = attrs['edges']
+    edges = []
+    for i, (f, t, w, w2) in enumerate(zip(src.tolist(), dst.tolist(), weights.tolist(), weights2.tolist())):
+        data = dict(edge_attrs.get(str(i), {}))
+        if not math.isnan(w):
+            data['weight'] = w
+        if not math.isnan(w2):
+            data['weight2'] = w2
+        edges.append((names[f], names[t], data))
+    graph.add_edges_from(edges)
+
+    weights2 = np.where(np.isnan(weights2), weights, weights2)
+    topology = CompactTopology.from_index_edges(ids, src.astype(np.int32), dst.astype(np.int32), weights, weights2)
+    return graph, topology
@@ -12,6 +12,7 @@ import os
 import requests
 
 from meshmesh.gui2.transport import RequestsTransport
+from meshmesh.hub2.linkquality import rssi_to_weight
 
 # --firmware /home/stefano/Sviluppo/Stefano/Meshmesh/esphome/tests/testmesh2/.pioenvs/testmesh2/firmware.bins
 # parameters
@@ -231,16 +232,6 @@ def discovery_nodes(repeats, id_, empty=False):
     DEVICE.save_graph('***')
     nx.readwrite.write_graphml(graph, 'discovery.graphml')
 
-def discovery_rssi_to_weight(_rssi):
-    # type: (int) -> float
-    if _rssi > 45:
-        _rssi = 45
-    if _rssi <= -1:
-        _rssi = -_rssi * 2
-    _weight = 1.0 - _rssi / 45.0
-    return _weight if _weight > 0.05 else 0.05
-
-
 def discovery_nodes2(repeats, id_, graph, local_id):
     # type: (int, int, nx.Graph, int) -> None
     id_hex = "0x%06X" % id_
@@ -284,7 +275,7 @@ def discovery_nodes2(repeats, id_, graph, local_id):
 
             if disc_ser_hex not in tnt:
                 tnt[disc_ser_hex] = {'last': None, 'next': None, 'curr': None, 'orig': False}
-            tnt[disc_ser_hex]['curr'] = discovery_rssi_to_weight(disc_rssi), discovery_rssi_to_weight(disc_rssi2)
+            tnt[disc_ser_hex]['curr'] = rssi_to_weight(disc_rssi), rssi_to_weight(disc_rssi2)
             tnt[disc_ser_hex]['next'] = tnt[disc_ser_hex]['curr'] \
                 if tnt[disc_ser_hex]['last'] is None \
                 else ((tnt[disc_ser_hex]['last'][0] + tnt[disc_ser_hex]['curr'][0]) / 2, (tnt[disc_ser_hex]['last'][1] +
@@ -325,6 +316,26 @@ def discovery_nodes2(repeats, id_, graph, local_id):
             graph[id_hex][k]['weight2'] = tnt[k]['next'][1]
 
 
+def discovery_nodes_hub(repeats, concurrency=1, budget=0):
+    # type: (int, int, int) -> None
+    if budget > 0:
+        started = DEVICE.discovery_job_incremental(budget, 0, 100)
+    else:
+        started = DEVICE.discovery_job_start(repeats, 100, concurrency)
+    if not started:
+        print('discovery_nodes_hub a discovery job is already running')
+    since = 0
+    while True:
+        events = DEVICE.discovery_job_events(since, 10.0)
+        for event in events:
+            since = event['seq']
+            node = f" 0x{event['node']:06X}" if 'node' in event else ''
+            print(f"{event['event']}{node} {event.get('tag', '')}{event.get('error', '')}")
+            if event['event'] in ('completed', 'cancelled', 'failed'):
+                print(DEVICE.discovery_job_status())
+                return
+
+
 def set_group_entity_state(_hash, _value, _group):
     _value = DEVICE.brd_service_set_entity_state(SERVICE_SWITCH, _hash, 1 if _value is True else 0, _group)
 
@@ -684,6 +695,9 @@ def main():
     parser.add_argument('--log-destination', dest='log_destination', default=-1, type=auto_int, help='set the log destination of node')
     parser.add_argument('--node-reboot', dest='node_reboot', default=None, type=auto_int, help='reboot node')
     parser.add_argument('--discovery', dest='discovery', default=0, type=auto_int, help='discovery nodes around')
+    parser.add_argument('--discovery-hub', dest='discovery_hub', default=0, type=auto_int, help='discovery nodes around running the job inside the hub')
+    parser.add_argument('--discovery-concurrency', dest='discovery_concurrency', default=1, type=auto_int, help='nodes discovered in parallel by the hub')
+    parser.add_argument('--discovery-incremental', dest='discovery_incremental', default=0, type=auto_int, help='rediscover the most stale nodes using at most N seconds of airtime')
     parser.add_argument('--discovery-entities', dest='discovery_entities', default=False, action='store_true', help='look for entitie')
     parser.add_argument('--read-entities', dest='read_entities', default=None, type=auto_int, help='Read entities')
     parser.add_argument('--set-entity-state', dest='set_entity_state', default=None, type=auto_int, help='Set entity state')
@@ -749,6 +763,10 @@ def main():
         test_send_update(args.firmware, ID_NODO)
     if args.discovery > 0:
         discovery_nodes(args.discovery, ID_NODO, True)
+    if args.discovery_hub > 0:
+        discovery_nodes_hub(args.discovery_hub, args.discovery_concurrency)
+    if args.discovery_incremental > 0:
+        discovery_nodes_hub(1, budget=args.discovery_incremental)
 
     entities = None
     for i in range(0, args.test_repeats):
@@ -0,0 +1,175 @@
+import heapq
+import math
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+COST_EXPONENT = 1.1
+
+
+class CompactTopology(object):
+    """
+    Read only mesh topology used for routing: integer node ids and CSR adjacency
+    with the edge cost precomputed as float32 (max(weight, weight2) ^ 1.1).
+    """
+    def __init__(self, ids, indptr, indices, costs):
+        # type: (np.ndarray, np.ndarray, np.ndarray, np.ndarray) -> None
+        self._ids = ids  # type: np.ndarray
+        self._indptr = indptr  # type: np.ndarray
+        self._indices = indices  # type: np.ndarray
+        self._costs = costs  # type: np.ndarray
+        self._index = {int(v): i for i, v in enumerate(ids)}  # type: Dict[int, int]
+
+    @staticmethod
+    def edge_cost(weight, weight2):
+        return np.power(np.maximum(weight, weight2), COST_EXPONENT)
+
+    @staticmethod
+    def from_edges(ids, sources, targets, weights, weights2):
+        # type: (List[int], List[int], List[int], List[float], List[float]) -> CompactTopology
+        index = {v: i for i, v in enumerate(ids)}
+        src = np.array([index[s] for s in sources], dtype=np.int32)
+        dst = np.array([index[t] for t in targets], dtype=np.int32)
+        return CompactTopology.from_index_edges(np.array(ids, dtype=np.uint32), src, dst, weights, weights2)
+
+    @staticmethod
+    def from_index_edges(node_ids, src, dst, weights, weights2):
+        # type: (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray) -> CompactTopology
+        """
+        Build the topology from edges given as positions in node_ids
+        """
+        src = np.asarray(src, dtype=np.int32)
+        dst = np.asarray(dst, dtype=np.int32)
+        cost = CompactTopology.edge_cost(np.asarray(weights, dtype=np.float64),
+                                         np.asarray(weights2, dtype=np.float64)).astype(np.float32)
+        # Undirected graph: store both directions, sorted by source node
+        src, dst = np.concatenate((src, dst)), np.concatenate((dst, src))
+        cost = np.concatenate((cost, cost))
+        order = np.argsort(src, kind='stable')
+        indptr = np.zeros(len(node_ids) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(src, minlength=len(node_ids)), out=indptr[1:])
+        return CompactTopology(node_ids, indptr, dst[order], cost[order])
+
+    @staticmethod
+    def from_graph(graph):
+        # type: (nx.Graph) -> CompactTopology
+        index = {n: i for i, n in enumerate(graph.nodes)}
+        ids = np.array([int(n[2:], 16) for n in index], dtype=np.uint32)
+        sources, targets, weights, weights2 = [], [], [], []
+        for f, t, data in graph.edges(data=True):
+            sources.append(index[f])
+            targets.append(index[t])
+            weights.append(data['weight'])
+            weights2.append(data.get('weight2', data['weight']))
+        return CompactTopology.from_index_edges(ids, sources, targets, weights, weights2)
+
+    @property
+    def nbytes(self):
+        # type: () -> int
+        return self._ids.nbytes + self._indptr.nbytes + self._indices.nbytes + self._costs.nbytes
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, node_id):
+        return node_id in self._index
+
+    def set_edge_cost(self, _from, _to, weight, weight2):
+        # type: (int, int, float, float) -> bool
+        """
+        Change the cost of an existing edge in place, return False if the edge is not present
+        """
+        u, v = self._index.get(_from), self._index.get(_to)
+        if u is None or v is None:
+            return False
+        cost = np.float32(max(weight, weight2) ** COST_EXPONENT)
+        found = False
+        for a, b in ((u, v), (v, u)):
+            row = self._indices[self._indptr[a]:self._indptr[a + 1]]
+            pos = np.nonzero(row == b)[0]
+            if len(pos) > 0:
+                self._costs[self._indptr[a] + pos[0]] = cost
+                found = True
+        return found
+
+    def shortest_path_tree(self, source):
+        # type: (int) -> Tuple[np.ndarray, np.ndarray]
+        """
+        Dijkstra from source, returns distance and parent (index) of every node
+        """
+        n = len(self._ids)
+        dist = [math.inf] * n
+        parent = [-1] * n
+        start = self._index[source]
+        dist[start] = 0.0
+        indptr = self._indptr.tolist()
+        indices = self._indices.tolist()
+        costs = self._costs.tolist()
+        heap = [(0.0, start)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                nd = d + costs[k]
+                if nd < dist[v]:
+                    dist[v] = nd
+                    parent[v] = u
+                    heapq.heappush(heap, (nd, v))
+        return np.array(dist, dtype=np.float64), np.array(parent, dtype=np.int32)
+
+    def node_id(self, index):
+        # type: (int) -> int
+        return int(self._ids[index])
+
+    def node_index(self, node_id):
+        # type: (int) -> Optional[int]
+        return self._index.get(node_id)
+
+
+class RouteTree(object):
+    """
+    Shortest path tree rooted at the coordinator, paths are rebuilt from the parent
+    array on first use and then cached.
+    """
+    def __init__(self, topology, source):
+        # type: (CompactTopology, int) -> None
+        self._topology = topology  # type: CompactTopology
+        self._source = source  # type: int
+        self._dist, self._parent = topology.shortest_path_tree(source)
+        self._paths = {}  # type: Dict[int, List[int]]
+
+    def distance(self, target):
+        # type: (int) -> float
+        index = self._topology.node_index(target)
+        return math.inf if index is None else float(self._dist[index])
+
+    def parent(self, target):
+        # type: (int) -> Optional[int]
+        index = self._topology.node_index(target)
+        if index is None or self._parent[index] < 0:
+            return None
+        return self._topology.node_id(self._parent[index])
+
+    def path(self, target):
+        # type: (int) -> Optional[List[int]]
+        path = self._paths.get(target)
+        if path is not None:
+            return path
+        index = self._topology.node_index(target)
+        if index is None:
+            return None
+        if target == self._source:
+            path = [target]
+        elif self._parent[index] < 0:
+            return None
+        else:
+            reverse = []
+            while index >= 0:
+                reverse.append(self._topology.node_id(index))
+                index = int(self._parent[index])
+            path = reverse[::-1]
+        self._paths[target] = path
+        return path
@@ -1,169 +1,87 @@
-import asyncio
 import binascii
-import logging
+import json
 import os
 import tempfile
 from typing import List
 
 from aiohttp_xmlrpc import handler
-from aiohttp.web import Application, AppRunner, TCPSite, Request, Response
-from asyncio import AbstractEventLoop, wait_for, TimeoutError, sleep
+from aiohttp.web import Application, AppRunner, TCPSite, Request, Response, StreamResponse
+from asyncio import AbstractEventLoop
 
 from .direct import DirectBase
 from .frame import APIFrame
 
 from .serialprotocol import SerialProtocol
-from .connectedpath import ConnectedPathProtocol
 from .network import GraphNetwork
-
-globalProtocol = 'unicast'
-
-
-def set_global_protocol(value):
-    # type: (str) -> None
-    global globalProtocol
-
-    if value in ['unicast', 'beacons', 'multipath', 'polite', 'connpath']:
-        globalProtocol = value
-    else:
-        logging.error('Invalid protocol requested')
+from .noderpc import rpc_request, set_global_protocol, RPC_TIMEOUT
+from .discovery import DiscoveryEngine
+from .connlog import ConnectionLog
+from .apicache import ApiCache
 
 
 class XMLRPCHub(handler.XMLRPCView):
     def __init__(self, request):
         super(XMLRPCHub, self).__init__(request)
-        self._timeout = 3.0  # type: float
-
-    def _flush_rx_queue(self, serprot):
-        while not serprot.rx_frames.empty():
-            print('Flush queue')
-            try:
-                serprot.rx_frames.get_nowait()
-            except asyncio.QueueEmpty:
-                pass
-
-    async def _rpc_standard_req(self, buffer, serial, protocol):
-        # type: (bytes, int, str) -> bytes
-        serprot = SerialProtocol.get()  # type: SerialProtocol
-        if serial == 0:
-            frame = APIFrame(buffer, escaped=True)
-        elif protocol == 'unicast':
-            buffer = DirectBase.build_command('unicast', target=serial, payload=buffer)
-            frame = APIFrame(buffer, escaped=True)
-        elif GraphNetwork.instance().is_network_loaded():
-            path = GraphNetwork.instance().shortest_path(serial)
-            if len(path) == 0:
-                pass
-            elif len(path) == 1:
-                buffer = DirectBase.build_command('unicast', target=serial, payload=buffer)
-            else:
-                path = path[0:-1]
-                buffer = DirectBase.build_command('multipath', target=serial, pathlen=len(path), path=path,
-                                                  payload=buffer)
-            frame = APIFrame(buffer, escaped=True)
-        else:
-            buffer = DirectBase.build_command('unicast', target=serial, payload=buffer)
-            frame = APIFrame(buffer, escaped=True)
-
-        while not serprot.rx_frames.empty():
-            print('Flush queue')
-            try:
-                serprot.rx_frames.get_nowait()
-            except asyncio.QueueEmpty:
-                pass
-
-        async with serprot.lock:
-            serprot.send_api_frame(frame)
-
-        timeout_ex = None
-        buffer = None
-        try:
-            buffer = await wait_for(serprot.rx_frames.get(), timeout=self._timeout)
-        except TimeoutError as ex:
-            timeout_ex = ex
-        if timeout_ex is not None:
-            logging.error(f"Timeout error while waiting for reply from node {serial:08x}")
-            raise Exception('Timeout error while waiting for reply')
-
-        return buffer
-
-    @staticmethod
-    async def _rpc_connpath_req(buffer, serial):
-        # type: (bytes, int) -> bytes
-        connpath = ConnectedPathProtocol.get()
-        return await connpath.send_and_receive_data(buffer, serial)
+        self._timeout = RPC_TIMEOUT  # type: float
 
     async def _rpc_request(self, serial, reply, cmd, **cmdkwargs):
-        global globalProtocol
-
-        commands = cmd.split('/')
-        in_buffer = DirectBase.build_command(cmd, **cmdkwargs)
-
-        if isinstance(serial, str):
-            serial = int(serial, 16)
-
-        if serial > 0 and globalProtocol == 'connpath':
-            buffer = await XMLRPCHub._rpc_connpath_req(in_buffer, serial)
-        else:
-            buffer = await self._rpc_standard_req(in_buffer, serial, globalProtocol)
-
-        frame = DirectBase.split_response(buffer)
-        if frame['id'] != commands[-1]:
-            if frame['id'] == 'error':
-                logging.error(f"Reply Error from node {serial:08x} data is {binascii.hexlify(frame['data'])}")
-                raise Exception('Error request %s' % binascii.hexlify(frame['data']))
-            else:
-                print(frame['id'], commands[-1])
-                logging.error(f"Reply mismateched from node {serial:08x}")
-                raise Exception('Malformed meshmesh packet %s' % binascii.hexlify(buffer))
-        else:
-            if globalProtocol == 'polite':
-                await sleep(0.5)
-            if reply is None:
-                return True
-            if isinstance(reply, str):
-                if reply not in frame:
-                    raise Exception(f'Invalid reply received {reply} not found')
-                return frame[reply]
-            elif isinstance(reply, tuple):
-                result = []
-                replies = list(reply)
-                for reply in replies:
-                    optional = False
-                    if reply[0] == '*':
-                        reply = reply[1:]
-                        optional = True
-                    if reply not in frame:
-                        if not optional:
-                            raise Exception('Invalid reply received')
-                    else:
-                        result.append(frame[reply])
-                return tuple(result)
-
-        return frame[reply]
+        return await rpc_request(serial, reply, cmd, self._timeout, **cmdkwargs)
 
     async def _rpc_polite_broadcast_rquest(self, group, cmd, **cmdkwargs):
-        global globalProtocol
         serprot = SerialProtocol.get()  # type: SerialProtocol
         in_buffer = DirectBase.build_command(cmd, **cmdkwargs)
         in_buffer = DirectBase.build_command('filter', target=group, payload=in_buffer)
         in_buffer = DirectBase.build_command('polite', target=0xFFFFFFFF, payload=in_buffer)
         print(binascii.hexlify(in_buffer))
         frame = APIFrame(in_buffer, escaped=True)
-        self._flush_rx_queue(serprot)
         async with serprot.lock:
             serprot.send_api_frame(frame)
 
     @staticmethod
-    def rpc_load_graph(filename):
+    async def rpc_load_graph(filename):
         # type: (str) -> None
         if os.path.exists(filename):
-            GraphNetwork.instance().load_network(filename)
+            await GraphNetwork.instance().load_network_async(filename)
 
     @staticmethod
-    def rpc_save_graph(filename):
+    async def rpc_save_graph(filename):
         # type: (str) -> None
-        GraphNetwork.instance().save_network(filename, True)
+        await GraphNetwork.instance().save_network_async(filename, True)
+
+    @staticmethod
+    def rpc_discovery_job_start(repeats, slots, concurrency):
+        # type: (int, int, int) -> bool
+        return DiscoveryEngine.instance().start(repeats, slots, concurrency=concurrency)
+
+    @staticmethod
+    def rpc_discovery_job_incremental(budget, interval, slots):
+        # type: (float, float, int) -> bool
+        return DiscoveryEngine.instance().start_incremental(budget, interval, slots)
+
+    @staticmethod
+    def rpc_discovery_job_stop():
+        # type: () -> bool
+        return DiscoveryEngine.instance().stop()
+
+    @staticmethod
+    def rpc_discovery_job_status():
+        # type: () -> dict
+        return DiscoveryEngine.instance().status()
+
+    @staticmethod
+    async def rpc_discovery_job_events(since, timeout):
+        # type: (int, float) -> list
+        return await DiscoveryEngine.instance().wait_events(since, timeout)
+
+    @staticmethod
+    async def rpc_connection_log(node, since, until, reason, limit):
+        # type: (int, float, float, str, int) -> list
+        return await ConnectionLog.instance().query(node, since, until, reason, limit)
+
+    @staticmethod
+    def rpc_connection_log_recent():
+        # type: () -> list
+        return ConnectionLog.instance().recent()
 
     @staticmethod
     def rpc_shortest_path(serial):
@@ -190,6 +108,7 @@ class XMLRPCHub(handler.XMLRPCView):
     async def rpc_cmd_update_start(self, size, md5, serial):
         # type: (int, str, int) -> int
         __md5__ = md5.encode() + b'\0'
+        ApiCache.instance().invalidate(serial, 'update started')
         return await self._rpc_request(serial, 'error', 'updateStart', size=size, md5=__md5__)
 
     async def rpc_cmd_update_chunk(self, chunk, serial):
@@ -235,6 +154,7 @@ class XMLRPCHub(handler.XMLRPCView):
             return "Flash read undefined"
 
     async def rpc_cmd_reboot(self, serial):
+        ApiCache.instance().invalidate(serial, 'reboot requested')
         return await self._rpc_request(serial, None, 'reboot')
 
     async def rpc_cmd_discovery_reset(self, serial):
@@ -336,10 +256,11 @@ async def upload_xml(request):
     post = await request.post()
     graph = post.get("graph")
     if graph:
-        fp = tempfile.NamedTemporaryFile()
+        fp = tempfile.NamedTemporaryFile(suffix='.graphml')
         fp.write(graph.file.read())
         fp.flush()
-        GraphNetwork.instance().load_network(fp.name, is_temporary=True)
+        await GraphNetwork.instance().load_network_async(fp.name, is_temporary=True)
+        GraphNetwork.instance().precompute_routes()
         fp.close()
         response = 'OK'
     return Response(text=response)
@@ -347,18 +268,47 @@ async def upload_xml(request):
 
 async def download_xml(request):
     # type: (Request) -> Response
-    _, filename = tempfile.mkstemp()
-    GraphNetwork.instance().save_network(filename)
-    with open(filename, 'r') as fp:
-        body = fp.read()
-    print(filename, body)
-    os.unlink(filename)
+    body = await GraphNetwork.instance().graphml_async()
     return Response(body=body, content_type='application/xml')
 
 
-def xmlrpcserver_setup(loop: AbstractEventLoop, protocol: str, port: int):
-    global globalProtocol
+async def discovery_events(request):
+    # type: (Request) -> StreamResponse
+    """
+    Stream the discovery job events as JSON lines until the job ends
+    """
+    engine = DiscoveryEngine.instance()
+    since = int(request.query.get('since', 0))
+    response = StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    while True:
+        events = await engine.wait_events(since, 30.0)
+        for event in events:
+            await response.write(json.dumps(event).encode() + b'\n')
+            since = event['seq']
+        if not engine.running:
+            break
+    await response.write_eof()
+    return response
+
+
+async def connection_log(request):
+    # type: (Request) -> Response
+    """
+    Closed connections as JSON, filtered by the node, since, until, reason and limit query parameters.
+    With recent=1 the connections kept in memory, open ones included.
+    """
+    log = ConnectionLog.instance()
+    query = request.query
+    if query.get('recent', '0') == '1':
+        rows = log.recent()
+    else:
+        rows = await log.query(int(query.get('node', '0'), 0), float(query.get('since', 0)), float(query.get('until', 0)),
+                               query.get('reason', ''), int(query.get('limit', 0)))
+    return Response(text=json.dumps(rows), content_type='application/json')
 
+
+def xmlrpcserver_setup(loop: AbstractEventLoop, protocol: str, port: int):
     if protocol:
         set_global_protocol(protocol)
 
@@ -366,6 +316,8 @@ def xmlrpcserver_setup(loop: AbstractEventLoop, protocol: str, port: int):
     app.router.add_route('*', '/RPC2', XMLRPCHub)
     app.router.add_route('POST', '/upload_xml', upload_xml)
     app.router.add_route('GET', '/download_xml', download_xml)
+    app.router.add_route('GET', '/discovery_events', discovery_events)
+    app.router.add_route('GET', '/connection_log', connection_log)
     runner = AppRunner(app)
     loop.run_until_complete(runner.setup())
     site = TCPSite(runner, host='0.0.0.0', port=port)